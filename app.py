@@ -1,102 +1,279 @@
 import sys
 import os
+import asyncio
 import io
-import queue
+import math
 import threading
 import requests
 from pathlib import Path
 from contextlib import asynccontextmanager
+from functools import partial
 from typing import Optional
 
 # Add local source to path for offline usage
 sys.path.insert(0, str(Path(__file__).parent / "pocket-tts-src"))
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-import torch
 import uvicorn
-import threading
 
-# Global control flags
-abort_event = threading.Event()
+# Stop flags of the generations, by X-Request-ID
+abort_events = {}
 
 # Pocket TTS imports
 import pocket_tts
-from pocket_tts.models.tts_model import TTSModel
+from pocket_tts.bundle import load_model_from_bundle
+from pocket_tts.variants import VOICE_CLONING, WITHOUT_VOICE_CLONING, load_model_variants, with_parameters
+from pocket_tts.snapshot import compute_fingerprint, compute_voice_states, load_snapshot, save_snapshot
+from pocket_tts.warmup import WARMUP_TEXT, Readiness
+from pocket_tts.admission import (
+    DEFAULT_MAX_CONCURRENCY,
+    DEFAULT_MAX_QUEUE_LENGTH,
+    DEFAULT_PREEMPTION_RATIO,
+    DEFAULT_QUEUE_TIMEOUT,
+    DEFAULT_SCHEDULING_POLICY,
+    DEFAULT_STARVATION_SECONDS,
+    CLIENT_ID_HEADER,
+    AdmissionController,
+    QueueFullError,
+    QueueTimeoutError,
+    estimate_cost,
+    parse_client_weights
+)
+from pocket_tts.preemption import get_preemption, new_generation
+from pocket_tts.parallel import generate_parallel_audio_stream
+from pocket_tts.seeding import seeded_generator
+from pocket_tts.batches import BatchManager
+from pocket_tts.utterance_cache import UtteranceCache, utterance_key, voice_file_identity
+from pocket_tts.single_flight import SingleFlight
+from pocket_tts.executor import GenerationExecutor, auto_tune
+from pocket_tts.utils.profiling import profile_generation
+from pocket_tts.utils import tracing
+from pocket_tts import metrics
 from pocket_tts.utils.config import load_config
-from pocket_tts.utils.utils import PREDEFINED_VOICES
+from pocket_tts.utils.utils import size_of_dict
 import pocket_tts.utils.utils as utils_module
 from pocket_tts.default_parameters import (
     DEFAULT_TEMPERATURE,
     DEFAULT_LSD_DECODE_STEPS,
     DEFAULT_NOISE_CLAMP,
     DEFAULT_EOS_THRESHOLD,
-    DEFAULT_AUDIO_PROMPT,
-    DEFAULT_VARIANT
+    DEFAULT_VARIANT,
+    DEFAULT_UTTERANCE_CACHE_MB,
+    DEFAULT_UTTERANCE_CACHE_DISK_MB
 )
 from pocket_tts.data.audio import stream_audio_chunks
 
 MODELS_DIR = Path(__file__).parent / "models"
+BUNDLE_PATH = MODELS_DIR / "pocket_tts.bundle"
+# Ready-to-serve state written after a full load, restored at the next boots.
+# Set POCKET_TTS_SNAPSHOT=0 to disable it.
+SNAPSHOT_PATH = MODELS_DIR / "pocket_tts.snapshot"
+SNAPSHOT_ENABLED = os.environ.get("POCKET_TTS_SNAPSHOT", "1") != "0"
+# Results of the batches submitted to /api/batches (manifest and one WAV per item)
+RESULTS_DIR = Path(os.environ.get("POCKET_TTS_RESULTS_DIR", Path(__file__).parent / "results"))
+# Text synthesized with each preloaded voice before reporting ready.
+# Set POCKET_TTS_WARMUP=0 to disable it.
+WARMUP_ENABLED = os.environ.get("POCKET_TTS_WARMUP", "1") != "0"
+WARMUP_TEXT = os.environ.get("POCKET_TTS_WARMUP_TEXT", WARMUP_TEXT)
+# Generations running at once, the other requests wait in a bounded queue (429 when full)
+MAX_CONCURRENCY = int(os.environ.get("POCKET_TTS_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+MAX_QUEUE_LENGTH = int(os.environ.get("POCKET_TTS_MAX_QUEUE", DEFAULT_MAX_QUEUE_LENGTH))
+# Requests waiting longer than this (in seconds) are dropped
+QUEUE_TIMEOUT = float(os.environ.get("POCKET_TTS_QUEUE_TIMEOUT", DEFAULT_QUEUE_TIMEOUT))
+# Order of the waiting requests: "fifo", "sjf" (shortest job first, from the token count)
+# or "fair" (weighted fair between clients, weights given as "alice=2,bob=1")
+SCHEDULING_POLICY = os.environ.get("POCKET_TTS_SCHEDULING", DEFAULT_SCHEDULING_POLICY)
+STARVATION_SECONDS = float(os.environ.get("POCKET_TTS_STARVATION_SECONDS", DEFAULT_STARVATION_SECONDS))
+CLIENT_WEIGHTS = parse_client_weights(os.environ.get("POCKET_TTS_CLIENT_WEIGHTS", ""))
+# A running generation is paused for a request this many times cheaper, 0 disables it.
+# Set POCKET_TTS_PREEMPT_SPILL_DIR to save the paused states on disk instead of keeping them in RAM.
+PREEMPTION_RATIO = float(os.environ.get("POCKET_TTS_PREEMPTION_RATIO", DEFAULT_PREEMPTION_RATIO)) or None
+# Segments of a long text (groups of sentences) generated at once by a request, 1 generates them in order
+SEGMENT_WORKERS = int(os.environ.get("POCKET_TTS_SEGMENT_WORKERS", "1"))
+# WAV files of the seeded (or temperature 0) requests, answered again without a generation.
+# Set POCKET_TTS_UTTERANCE_CACHE_MB=0 to disable it, POCKET_TTS_UTTERANCE_CACHE_DIR to keep them across restarts.
+UTTERANCE_CACHE_MB = int(os.environ.get("POCKET_TTS_UTTERANCE_CACHE_MB", DEFAULT_UTTERANCE_CACHE_MB))
+UTTERANCE_CACHE_DIR = os.environ.get("POCKET_TTS_UTTERANCE_CACHE_DIR")
+UTTERANCE_CACHE_DISK_MB = int(os.environ.get("POCKET_TTS_UTTERANCE_CACHE_DISK_MB", DEFAULT_UTTERANCE_CACHE_DISK_MB))
+# Identical seeded (or temperature 0) requests running at once share one generation.
+# Set POCKET_TTS_COALESCE=0 to disable it.
+COALESCE_ENABLED = os.environ.get("POCKET_TTS_COALESCE", "1") != "0"
+# Torch threads of each generation, by default the CPUs divided by twice the maximum concurrency.
+# Set POCKET_TTS_PIN_CPUS=1 to pin each running generation to cores of its own (Linux).
+THREADS_PER_WORKER = int(os.environ.get("POCKET_TTS_THREADS_PER_WORKER", "0")) or None
+PIN_CPUS = os.environ.get("POCKET_TTS_PIN_CPUS", "0") == "1"
+# Set POCKET_TTS_AUTO_TUNE=1 to measure a few concurrencies and torch threads per generation at startup
+# and use the one generating the most frames per second (keeps POCKET_TTS_MAX_CONCURRENCY if set).
+AUTO_TUNE = os.environ.get("POCKET_TTS_AUTO_TUNE", "0") == "1"
 
 # Global model
 tts_model = None
+# All the loaded variants (with/without voice cloning), they share their common weights
+tts_models = {}
+default_variant = None
+# Precomputed states of the predefined voices: {variant: {voice: model_state}}
+voice_states = {}
+# Batches of generations, processed in the background by the free generation slots
+batches = None
+# "loading", "warming_up", "ready" or "failed", with the measured warm-path latency
+readiness = Readiness()
+utterance_cache = UtteranceCache(
+    UTTERANCE_CACHE_MB * 1024 * 1024, UTTERANCE_CACHE_DIR, UTTERANCE_CACHE_DISK_MB * 1024 * 1024
+) if UTTERANCE_CACHE_MB > 0 else None
+single_flight = SingleFlight() if COALESCE_ENABLED else None
+# Threads of the generations (the generations paused by preemption keep theirs), built once
+# the models are loaded since it sets the number of torch threads of the process
+generation_executor = None
+admission = AdmissionController(
+    MAX_CONCURRENCY, MAX_QUEUE_LENGTH, QUEUE_TIMEOUT, SCHEDULING_POLICY, STARVATION_SECONDS, CLIENT_WEIGHTS,
+    PREEMPTION_RATIO
+)
+
+def use_local_voices():
+    # Patch PREDEFINED_VOICES to use local files if available
+    voices_dir = MODELS_DIR / "embeddings"
+    if voices_dir.exists():
+        print(f"Checking for local voices in {voices_dir}")
+        local_voices_count = 0
+        for name in utils_module._voices_names:
+             voice_path = voices_dir / f"{name}.safetensors"
+             if voice_path.exists():
+                 utils_module.PREDEFINED_VOICES[name] = str(voice_path)
+                 local_voices_count += 1
+        if local_voices_count > 0:
+            print(f"Updated {local_voices_count} voices to use local files")
+
+def snapshot_fingerprint():
+    config_path = Path(pocket_tts.__file__).parent / f"config/{DEFAULT_VARIANT}.yaml"
+    inputs = [
+        config_path,
+        BUNDLE_PATH,
+        MODELS_DIR / "tts_b6369a24.safetensors",
+        MODELS_DIR / "tts_b6369a24_no_vc.safetensors",
+        MODELS_DIR / "tokenizer.model",
+    ] + [MODELS_DIR / "embeddings" / f"{name}.safetensors" for name in utils_module._voices_names]
+    return compute_fingerprint(inputs)
+
+def load_models():
+    if BUNDLE_PATH.exists():
+        # Everything (weights, tokenizer, voices) is memory-mapped from one file
+        print(f"Found local bundle: {BUNDLE_PATH}")
+        model = load_model_from_bundle(
+            BUNDLE_PATH,
+            DEFAULT_TEMPERATURE,
+            DEFAULT_LSD_DECODE_STEPS,
+            DEFAULT_NOISE_CLAMP,
+            DEFAULT_EOS_THRESHOLD
+        )
+        variant = VOICE_CLONING if model.has_voice_cloning else WITHOUT_VOICE_CLONING
+        return {variant: model}
+
+    # Load config
+    config_path = Path(pocket_tts.__file__).parent / f"config/{DEFAULT_VARIANT}.yaml"
+    print(f"Loading config from {config_path}")
+    config = load_config(config_path)
+
+    # Override with local paths
+    weights_path = MODELS_DIR / "tts_b6369a24.safetensors"
+    if weights_path.exists():
+        print(f"Found local weights: {weights_path}")
+        config.weights_path = str(weights_path)
+    else:
+        print(f"Local weights not found at {weights_path}, using config default (might download)")
+
+    weights_no_vc = MODELS_DIR / "tts_b6369a24_no_vc.safetensors"
+    if weights_no_vc.exists():
+        print(f"Found local no-VC weights: {weights_no_vc}")
+        config.weights_path_without_voice_cloning = str(weights_no_vc)
+
+    tokenizer_path = MODELS_DIR / "tokenizer.model"
+    if tokenizer_path.exists():
+        print(f"Found local tokenizer: {tokenizer_path}")
+        config.flow_lm.lookup_table.tokenizer_path = str(tokenizer_path)
+
+    # Load both variants using the modified config, with a single copy of the shared weights
+    return load_model_variants(
+        config,
+        DEFAULT_TEMPERATURE,
+        DEFAULT_LSD_DECODE_STEPS,
+        DEFAULT_NOISE_CLAMP,
+        DEFAULT_EOS_THRESHOLD
+    )
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global tts_model
+    global tts_model, tts_models, default_variant, voice_states, batches, generation_executor
     
     print("Initializing Pocket TTS Web UI...")
     
     print("Loading Model... using local offline models if available")
     try:
-        # Load config
-        config_path = Path(pocket_tts.__file__).parent / f"config/{DEFAULT_VARIANT}.yaml"
-        print(f"Loading config from {config_path}")
-        config = load_config(config_path)
-
-        # Override with local paths
-        weights_path = MODELS_DIR / "tts_b6369a24.safetensors"
-        if weights_path.exists():
-            print(f"Found local weights: {weights_path}")
-            config.weights_path = str(weights_path)
-        else:
-            print(f"Local weights not found at {weights_path}, using config default (might download)")
-
-        weights_no_vc = MODELS_DIR / "tts_b6369a24_no_vc.safetensors"
-        if weights_no_vc.exists():
-            print(f"Found local no-VC weights: {weights_no_vc}")
-            config.weights_path_without_voice_cloning = str(weights_no_vc)
-
-        tokenizer_path = MODELS_DIR / "tokenizer.model"
-        if tokenizer_path.exists():
-            print(f"Found local tokenizer: {tokenizer_path}")
-            config.flow_lm.lookup_table.tokenizer_path = str(tokenizer_path)
-
-        # Patch PREDEFINED_VOICES to use local files if available
-        voices_dir = MODELS_DIR / "embeddings"
-        if voices_dir.exists():
-            print(f"Checking for local voices in {voices_dir}")
-            local_voices_count = 0
-            for name in utils_module._voices_names:
-                 voice_path = voices_dir / f"{name}.safetensors"
-                 if voice_path.exists():
-                     utils_module.PREDEFINED_VOICES[name] = str(voice_path)
-                     local_voices_count += 1
-            if local_voices_count > 0:
-                print(f"Updated {local_voices_count} voices to use local files")
-
-        # Load model using the modified config
-        tts_model = TTSModel._from_pydantic_config_with_weights(
-            config,
-            DEFAULT_TEMPERATURE,
-            DEFAULT_LSD_DECODE_STEPS,
-            DEFAULT_NOISE_CLAMP,
-            DEFAULT_EOS_THRESHOLD
-        )
+        use_local_voices()
+        fingerprint = snapshot_fingerprint()
+
+        if SNAPSHOT_ENABLED and SNAPSHOT_PATH.exists():
+            try:
+                tts_models, voice_states = load_snapshot(
+                    SNAPSHOT_PATH,
+                    fingerprint,
+                    DEFAULT_TEMPERATURE,
+                    DEFAULT_LSD_DECODE_STEPS,
+                    DEFAULT_NOISE_CLAMP,
+                    DEFAULT_EOS_THRESHOLD
+                )
+                print(f"Restored snapshot: {SNAPSHOT_PATH}")
+                for variant_states in voice_states.values():
+                    for name in variant_states:
+                        utils_module.PREDEFINED_VOICES.setdefault(name, str(SNAPSHOT_PATH))
+            except ValueError as e:
+                # Not a snapshot, or a stale one
+                print(f"Could not restore snapshot ({e}), doing a full load")
+
+        if not tts_models:
+            tts_models = load_models()
+            if SNAPSHOT_ENABLED:
+                print("Computing voice states and writing snapshot...")
+                voice_states = compute_voice_states(tts_models)
+                try:
+                    save_snapshot(SNAPSHOT_PATH, tts_models, voice_states, fingerprint)
+                except Exception as e:
+                    print(f"Could not write snapshot: {e}")
+
+        print(f"Loaded variants: {list(tts_models)}")
+        metrics.VOICE_CACHE_BYTES.set_function(lambda: sum(
+            size_of_dict(state) for states in voice_states.values() for state in states.values()
+        ))
+        default_variant = VOICE_CLONING if VOICE_CLONING in tts_models else WITHOUT_VOICE_CLONING
+        tts_model = tts_models[default_variant]
         # tts_model.to("cpu")
         print("Model Loaded Successfully!")
+
+        # Warm up in the background, /api/status reports "warming_up" meanwhile
+        warmup_states = voice_states.get(default_variant) or {
+            'alba': tts_model._cached_get_state_for_audio_prompt('alba', truncate=True)
+        }
+
+        workers, threads = MAX_CONCURRENCY, THREADS_PER_WORKER
+        if AUTO_TUNE:
+            print("Auto-tuning the generation threads...")
+            num_workers = MAX_CONCURRENCY if "POCKET_TTS_MAX_CONCURRENCY" in os.environ else None
+            workers, threads = await asyncio.to_thread(
+                auto_tune, tts_model, next(iter(warmup_states.values())), num_workers, PIN_CPUS
+            )
+            print(f"Running {workers} generations at once with {threads} torch threads")
+            admission.max_concurrency = workers
+        generation_executor = GenerationExecutor(workers, threads, PIN_CPUS, workers + MAX_QUEUE_LENGTH)
+
+        print(f"Warming up with voices: {list(warmup_states)}")
+        readiness.start_warm_up(tts_model, warmup_states, WARMUP_TEXT if WARMUP_ENABLED else None)
+
+        batches = BatchManager(
+            RESULTS_DIR, synthesize_batch_item, estimate_batch_item_cost, tts_model.sample_rate
+        )
+        batches_task = asyncio.create_task(batches.serve(admission, generation_executor))
         
     except Exception as e:
         print(f"Failed to load model: {e}")
@@ -106,6 +283,8 @@ async def lifespan(app: FastAPI):
     yield
     
     print("Shutting down")
+    if batches is not None:
+        batches_task.cancel()
 
 app = FastAPI(title="Pocket TTS Local", lifespan=lifespan)
 
@@ -132,10 +311,37 @@ async def get_voices():
 @app.get("/api/status")
 async def status():
     return {
-        "status": "ready" if tts_model else "model_not_loaded",
-        "has_voice_cloning": tts_model.has_voice_cloning if tts_model else False
+        "status": readiness.status if tts_model else "model_not_loaded",
+        "has_voice_cloning": tts_model.has_voice_cloning if tts_model else False,
+        "variants": list(tts_models),
+        "warm_latency": readiness.warm_latency
     }
 
+@app.get("/api/queue")
+async def queue_status():
+    # Generations running and waiting, with the estimated wait of a new request
+    return admission.status()
+
+@app.get("/api/queue/{request_id}")
+async def request_queue_status(request_id: str):
+    # Position and estimated wait of a request sent with this X-Request-ID header
+    status = admission.request_status(request_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown request, or already finished")
+    return status
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus scrape endpoint
+    return PlainTextResponse(metrics.REGISTRY.exposition(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/health")
+async def health():
+    # Readiness probe: 503 until the model is loaded and warmed up
+    if not readiness.is_ready:
+        return JSONResponse(status_code=503, content=readiness.as_dict())
+    return {"status": "healthy", "warm_latency": readiness.warm_latency}
+
 def write_to_queue(q, text, model_state):
     """Bridge generator to queue for StreamingResponse"""
     print(f"Starting generation for text: {text[:20]}...")
@@ -166,26 +372,154 @@ def iter_audio(q):
         yield data
 
 @app.post("/api/stop")
-async def stop_generation():
-    print("Stop request received")
+async def stop_generation(request: Request):
+    # Stops the generation sent with the same X-Request-ID header, queued or running
+    request_id = request.headers.get(tracing.REQUEST_ID_HEADER)
+    print(f"Stop request received for {request_id}")
+    abort_event = abort_events.get(request_id)
+    if abort_event is None:
+        raise HTTPException(status_code=404, detail="Unknown request, or already finished")
     abort_event.set()
     return {"status": "stopped"}
 
 @app.post("/api/generate")
 async def generate(
+    request: Request,
     text: str = Form(...),
     voice: Optional[str] = Form(None),
     file: Optional[UploadFile] = File(None),
     url: Optional[str] = Form(None),
     seed: Optional[int] = Form(None),
     temperature: Optional[float] = Form(None),
-    lsd_steps: Optional[int] = Form(None)
+    lsd_steps: Optional[int] = Form(None),
+    variant: Optional[str] = Form(None),
+    profile: bool = Form(False),
+    timeout: Optional[float] = Form(None)
 ):
     if not tts_model:
         raise HTTPException(status_code=503, detail="Model not loaded")
+
+    # Spans of the request, returned in the Server-Timing header (and exported if configured)
+    trace = tracing.Trace(request.headers.get(tracing.REQUEST_ID_HEADER))
+
+    # The same seeded (or temperature 0) request gives the same audio, answer it from the cache
+    cache_key = None
+    model_variant = variant if variant is not None else default_variant
+    if (utterance_cache is not None or single_flight is not None) and model_variant in tts_models:
+        model_temperature = temperature if temperature is not None else tts_models[model_variant].temp
+        if seed is not None or model_temperature == 0:
+            cache_key = await utterance_cache_key(
+                text, voice, file, url, seed, model_temperature, lsd_steps, model_variant
+            )
+    if cache_key is not None and utterance_cache is not None:
+        data = await asyncio.to_thread(utterance_cache.get, cache_key)
+        if data is not None:
+            return Response(
+                data,
+                media_type="audio/wav",
+                headers={
+                    "Content-Disposition": "attachment; filename=output.wav",
+                    "X-Cache": "HIT",
+                    tracing.REQUEST_ID_HEADER: trace.request_id
+                }
+            )
+
+    # The same request already running generates for this one too
+    flight = None
+    while cache_key is not None and single_flight is not None and flight is None:
+        flight, leading = single_flight.join(cache_key)
+        if leading:
+            break
+        if await flight.wait_started():
+            metrics.COALESCED_REQUESTS.inc()
+            data = b"".join([chunk async for chunk in flight.read()])
+            return Response(
+                data,
+                media_type="audio/wav",
+                headers={
+                    "Content-Disposition": "attachment; filename=output.wav",
+                    "X-Cache": "COALESCED",
+                    tracing.REQUEST_ID_HEADER: trace.request_id
+                }
+            )
+        # It failed (or was stopped) before its audio, generate it here
+        flight = None
+
+    try:
+        return await admit_and_generate(
+            request, trace, text, voice, file, url, seed, temperature, lsd_steps, variant, profile, timeout,
+            cache_key, flight
+        )
+    finally:
+        if flight is not None:
+            flight.close()
+
+async def admit_and_generate(request, trace, text, voice, file, url, seed, temperature, lsd_steps, variant, profile,
+                             timeout, cache_key, flight):
+    # Wait for a generation slot, the client can poll /api/queue/{request_id} meanwhile.
+    # Short texts go first with the "sjf" policy.
+    cost = estimate_cost(tts_model, text, lsd_steps)
+    client_id = request.headers.get(CLIENT_ID_HEADER) or (request.client and request.client.host) or "default"
+    # /api/stop with the same X-Request-ID stops this generation only
+    abort_event = abort_events[trace.request_id] = threading.Event()
+    try:
+        metrics.QUEUE_DEPTH.inc()
+        try:
+            with trace.span("queue"):
+                ticket = await admission.acquire(trace.request_id, timeout, cost, client_id)
+        except QueueFullError as e:
+            return JSONResponse(
+                status_code=429,
+                content={"detail": str(e), **admission.status()},
+                headers={"Retry-After": str(math.ceil(e.retry_after))}
+            )
+        except QueueTimeoutError as e:
+            return JSONResponse(status_code=503, content={"detail": str(e)})
+        finally:
+            metrics.QUEUE_DEPTH.dec()
+
+        try:
+            return await run_generation(
+                trace, ticket, abort_event, text, voice, file, url, seed, temperature, lsd_steps, variant, profile,
+                cache_key, flight
+            )
+        finally:
+            admission.release(ticket)
+    finally:
+        if abort_events.get(trace.request_id) is abort_event:
+            del abort_events[trace.request_id]
+
+async def utterance_cache_key(text, voice, file, url, seed, temperature, lsd_steps, variant):
+    # Uploaded voices are identified by their content
+    if file:
+        voice_identity = voice_file_identity(await file.read())
+        await file.seek(0)
+    else:
+        voice_identity = url or voice or 'alba'
+    model = tts_models[variant]
+    return utterance_key(
+        text,
+        voice_identity,
+        seed=seed,
+        model=variant,
+        temperature=temperature,
+        lsd_decode_steps=lsd_steps if lsd_steps is not None else model.lsd_decode_steps,
+        noise_clamp=model.noise_clamp,
+        eos_threshold=model.eos_threshold,
+        segment_workers=SEGMENT_WORKERS
+    )
+
+async def run_generation(trace, ticket, abort_event, text, voice, file, url, seed, temperature, lsd_steps, variant,
+                         profile, cache_key=None, flight=None):
+
+    # Default to the voice cloning variant when it is loaded
+    model_variant = variant if variant is not None else default_variant
+    if model_variant not in tts_models:
+        raise HTTPException(status_code=400, detail=f"Unknown variant, loaded variants are {list(tts_models)}")
+    model = tts_models[model_variant]
+    precomputed_states = voice_states.get(model_variant, {})
     
     model_state = None
-    abort_event.clear()
     
     # Determine voice
     if file or url:
@@ -198,7 +532,8 @@ async def generate(
             if file:
                 suffix = Path(file.filename).suffix or ".wav"
                 with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-                    content = await file.read()
+                    with trace.span("upload"):
+                        content = await file.read()
                     tmp.write(content)
                     tmp_path = Path(tmp.name)
                 print(f"Received file: {file.filename}, size: {len(content)} bytes, saved to {tmp_path}")
@@ -207,7 +542,8 @@ async def generate(
                 # Download from URL
                 print(f"Downloading voice from URL: {url}")
                 try:
-                    response = requests.get(url, timeout=30)
+                    with trace.span("download"):
+                        response = requests.get(url, timeout=30)
                     response.raise_for_status()
                     
                     # Try to guess extension from url or content-type
@@ -229,7 +565,9 @@ async def generate(
                      raise HTTPException(status_code=400, detail=f"Failed to download audio from URL: {str(e)}")
 
             # Use library truncate
-            model_state = tts_model.get_state_for_audio_prompt(tmp_path, truncate=True)
+            with tracing.activate(trace), trace.span("voice_prompt"):
+                model_state = model.get_state_for_audio_prompt(tmp_path, truncate=True)
+            metrics.record_voice_lookup(hit=False)
             print("Successfully created model state from audio file")
             
         except HTTPException:
@@ -263,11 +601,20 @@ async def generate(
              raise HTTPException(status_code=400, detail="Unknown voice")
         # Ensure we pass the URL/path stored in PREDEFINED_VOICES
         voice_path = utils_module.PREDEFINED_VOICES[voice]
-        # Pass the voice name directly so the model knows it's a predefined voice
-        model_state = tts_model._cached_get_state_for_audio_prompt(voice, truncate=True)
+        if voice in precomputed_states:
+            model_state = precomputed_states[voice]
+            metrics.record_voice_lookup(hit=True)
+        else:
+            # Pass the voice name directly so the model knows it's a predefined voice
+            with tracing.activate(trace), trace.span("voice_prompt"):
+                model_state = metrics.cached_voice_state(model, voice, truncate=True)
+    elif 'alba' in precomputed_states:
+        model_state = precomputed_states['alba']
+        metrics.record_voice_lookup(hit=True)
     else:
         # Default voice
-        model_state = tts_model._cached_get_state_for_audio_prompt('alba', truncate=True)
+        with tracing.activate(trace), trace.span("voice_prompt"):
+            model_state = metrics.cached_voice_state(model, 'alba', truncate=True)
 
     # Buffer audio in memory to ensure correct WAV header
     # This avoids browser issues with streaming WAVs having incorrect duration in header
@@ -282,36 +629,52 @@ async def generate(
     
     def generate_to_buffer(model_state, text, buffer, seed, temperature, lsd_steps):
         try:
+            # The noise of a seeded request is drawn from its own generator, not the global RNG
+            # shared with the requests running at the same time
             if seed is not None:
-                print(f"Setting seed to: {seed}")
-                torch.manual_seed(seed)
+                print(f"Using seed: {seed}")
 
             # Generate all chunks
             chunks = []
             print(f"Generating for: {text[:20]}...")
             
-            kwargs = {
-                "model_state": model_state,
-                "text_to_generate": text
-            }
+            kwargs = {}
             if temperature is not None:
                 kwargs["temperature"] = temperature
             if lsd_steps is not None:
                 kwargs["lsd_decode_steps"] = lsd_steps
 
-            for chunk in tts_model.generate_audio_stream(**kwargs):
-                if abort_event.is_set():
-                    print("Generation aborted by user")
-                    return
-                chunks.append(chunk)
+            # Long generations can be paused at a frame boundary for short requests
+            generation = new_generation()
+            if PREEMPTION_RATIO is not None:
+                admission.set_preemptible(ticket, generation)
+
+            # Times each module of the model (also enabled by POCKET_TTS_PROFILE=1)
+            with tracing.activate(trace), get_preemption(model).track(generation), \
+                    profile_generation(model, profile) as profiler:
+                # The segment workers are paused with the generation
+                audio_chunks = generate_parallel_audio_stream(
+                    model, model_state, text, SEGMENT_WORKERS,
+                    worker_context=partial(get_preemption(model).join, generation),
+                    generator=seeded_generator(seed), **kwargs
+                )
+                stream = tracing.traced_stream(metrics.instrument_stream(audio_chunks, model.sample_rate))
+                for chunk in stream:
+                    if abort_event.is_set():
+                        print("Generation aborted by user")
+                        stream.close()
+                        return
+                    chunks.append(chunk)
+            if profiler is not None:
+                print(profiler.format_table())
             
             print(f"Generated {len(chunks)} chunks.")
             
             # Write to buffer with correct header
-            with wave.open(buffer, "wb") as wav_file:
+            with trace.span("wav_write"), wave.open(buffer, "wb") as wav_file:
                 wav_file.setnchannels(1)
                 wav_file.setsampwidth(2) # 16-bit
-                wav_file.setframerate(tts_model.config.mimi.sample_rate)
+                wav_file.setframerate(model.config.mimi.sample_rate)
                 
                 # Convert and write all chunks
                 for chunk in chunks:
@@ -326,21 +689,119 @@ async def generate(
             import traceback
             traceback.print_exc()
 
-    # Run in thread
-    import asyncio
-    await asyncio.to_thread(generate_to_buffer, model_state, text, output_buffer, seed, temperature, lsd_steps)
+    # Run in a generation thread (the admission control above limits how many run at once)
+    await generation_executor.run(generate_to_buffer, model_state, text, output_buffer, seed, temperature, lsd_steps)
     
     output_buffer.seek(0)
     data = output_buffer.read()
+    tracing.export(trace)
+    if cache_key is not None and data:
+        if utterance_cache is not None:
+            utterance_cache.put(cache_key, data)
+        if flight is not None:
+            flight.write(data)
     
     return StreamingResponse(
         io.BytesIO(data), 
         media_type="audio/wav",
         headers={
             "Content-Disposition": "attachment; filename=output.wav",
-            "Content-Length": str(len(data))
+            "Content-Length": str(len(data)),
+            tracing.REQUEST_ID_HEADER: trace.request_id,
+            "Server-Timing": trace.server_timing()
         }
     )
     
+def batch_item_model(item):
+    variant = item.get("variant") or default_variant
+    if variant not in tts_models:
+        raise ValueError(f"Unknown variant, loaded variants are {list(tts_models)}")
+    return variant, tts_models[variant]
+
+def synthesize_batch_item(item):
+    # Audio chunks of an item of a batch, run by the batch workers in a thread
+    variant, model = batch_item_model(item)
+    voice = item.get("voice") or 'alba'
+    precomputed_states = voice_states.get(variant, {})
+    if voice in precomputed_states:
+        model_state = precomputed_states[voice]
+        metrics.record_voice_lookup(hit=True)
+    else:
+        # Predefined voice name or URL (http://, https:// or hf://)
+        model_state = metrics.cached_voice_state(model, voice, truncate=True)
+
+    # A copy of the model sharing its weights, the other generations keep its parameters
+    model = with_parameters(model, item.get("temperature"), item.get("lsd_steps"))
+    return metrics.instrument_stream(
+        model.generate_audio_stream(model_state=model_state, text_to_generate=item["text"]),
+        model.sample_rate
+    )
+
+def estimate_batch_item_cost(item):
+    return estimate_cost(batch_item_model(item)[1], item["text"], item.get("lsd_steps"))
+
+def get_batch(batch_id):
+    if batches is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    batch = batches.get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Unknown batch")
+    return batch
+
+@app.post("/api/batches", status_code=202)
+async def create_batch(request: Request):
+    # Body: {"items": [{"text": ..., "voice": ..., "variant": ..., "temperature": ..., "lsd_steps": ...}]}
+    # Only "text" is required. Poll /api/batches/{batch_id}, then download the zip from
+    # /api/batches/{batch_id}/archive or each item from /api/batches/{batch_id}/items/{index}
+    if batches is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    body = await request.json()
+    items = body.get("items") if isinstance(body, dict) else None
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise HTTPException(status_code=400, detail="Expected {\"items\": [{\"text\": ...}, ...]}")
+    for item in items:
+        voice = item.get("voice")
+        if voice is not None and voice not in utils_module.PREDEFINED_VOICES and not voice.startswith(("http://", "https://", "hf://")):
+            raise HTTPException(status_code=400, detail=f"Unknown voice {voice}")
+    try:
+        batch = await asyncio.to_thread(batches.submit, items)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return batch.as_dict()
+
+@app.get("/api/batches")
+async def list_batches():
+    return [batch.as_dict() for batch in batches.batches()] if batches is not None else []
+
+@app.get("/api/batches/{batch_id}")
+async def batch_status(batch_id: str):
+    return get_batch(batch_id).as_dict()
+
+@app.get("/api/batches/{batch_id}/manifest")
+async def batch_manifest(batch_id: str):
+    return get_batch(batch_id).manifest()
+
+@app.get("/api/batches/{batch_id}/items/{index}")
+async def batch_item_audio(batch_id: str, index: int):
+    batch = get_batch(batch_id)
+    if not 0 <= index < len(batch.items):
+        raise HTTPException(status_code=404, detail="Unknown item")
+    item = batch.items[index]
+    if item["file"] is None:
+        raise HTTPException(status_code=409, detail=f"The item is {item['status']}")
+    return FileResponse(batch.batch_dir / item["file"], media_type="audio/wav")
+
+@app.get("/api/batches/{batch_id}/archive")
+async def batch_archive(batch_id: str):
+    # Zip of the manifest and of the items completed so far
+    batch = get_batch(batch_id)
+    archive_path = await asyncio.to_thread(batches.write_archive, batch)
+    return FileResponse(archive_path, media_type="application/zip", filename=f"{batch_id}.zip")
+
+@app.delete("/api/batches/{batch_id}")
+async def cancel_batch(batch_id: str):
+    get_batch(batch_id)
+    return batches.cancel(batch_id).as_dict()
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -3,7 +3,16 @@ from beartype.claw import beartype_this_package
 
 beartype_this_package(conf=BeartypeConf(is_color=False))
 
-from pocket_tts.models.tts_model import TTSModel  # noqa: E402
+
+def __getattr__(name: str):
+    # TTSModel is imported lazily so that the parts of the package which do not need
+    # PyTorch (like the ONNX runtime backend) can be used without it.
+    if name == "TTSModel":
+        from pocket_tts.models.tts_model import TTSModel
+
+        return TTSModel
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 # Public methods:
 # TTSModel.device
@@ -0,0 +1,357 @@
+"""Admission control and scheduling of the generations of a server.
+
+A generation takes a lot of CPU, so running too many at once slows all of them down and
+grows the memory with their model states. `AdmissionController` runs at most
+`max_concurrency` generations at a time and makes the other requests wait in a bounded
+queue. When the queue is full, requests are rejected right away (HTTP 429) with an estimate
+of when to retry, and requests which waited longer than their deadline are dropped.
+
+When a slot frees up, the next request is chosen by the scheduling policy:
+
+- "fifo": in the order of arrival.
+- "sjf": shortest job first, by the cost estimated with `estimate_cost` from the number of
+  text tokens and the LSD decode steps. Short interactive prompts no longer wait behind
+  long paragraphs.
+- "fair": weighted fair queuing between clients, so that a client sending many requests
+  does not delay the others. A client with twice the weight gets twice the generation time.
+
+With any policy, a request which waited more than `starvation_seconds` goes first, in the
+order of arrival, so that long jobs are not postponed forever.
+
+A running generation registered with `set_preemptible` can also be preempted: when no slot
+is free and the next request costs `preemption_ratio` times less, the long generation is
+paused at a frame boundary (see `pocket_tts.preemption`) and goes back to the queue, where
+it is scheduled like the other requests, without a deadline. It resumes where it stopped.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Each generation runs the FlowLM and the Mimi decoder in two threads.
+DEFAULT_MAX_CONCURRENCY = max(1, (os.cpu_count() or 2) // 2)
+DEFAULT_MAX_QUEUE_LENGTH = 16
+# Maximum time a request waits in the queue, in seconds.
+DEFAULT_QUEUE_TIMEOUT = 60.0
+# Duration of a generation assumed before any was measured, in seconds.
+DEFAULT_GENERATION_SECONDS = 5.0
+# Header identifying the client of a request for the "fair" policy, else its IP is used.
+CLIENT_ID_HEADER = "X-Client-ID"
+SCHEDULING_POLICIES = ["fifo", "sjf", "fair"]
+DEFAULT_SCHEDULING_POLICY = "sjf"
+# Requests waiting longer than this are served first, whatever the policy, in seconds.
+DEFAULT_STARVATION_SECONDS = 20.0
+# Cost of one flow net call (one LSD step) relative to the rest of a frame, see the
+# `test_flow_net` and FlowLM/Mimi microbenchmarks.
+LSD_STEP_COST = 0.25
+# A running generation is preempted for a request this many times cheaper, None never does.
+DEFAULT_PREEMPTION_RATIO = 10.0
+
+
+def estimate_cost(tts_model, text: str, lsd_decode_steps: int | None = None) -> float:
+    """Relative cost of generating `text`: its number of tokens, weighted by the LSD steps.
+
+    The number of generated frames is roughly proportional to the number of tokens.
+    """
+    if lsd_decode_steps is None:
+        lsd_decode_steps = tts_model.lsd_decode_steps
+    num_tokens = tts_model.flow_lm.conditioner.prepare(text).tokens.shape[-1]
+    return num_tokens * (1 + LSD_STEP_COST * lsd_decode_steps)
+
+
+def parse_client_weights(spec: str) -> dict[str, float]:
+    """Parses weights of the "fair" policy written as `client=weight,other=weight`."""
+    weights = {}
+    for item in spec.split(","):
+        if item.strip():
+            client_id, weight = item.split("=")
+            weights[client_id.strip()] = float(weight)
+    return weights
+
+
+class QueueFullError(Exception):
+    """The queue is full, `retry_after` is the estimated wait in seconds."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"The generation queue is full, retry in {retry_after:.0f} seconds.")
+        self.retry_after = retry_after
+
+
+class QueueTimeoutError(Exception):
+    """The request reached its deadline before a generation slot was free."""
+
+
+class Ticket:
+    """A request admitted by, or waiting in, an `AdmissionController`."""
+
+    def __init__(self, request_id: str, deadline: float | None, cost: float, client_id: str):
+        self.request_id = request_id
+        self.deadline = deadline
+        self.cost = cost
+        self.client_id = client_id
+        # Virtual start and finish times of the "fair" policy.
+        self.start_tag = 0.0
+        self.finish_tag = 0.0
+        self.enqueue_time = time.monotonic()
+        self.start_time: float | None = None
+        # Seconds spent generating before the last preemption.
+        self.run_seconds = 0.0
+        self.num_preemptions = 0
+        self.preempted = False
+        # Has `pause()` and `resume()`, set by `AdmissionController.set_preemptible`.
+        self._generation = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._admitted: asyncio.Future | None = None
+
+    @property
+    def queued_seconds(self) -> float:
+        return (self.start_time or time.monotonic()) - self.enqueue_time
+
+
+class AdmissionController:
+    """Runs at most `max_concurrency` generations, with at most `max_queue_length` waiting.
+
+    `acquire` is awaited on the event loop of the server. `release` can be called from any
+    thread, typically the one which ran the generation.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        max_queue_length: int = DEFAULT_MAX_QUEUE_LENGTH,
+        queue_timeout: float | None = DEFAULT_QUEUE_TIMEOUT,
+        policy: str = DEFAULT_SCHEDULING_POLICY,
+        starvation_seconds: float = DEFAULT_STARVATION_SECONDS,
+        client_weights: dict[str, float] | None = None,
+        preemption_ratio: float | None = DEFAULT_PREEMPTION_RATIO,
+    ):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1.")
+        if policy not in SCHEDULING_POLICIES:
+            raise ValueError(f"Unknown policy {policy!r}, use one of {SCHEDULING_POLICIES}.")
+        if preemption_ratio is not None and preemption_ratio <= 1:
+            # Two generations could otherwise preempt each other forever.
+            raise ValueError("preemption_ratio must be greater than 1.")
+        self.max_concurrency = max_concurrency
+        self.max_queue_length = max_queue_length
+        self.queue_timeout = queue_timeout
+        self.policy = policy
+        self.starvation_seconds = starvation_seconds
+        self.client_weights = client_weights or {}
+        self.preemption_ratio = preemption_ratio
+        # Exponential moving averages of the duration of the generations, in seconds, and of
+        # their duration per unit of cost.
+        self.average_generation_seconds: float | None = None
+        self.seconds_per_cost: float | None = None
+        self._queue: list[Ticket] = []
+        self._active: list[Ticket] = []
+        self._virtual_time = 0.0
+        self._last_finish_tags: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    async def acquire(
+        self,
+        request_id: str | None = None,
+        timeout: float | None = None,
+        cost: float = 1.0,
+        client_id: str = "default",
+    ) -> Ticket:
+        """Waits for a generation slot, given by the scheduling policy.
+
+        Raises `QueueFullError` if the queue is full, and `QueueTimeoutError` if no slot was
+        free before `timeout` (capped by `queue_timeout`). Call `release` once done.
+        """
+        if self.queue_timeout is not None:
+            timeout = self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+        ticket = Ticket(
+            request_id or uuid.uuid4().hex,
+            None if timeout is None else time.monotonic() + timeout,
+            cost,
+            client_id,
+        )
+        with self._lock:
+            if not self._queue and len(self._active) < self.max_concurrency:
+                self._tag(ticket)
+                self._start(ticket)
+                return ticket
+            if len(self._queue) >= self.max_queue_length:
+                raise QueueFullError(self._estimated_wait(self._queue))
+            self._tag(ticket)
+            ticket._loop = asyncio.get_running_loop()
+            ticket._admitted = ticket._loop.create_future()
+            self._queue.append(ticket)
+            self._preempt()
+            if ticket in self._active:
+                return ticket
+
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket._admitted), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                was_admitted = ticket in self._active
+                if ticket in self._queue:
+                    self._queue.remove(ticket)
+            if was_admitted:
+                # Admitted at the same time, give the slot back if the client is gone.
+                if isinstance(e, asyncio.CancelledError):
+                    self.release(ticket)
+                    raise
+                return ticket
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            raise QueueTimeoutError(
+                f"No generation slot was free after {ticket.queued_seconds:.0f} seconds."
+            ) from None
+        return ticket
+
+    def set_preemptible(self, ticket: Ticket, generation):
+        """Lets the generation of `ticket` be paused and resumed by its `pause` and `resume`."""
+        with self._lock:
+            ticket._generation = generation
+            self._preempt()
+
+    def release(self, ticket: Ticket):
+        """Frees the slot of `ticket` and admits the next requests."""
+        with self._lock:
+            if ticket in self._queue:
+                # Ended while preempted, e.g. the client went away.
+                self._queue.remove(ticket)
+                return
+            if ticket not in self._active:
+                return
+            self._active.remove(ticket)
+            duration = ticket.run_seconds + time.monotonic() - ticket.start_time
+            self.average_generation_seconds = _moving_average(
+                self.average_generation_seconds, duration
+            )
+            if ticket.cost > 0:
+                self.seconds_per_cost = _moving_average(
+                    self.seconds_per_cost, duration / ticket.cost
+                )
+            self._admit_next()
+
+    def _tag(self, ticket: Ticket):
+        # Weighted fair queuing: a client's requests follow each other in virtual time,
+        # each one taking its cost divided by the weight of the client.
+        ticket.start_tag = max(
+            self._virtual_time, self._last_finish_tags.get(ticket.client_id, 0.0)
+        )
+        weight = self.client_weights.get(ticket.client_id, 1.0)
+        ticket.finish_tag = ticket.start_tag + ticket.cost / weight
+        self._last_finish_tags[ticket.client_id] = ticket.finish_tag
+
+    def _start(self, ticket: Ticket):
+        ticket.start_time = time.monotonic()
+        self._virtual_time = max(self._virtual_time, ticket.start_tag)
+        self._active.append(ticket)
+
+    def _schedule(self) -> list[Ticket]:
+        """The waiting requests, in the order they will be admitted."""
+        now = time.monotonic()
+        starving = [t for t in self._queue if now - t.enqueue_time >= self.starvation_seconds]
+        others = [t for t in self._queue if now - t.enqueue_time < self.starvation_seconds]
+        # The sorts are stable, so equal keys stay in their order of arrival.
+        if self.policy == "sjf":
+            others.sort(key=lambda ticket: ticket.cost)
+        elif self.policy == "fair":
+            others.sort(key=lambda ticket: ticket.finish_tag)
+        return starving + others
+
+    def _admit_next(self):
+        now = time.monotonic()
+        while self._queue and len(self._active) < self.max_concurrency:
+            ticket = self._schedule()[0]
+            self._queue.remove(ticket)
+            if ticket.deadline is not None and ticket.deadline <= now:
+                # Its waiter is about to raise QueueTimeoutError.
+                logger.info("Dropping request %s, past its deadline", ticket.request_id)
+                continue
+            self._start(ticket)
+            if ticket.preempted:
+                ticket.preempted = False
+                ticket._generation.resume()
+            else:
+                ticket._loop.call_soon_threadsafe(_set_admitted, ticket._admitted)
+
+    def _preempt(self):
+        """Pauses long generations for the next requests, if they are much cheaper."""
+        if self.preemption_ratio is None:
+            return
+        while self._queue and len(self._active) >= self.max_concurrency:
+            ticket = self._schedule()[0]
+            victims = [
+                t
+                for t in self._active
+                if t._generation is not None and t.cost >= ticket.cost * self.preemption_ratio
+            ]
+            if not victims:
+                return
+            victim = max(victims, key=lambda t: t.cost)
+            logger.info("Preempting request %s for %s", victim.request_id, ticket.request_id)
+            victim._generation.pause()
+            self._active.remove(victim)
+            now = time.monotonic()
+            victim.run_seconds += now - victim.start_time
+            victim.num_preemptions += 1
+            victim.preempted = True
+            victim.deadline = None
+            victim.enqueue_time = now
+            victim.start_time = None
+            self._queue.append(victim)
+            self._admit_next()
+
+    def _estimated_wait(self, ahead: list[Ticket]) -> float:
+        """Seconds until a request waiting behind `ahead` is admitted."""
+        if len(self._active) < self.max_concurrency and not ahead:
+            return 0.0
+        if self.seconds_per_cost is None:
+            # One default generation per request, the running ones being half done.
+            work = (len(ahead) + 0.5 * len(self._active)) * DEFAULT_GENERATION_SECONDS
+        else:
+            costs = sum(t.cost for t in ahead) + 0.5 * sum(t.cost for t in self._active)
+            work = costs * self.seconds_per_cost
+        return work / self.max_concurrency
+
+    def request_status(self, request_id: str) -> dict | None:
+        """Where a request is: "running", or "queued" or "preempted" with its position and
+        estimated wait."""
+        with self._lock:
+            if any(ticket.request_id == request_id for ticket in self._active):
+                return {"request_id": request_id, "state": "running", "position": 0}
+            schedule = self._schedule()
+            for i, ticket in enumerate(schedule):
+                if ticket.request_id == request_id:
+                    return {
+                        "request_id": request_id,
+                        "state": "preempted" if ticket.preempted else "queued",
+                        "position": i + 1,
+                        "estimated_wait_seconds": self._estimated_wait(schedule[:i]),
+                    }
+        return None
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "running": len(self._active),
+                "queued": len(self._queue),
+                "preempted": sum(ticket.preempted for ticket in self._queue),
+                "policy": self.policy,
+                "max_concurrency": self.max_concurrency,
+                "max_queue_length": self.max_queue_length,
+                "average_generation_seconds": self.average_generation_seconds,
+                "estimated_wait_seconds": self._estimated_wait(self._queue),
+            }
+
+
+def _moving_average(average: float | None, value: float, weight: float = 0.2) -> float:
+    return value if average is None else average + weight * (value - average)
+
+
+def _set_admitted(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
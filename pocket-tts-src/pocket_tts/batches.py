@@ -0,0 +1,285 @@
+"""Batches of generations, processed in the background with their results on disk.
+
+Bulk content (thousands of short texts) does not need one HTTP request per utterance: a
+batch is a list of items, each a text with its voice and generation parameters, which is
+submitted at once and returns a batch ID. `BatchManager.serve` runs one worker per
+generation slot, so that the batches use all the slots left free by the other requests.
+Each item is scheduled by the admission controller like a request, the items of a batch
+being a client of their own for the "fair" policy.
+
+Each batch is a directory of `results_dir`:
+
+- `manifest.json`: the items, with their status ("queued", "running", "completed" or
+  "failed"), the name of their audio file, their duration and their error.
+- `00000.wav`, `00001.wav`, ...: the audio of the completed items.
+
+`write_archive` zips them. The items which did not finish when the server stopped are
+generated again at the next start.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import wave
+import zipfile
+from collections import deque
+from collections.abc import Callable, Iterable
+from pathlib import Path
+
+import torch
+
+from pocket_tts.admission import AdmissionController, QueueFullError, QueueTimeoutError
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two looks for a queued item.
+BATCH_POLL_SECONDS = 0.5
+# Seconds between two writes of a manifest, the items completed since are lost on a crash.
+MANIFEST_SAVE_SECONDS = 1.0
+MAX_BATCH_ITEMS = 100_000
+
+
+class Batch:
+    """The items of a batch and their results, stored in `batch_dir`."""
+
+    def __init__(self, batch_dir: Path, items: list[dict], created_at: float | None = None):
+        self.batch_dir = batch_dir
+        self.items = items
+        self.created_at = created_at or time.time()
+        self.cancelled = False
+        self.saved_at = 0.0
+        # Indices of the queued items, in order.
+        self._pending = deque(item["index"] for item in items if item["status"] == "queued")
+
+    @property
+    def batch_id(self) -> str:
+        return self.batch_dir.name
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.batch_dir / "manifest.json"
+
+    def as_dict(self) -> dict:
+        counts = {status: 0 for status in ["queued", "running", "completed", "failed"]}
+        for item in self.items:
+            counts[item["status"]] += 1
+        finished = counts["completed"] + counts["failed"]
+        return {
+            "batch_id": self.batch_id,
+            "status": "completed" if finished == len(self.items) else "running",
+            "num_items": len(self.items),
+            **counts,
+            "progress": finished / len(self.items),
+            "audio_seconds": sum(item["audio_seconds"] or 0.0 for item in self.items),
+            "created_at": self.created_at,
+        }
+
+    def manifest(self) -> dict:
+        return {"batch_id": self.batch_id, "created_at": self.created_at, "items": self.items}
+
+    def save(self):
+        manifest = json.dumps(self.manifest())
+        temp_path = self.manifest_path.with_name("manifest.json.tmp")
+        temp_path.write_text(manifest)
+        os.replace(temp_path, self.manifest_path)
+        self.saved_at = time.monotonic()
+
+
+class BatchManager:
+    """The batches stored in `results_dir`.
+
+    Args:
+        results_dir: Directory of the batches.
+        synthesize: Generates the audio chunks of an item, from a worker thread.
+        estimate_cost: Cost of an item for the scheduling policy.
+        sample_rate: Sample rate of the audio of `synthesize`.
+    """
+
+    def __init__(
+        self,
+        results_dir: str | Path,
+        synthesize: Callable[[dict], Iterable[torch.Tensor]],
+        estimate_cost: Callable[[dict], float],
+        sample_rate: int,
+    ):
+        self.results_dir = Path(results_dir)
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        self.synthesize = synthesize
+        self.estimate_cost = estimate_cost
+        self.sample_rate = sample_rate
+        self._batches: dict[str, Batch] = {}
+        # Protects the statuses of the items, claimed by the workers.
+        self._lock = threading.Lock()
+        for batch_dir in self.results_dir.iterdir():
+            if not (batch_dir / "manifest.json").exists():
+                continue
+            manifest = json.loads((batch_dir / "manifest.json").read_text())
+            for item in manifest["items"]:
+                if item["status"] == "running":
+                    item["status"] = "queued"
+            batch = Batch(batch_dir, manifest["items"], manifest["created_at"])
+            self._batches[batch.batch_id] = batch
+
+    def submit(self, items: list[dict]) -> Batch:
+        """Queues a batch of items, each a dict with a "text" and its parameters.
+
+        The "index", "status", "file", "audio_seconds" and "error" of the items are filled
+        in by the batch.
+        """
+        if not items:
+            raise ValueError("A batch needs at least one item.")
+        if len(items) > MAX_BATCH_ITEMS:
+            raise ValueError(f"A batch has at most {MAX_BATCH_ITEMS} items.")
+        for item in items:
+            if not isinstance(item.get("text"), str) or not item["text"].strip():
+                raise ValueError("Each item needs a non-empty text.")
+        batch = Batch(
+            self.results_dir / uuid.uuid4().hex,
+            [
+                {
+                    **item,
+                    "index": i,
+                    "status": "queued",
+                    "file": None,
+                    "audio_seconds": None,
+                    "error": None,
+                }
+                for i, item in enumerate(items)
+            ],
+        )
+        batch.batch_dir.mkdir()
+        batch.save()
+        with self._lock:
+            self._batches[batch.batch_id] = batch
+        return batch
+
+    def get(self, batch_id: str) -> Batch | None:
+        return self._batches.get(batch_id)
+
+    def batches(self) -> list[Batch]:
+        with self._lock:
+            return sorted(self._batches.values(), key=lambda batch: batch.created_at)
+
+    def cancel(self, batch_id: str) -> Batch | None:
+        """Stops a batch after its running items, and deletes its results."""
+        with self._lock:
+            batch = self._batches.pop(batch_id, None)
+        if batch is not None:
+            batch.cancelled = True
+            shutil.rmtree(batch.batch_dir, ignore_errors=True)
+        return batch
+
+    def write_archive(self, batch: Batch) -> Path:
+        """Zips the manifest and the audio files of `batch`, returns the path of the zip."""
+        archive_path = batch.batch_dir / "results.zip"
+        with self._lock:
+            manifest = json.dumps(batch.manifest(), indent=2)
+        with zipfile.ZipFile(archive_path, "w") as archive:
+            archive.writestr("manifest.json", manifest)
+            for item in batch.items:
+                if item["file"] is not None:
+                    archive.write(batch.batch_dir / item["file"], item["file"])
+        return archive_path
+
+    def _claim_next(self) -> tuple[Batch, dict] | None:
+        """The next queued item, from the oldest batch, marked as running."""
+        for batch in self.batches():
+            with self._lock:
+                if batch._pending:
+                    item = batch.items[batch._pending.popleft()]
+                    item["status"] = "running"
+                    return batch, item
+        return None
+
+    def _requeue(self, batch: Batch, item: dict):
+        with self._lock:
+            item["status"] = "queued"
+            batch._pending.appendleft(item["index"])
+
+    def _finish(self, batch: Batch, item: dict, **results):
+        with self._lock:
+            item.update(results)
+            finished = not batch._pending and all(
+                other["status"] in ("completed", "failed") for other in batch.items
+            )
+            if batch.cancelled:
+                return
+            if finished or time.monotonic() - batch.saved_at >= MANIFEST_SAVE_SECONDS:
+                batch.save()
+
+    def generate(self, batch: Batch, item: dict):
+        """Generates `item` to its audio file, and records the result in the manifest."""
+        file_name = f"{item['index']:05d}.wav"
+        num_samples = 0
+        try:
+            with wave.open(str(batch.batch_dir / file_name), "wb") as wav_file:
+                wav_file.setnchannels(1)
+                wav_file.setsampwidth(2)
+                wav_file.setframerate(self.sample_rate)
+                for chunk in self.synthesize(item):
+                    if batch.cancelled:
+                        return
+                    chunk_int16 = (chunk.clamp(-1, 1) * 32767).short()
+                    wav_file.writeframes(chunk_int16.detach().cpu().numpy().tobytes())
+                    num_samples += chunk.shape[-1]
+        except Exception as e:
+            if batch.cancelled:
+                return
+            logger.exception("Item %d of batch %s failed", item["index"], batch.batch_id)
+            (batch.batch_dir / file_name).unlink(missing_ok=True)
+            self._finish(batch, item, status="failed", error=str(e))
+            return
+        self._finish(
+            batch,
+            item,
+            status="completed",
+            file=file_name,
+            audio_seconds=num_samples / self.sample_rate,
+        )
+
+    async def serve(self, admission: AdmissionController, executor=None):
+        """Generates the queued items, with one worker per generation slot of `admission`.
+
+        The items are generated in the threads of `executor` if given, a
+        `pocket_tts.executor.GenerationExecutor`.
+        """
+        run = executor.run if executor is not None else asyncio.to_thread
+        await asyncio.gather(
+            *[self._work(admission, run) for _ in range(admission.max_concurrency)]
+        )
+
+    async def _work(self, admission: AdmissionController, run):
+        while True:
+            claimed = self._claim_next()
+            if claimed is None:
+                await asyncio.sleep(BATCH_POLL_SECONDS)
+                continue
+            batch, item = claimed
+            try:
+                cost = self.estimate_cost(item)
+            except Exception as e:
+                logger.exception("Could not estimate the cost of item %d", item["index"])
+                self._finish(batch, item, status="failed", error=str(e))
+                continue
+            try:
+                ticket = await admission.acquire(
+                    f"{batch.batch_id}-{item['index']}",
+                    cost=cost,
+                    client_id=f"batch-{batch.batch_id}",
+                )
+            except QueueFullError as e:
+                self._requeue(batch, item)
+                await asyncio.sleep(e.retry_after)
+                continue
+            except QueueTimeoutError:
+                self._requeue(batch, item)
+                continue
+            try:
+                await run(self.generate, batch, item)
+            finally:
+                admission.release(ticket)
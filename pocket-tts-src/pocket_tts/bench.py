@@ -0,0 +1,200 @@
+"""Benchmark of the generation speed, see `pocket-tts bench`.
+
+A fixed corpus of texts and voices is run through `generate_audio_stream` for each
+combination of LSD decode steps, torch thread count and batch size. The model is batch size
+1, so a batch is made of concurrent generations, like the requests of a server.
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from pocket_tts.utils.utils import size_of_dict
+from pocket_tts.warmup import WARMUP_TEXT, measure_generation
+
+logger = logging.getLogger(__name__)
+
+BENCH_TEXTS = [
+    "Hello world.",
+    "The quick brown fox jumps over the lazy dog, while the cat watches from the window.",
+    (
+        "Pocket TTS runs on small CPUs. It generates speech faster than real time, one frame "
+        "at a time, and streams the audio as soon as the first frame is decoded. This longer "
+        "text measures the steady state of the generation."
+    ),
+]
+BENCH_VOICES = ["alba", "marius"]
+
+
+def rss_mb() -> float | None:
+    """Resident set size of the process, None where it is not available (not Linux)."""
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+
+class PeakRss:
+    """Samples the resident set size in a thread while in the `with` block.
+
+    `increase_mb` is the peak over the resident set size at the start of the block, None
+    where it is not available. Unlike the peak of the whole process (`ru_maxrss`), it goes
+    down when a configuration needs less memory than the previous ones.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.increase_mb = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._peak = max(self._peak, rss_mb())
+
+    def __enter__(self):
+        self._start = self._peak = rss_mb()
+        if self._start is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._start is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self.increase_mb = max(self._peak, rss_mb()) - self._start
+
+
+def _timed_generation(tts_model, model_state: dict, text: str) -> dict:
+    start = time.monotonic()
+    chunk_times = []
+    num_samples = 0
+    for chunk in tts_model.generate_audio_stream(model_state=model_state, text_to_generate=text):
+        chunk_times.append(time.monotonic())
+        num_samples += chunk.shape[-1]
+    return {
+        "time_to_first_chunk": chunk_times[0] - start,
+        "frame_latencies": np.diff(chunk_times).tolist(),
+        "total_time": time.monotonic() - start,
+        "audio_duration": num_samples / tts_model.sample_rate,
+    }
+
+
+def _run_batch(tts_model, model_state: dict, text: str, batch_size: int) -> list[dict]:
+    results = [None] * batch_size
+
+    def run(index: int):
+        results[index] = _timed_generation(tts_model, model_state, text)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(batch_size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if any(result is None for result in results):
+        raise RuntimeError("A generation of the batch failed, see the logs.")
+    return results
+
+
+def _summarize(generations: list[dict], wall_time: float) -> dict:
+    frame_latencies = np.array([x for g in generations for x in g["frame_latencies"]])
+    time_to_first_chunk = np.array([g["time_to_first_chunk"] for g in generations])
+    audio_duration = sum(g["audio_duration"] for g in generations)
+    summary = {
+        # Wall time over generated audio, all the generations of a batch count.
+        "real_time_factor": wall_time / audio_duration,
+        "time_to_first_chunk_ms": {
+            "mean": time_to_first_chunk.mean() * 1000,
+            "p50": np.percentile(time_to_first_chunk, 50) * 1000,
+            "p90": np.percentile(time_to_first_chunk, 90) * 1000,
+        },
+        "audio_seconds": audio_duration,
+        "wall_seconds": wall_time,
+    }
+    if len(frame_latencies) > 0:
+        summary["frame_latency_ms"] = {
+            f"p{q}": np.percentile(frame_latencies, q) * 1000 for q in (50, 90, 99)
+        }
+    return summary
+
+
+def run_benchmark(
+    tts_model,
+    lsd_decode_steps: list[int],
+    num_threads: list[int],
+    batch_sizes: list[int],
+    texts: list[str] = BENCH_TEXTS,
+    voices: list[str] = BENCH_VOICES,
+) -> dict:
+    """Runs `texts` with each voice, for each combination of the other arguments.
+
+    Returns:
+        A JSON-serializable dict with the environment and one result per combination.
+    """
+    voice_states = {voice: tts_model.get_state_for_audio_prompt(voice) for voice in voices}
+    initial_lsd_decode_steps = tts_model.lsd_decode_steps
+    initial_num_threads = torch.get_num_threads()
+    results = []
+    try:
+        for steps in lsd_decode_steps:
+            for threads in num_threads:
+                tts_model.lsd_decode_steps = steps
+                torch.set_num_threads(threads)
+                # The first generation of a configuration pays one-time costs.
+                measure_generation(tts_model, next(iter(voice_states.values())), WARMUP_TEXT)
+                for batch_size in batch_sizes:
+                    generations = []
+                    start = time.monotonic()
+                    with PeakRss() as peak_rss:
+                        for model_state in voice_states.values():
+                            for text in texts:
+                                generations += _run_batch(tts_model, model_state, text, batch_size)
+                    result = {
+                        "lsd_decode_steps": steps,
+                        "num_threads": threads,
+                        "batch_size": batch_size,
+                        **_summarize(generations, time.monotonic() - start),
+                        "peak_rss_increase_mb": peak_rss.increase_mb,
+                    }
+                    logger.info(
+                        "lsd_decode_steps=%d num_threads=%d batch_size=%d: RTF %.3f, "
+                        "time to first chunk %.0f ms",
+                        steps,
+                        threads,
+                        batch_size,
+                        result["real_time_factor"],
+                        result["time_to_first_chunk_ms"]["p50"],
+                    )
+                    results.append(result)
+    finally:
+        tts_model.lsd_decode_steps = initial_lsd_decode_steps
+        torch.set_num_threads(initial_num_threads)
+
+    return {
+        "environment": {
+            "torch_version": torch.__version__,
+            "device": tts_model.device,
+            "platform": sys.platform,
+            "has_voice_cloning": tts_model.has_voice_cloning,
+        },
+        "texts": texts,
+        "voices": voices,
+        "model_state_mb": {
+            voice: size_of_dict(model_state) / 1e6 for voice, model_state in voice_states.items()
+        },
+        "results": results,
+    }
+
+
+def write_results(results: dict, output_path: str | Path):
+    Path(output_path).write_text(json.dumps(results, indent=2))
@@ -0,0 +1,149 @@
+"""Single-file model bundles.
+
+A bundle holds everything needed to run a model offline: the config, the weights, the
+tokenizer and the predefined voices. It is a regular safetensors file, so its header is
+the index of its content and every tensor can be memory-mapped instead of being read:
+
+- `model/<name>`: the tensors of the `TTSModel` state dict,
+- `voices/<name>`: the audio prompt of each predefined voice,
+- `tokenizer`: the bytes of the sentencepiece model, as a uint8 tensor,
+- the metadata holds the config and whether the weights support voice cloning.
+"""
+
+import hashlib
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+
+import safetensors.torch
+import torch
+
+from pocket_tts.utils.config import Config
+from pocket_tts.utils.utils import (
+    BUNDLED_VOICES,
+    PREDEFINED_VOICES,
+    download_if_necessary,
+    make_cache_directory,
+)
+from pocket_tts.utils.weights_loading import (
+    assign_state_dict,
+    load_safetensors_metadata,
+    load_safetensors_mmap,
+    skip_weight_init,
+)
+from pocket_tts.variants import resolve_weights
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_FORMAT = "pocket-tts-bundle"
+BUNDLE_VERSION = "1"
+
+
+@dataclass
+class Bundle:
+    config: Config
+    has_voice_cloning: bool
+    state_dict: dict[str, torch.Tensor]
+    tokenizer_path: Path
+    voices: dict[str, torch.Tensor]
+
+
+def pack_bundle(config: Config, output_path: str | Path, voices: dict[str, str] | None = None):
+    """Writes the model described by `config` in a single bundle file.
+
+    Args:
+        config: The model config. Its weights and tokenizer paths can be local files,
+            urls or `hf://` paths.
+        output_path: Where to write the bundle.
+        voices: The voices to include, mapping their name to their safetensors file.
+            Defaults to the predefined voices.
+    """
+    if voices is None:
+        voices = PREDEFINED_VOICES
+    weights_file, has_voice_cloning = resolve_weights(config)
+    tokenizer_file = download_if_necessary(config.flow_lm.lookup_table.tokenizer_path)
+
+    tensors = {f"model/{key}": value for key, value in load_safetensors_mmap(weights_file).items()}
+    tensors["tokenizer"] = torch.frombuffer(
+        bytearray(tokenizer_file.read_bytes()), dtype=torch.uint8
+    )
+    for voice_name, voice_path in voices.items():
+        voice_file = download_if_necessary(voice_path)
+        tensors[f"voices/{voice_name}"] = safetensors.torch.load_file(voice_file)["audio_prompt"]
+
+    # The files are now part of the bundle.
+    bundle_config = config.model_copy(deep=True)
+    bundle_config.weights_path = None
+    bundle_config.weights_path_without_voice_cloning = None
+    bundle_config.flow_lm.lookup_table.tokenizer_path = ""
+    metadata = {
+        "format": BUNDLE_FORMAT,
+        "version": BUNDLE_VERSION,
+        "config": bundle_config.model_dump_json(),
+        "has_voice_cloning": str(has_voice_cloning),
+    }
+    # safetensors sorts the tensors by alignment, so every tensor is aligned in the file.
+    safetensors.torch.save_file(tensors, output_path, metadata=metadata)
+    logger.info("Bundle with %d voices written in %s", len(voices), output_path)
+
+
+def materialize_tokenizer(tokenizer: torch.Tensor) -> Path:
+    # sentencepiece can only load the tokenizer from a file.
+    tokenizer_bytes = tokenizer.numpy().tobytes()
+    digest = hashlib.sha256(tokenizer_bytes).hexdigest()
+    tokenizer_path = make_cache_directory() / f"tokenizer_{digest}.model"
+    if not tokenizer_path.exists():
+        tokenizer_path.write_bytes(tokenizer_bytes)
+    return tokenizer_path
+
+
+def load_bundle(path: str | Path) -> Bundle:
+    """Opens a bundle written by `pack_bundle`. The tensors are memory-mapped."""
+    metadata = load_safetensors_metadata(path)
+    if metadata.get("format") != BUNDLE_FORMAT:
+        raise ValueError(f"{path} is not a pocket-tts bundle.")
+    if metadata["version"] != BUNDLE_VERSION:
+        raise ValueError(
+            f"Unsupported bundle version {metadata['version']}, expected {BUNDLE_VERSION}."
+        )
+
+    state_dict, voices = {}, {}
+    tokenizer_path = None
+    for key, value in load_safetensors_mmap(path).items():
+        if key.startswith("model/"):
+            state_dict[key.removeprefix("model/")] = value
+        elif key.startswith("voices/"):
+            voices[key.removeprefix("voices/")] = value
+        elif key == "tokenizer":
+            tokenizer_path = materialize_tokenizer(value)
+
+    config = Config.model_validate_json(metadata["config"])
+    config.flow_lm.lookup_table.tokenizer_path = str(tokenizer_path)
+    return Bundle(
+        config=config,
+        has_voice_cloning=metadata["has_voice_cloning"] == "True",
+        state_dict=state_dict,
+        tokenizer_path=tokenizer_path,
+        voices=voices,
+    )
+
+
+def load_model_from_bundle(
+    path: str | Path, temp, lsd_decode_steps, noise_clamp: float | None, eos_threshold
+):
+    """Loads a `TTSModel` from a bundle and registers its voices as predefined voices."""
+    # Imported here, packing a bundle does not need the model code.
+    from pocket_tts.models.tts_model import TTSModel
+
+    bundle = load_bundle(path)
+    with skip_weight_init():
+        tts_model = TTSModel._from_pydantic_config_with_weights(
+            bundle.config, temp, lsd_decode_steps, noise_clamp, eos_threshold
+        )
+    assign_state_dict(tts_model, bundle.state_dict)
+    tts_model.has_voice_cloning = bundle.has_voice_cloning
+
+    for voice_name, audio_prompt in bundle.voices.items():
+        PREDEFINED_VOICES[voice_name] = str(path)
+        BUNDLED_VOICES[voice_name] = audio_prompt
+    return tts_model
@@ -3,9 +3,12 @@ Audio IO methods are defined in this module (info, read, write),
 We rely on av library for faster read when possible, otherwise on torchaudio.
 """
 
+import io
 import logging
+import math
 import os
 import sys
+import time
 import wave
 from contextlib import nullcontext
 from pathlib import Path
@@ -15,14 +18,28 @@ import numpy as np
 import torch
 from beartype.typing import Iterator
 
+from pocket_tts.utils import tracing
+
 logger = logging.getLogger(__name__)
 
-FIRST_CHUNK_LENGTH_SECONDS = float(os.environ.get("FIRST_CHUNK_LENGTH_SECONDS", "0"))
+# Audio buffered before the first write, in seconds, "auto" adapts it to the speed of the
+# generation (see `StreamingWAVWriter`).
+_first_chunk_length = os.environ.get("FIRST_CHUNK_LENGTH_SECONDS", "0")
+FIRST_CHUNK_LENGTH_SECONDS = None if _first_chunk_length == "auto" else float(_first_chunk_length)
+# The adaptive first write assumes a generation this many times slower than measured.
+ADAPTIVE_FLUSH_MARGIN = 1.25
+# Average speaking rate, to estimate the duration of a text.
+WORDS_PER_SECOND = 2.5
+
+
+def estimate_speech_seconds(text: str) -> float:
+    """Rough duration of `text` once spoken, from its number of words."""
+    return len(text.split()) / WORDS_PER_SECOND
 
 
 def audio_read(filepath: str | Path) -> tuple[torch.Tensor, int]:
     """Read audio using Python's wave module."""
-    with wave.open(str(filepath), "rb") as wav_file:
+    with tracing.span("audio_decode"), wave.open(str(filepath), "rb") as wav_file:
         sample_rate = wav_file.getframerate()
 
         # Read all audio data as 16-bit signed integers
@@ -34,14 +51,51 @@ def audio_read(filepath: str | Path) -> tuple[torch.Tensor, int]:
         return wav, sample_rate
 
 
-class StreamingWAVWriter:
-    """WAV writer using Python's standard library wave module."""
+def encode_wav(audio_chunks: list[torch.Tensor], sample_rate: int) -> bytes:
+    """The 16-bit mono WAV file of the concatenated `audio_chunks`."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        for chunk in audio_chunks:
+            chunk_int16 = (chunk.clamp(-1, 1) * 32767).short()
+            wav_file.writeframes(chunk_int16.detach().cpu().numpy().tobytes())
+    return buffer.getvalue()
+
 
-    def __init__(self, output_stream, sample_rate: int):
+def _pcm16_bytes(audio_chunk: torch.Tensor | np.ndarray) -> bytes:
+    """16-bit PCM of an audio chunk, from torch or from the ONNX runtime (numpy)."""
+    if isinstance(audio_chunk, np.ndarray):
+        return (np.clip(audio_chunk, -1, 1) * 32767).astype(np.int16).tobytes()
+    return (audio_chunk.clamp(-1, 1) * 32767).short().detach().cpu().numpy().tobytes()
+
+
+class StreamingWAVWriter:
+    """WAV writer using Python's standard library wave module.
+
+    The first chunks are buffered until `first_chunk_seconds` of audio. If None, the first
+    write adapts to the speed of the generation: it happens once the buffered audio lasts as
+    long as the generation of the rest of the `expected_seconds` of audio, so that a player
+    starting with it never runs out of audio. It happens right away when the generation is
+    faster than real time, and at the end when it is not and `expected_seconds` is unknown.
+    """
+
+    def __init__(
+        self,
+        output_stream,
+        sample_rate: int,
+        first_chunk_seconds: float | None = FIRST_CHUNK_LENGTH_SECONDS,
+        expected_seconds: float | None = None,
+    ):
         self.output_stream = output_stream
         self.sample_rate = sample_rate
+        self.first_chunk_seconds = first_chunk_seconds
+        self.expected_seconds = expected_seconds
         self.wave_writer = None
         self.first_chunk_buffer = []
+        self.buffered_bytes = 0
+        self.start_time = time.monotonic()
 
     def write_header(self, sample_rate: int):
         """Initialize WAV writer with header."""
@@ -53,19 +107,15 @@ class StreamingWAVWriter:
         self.wave_writer.setframerate(sample_rate)
         self.wave_writer.setnframes(1_000_000_000)
 
-    def write_pcm_data(self, audio_chunk: torch.Tensor):
+    def write_pcm_data(self, audio_chunk: torch.Tensor | np.ndarray):
         """Write PCM data using wave module."""
-        # Convert to int16 PCM bytes
-        chunk_int16 = (audio_chunk.clamp(-1, 1) * 32767).short()
-        chunk_bytes = chunk_int16.detach().cpu().numpy().tobytes()
+        chunk_bytes = _pcm16_bytes(audio_chunk)
 
         if self.first_chunk_buffer is not None:
             self.first_chunk_buffer.append(chunk_bytes)
-            total_length = sum(len(c) for c in self.first_chunk_buffer)
-            target_length = (
-                int(self.sample_rate * FIRST_CHUNK_LENGTH_SECONDS) * 2
-            )  # 2 bytes per sample
-            if total_length < target_length:
+            self.buffered_bytes += len(chunk_bytes)
+            buffered_seconds = self.buffered_bytes / 2 / self.sample_rate  # 2 bytes per sample
+            if buffered_seconds < self._first_write_seconds(buffered_seconds):
                 return
             self._flush()
             return
@@ -73,6 +123,21 @@ class StreamingWAVWriter:
         # Use writeframesraw to avoid frame count validation for streaming
         self.wave_writer.writeframesraw(chunk_bytes)
 
+    def _first_write_seconds(self, buffered_seconds: float) -> float:
+        if self.first_chunk_seconds is not None:
+            return self.first_chunk_seconds
+        # Seconds of audio generated per second so far, with a margin.
+        elapsed = max(time.monotonic() - self.start_time, 1e-6)
+        speed = buffered_seconds / elapsed / ADAPTIVE_FLUSH_MARGIN
+        if speed >= 1:
+            return 0.0
+        if self.expected_seconds is None:
+            return math.inf
+        # The rest takes `remaining / speed` seconds to generate, while the buffered audio and
+        # the rest play for `buffered_seconds + remaining` seconds.
+        remaining = max(self.expected_seconds - buffered_seconds, 0.0)
+        return remaining * (1 / speed - 1)
+
     def _flush(self):
         if self.first_chunk_buffer is not None:
             self.wave_writer.writeframesraw(b"".join(self.first_chunk_buffer))
@@ -100,9 +165,16 @@ def is_file_like(obj):
 
 
 def stream_audio_chunks(
-    path: str | Path | None | Any, audio_chunks: Iterator[torch.Tensor], sample_rate: int
+    path: str | Path | None | Any,
+    audio_chunks: Iterator[torch.Tensor | np.ndarray],
+    sample_rate: int,
+    first_chunk_seconds: float | None = FIRST_CHUNK_LENGTH_SECONDS,
+    expected_seconds: float | None = None,
 ):
-    """Stream audio chunks to a WAV file or stdout, optionally playing them."""
+    """Stream audio chunks to a WAV file or stdout, optionally playing them.
+
+    See `StreamingWAVWriter` for `first_chunk_seconds` and `expected_seconds`.
+    """
     if path == "-":
         f = sys.stdout.buffer
     elif path is None:
@@ -114,13 +186,21 @@ def stream_audio_chunks(
 
     with f:
         if path is not None:
-            writer = StreamingWAVWriter(f, sample_rate)
+            writer = StreamingWAVWriter(f, sample_rate, first_chunk_seconds, expected_seconds)
             writer.write_header(sample_rate)
 
+        # The time spent writing is recorded as one span of the current trace.
+        write_start, write_time = None, 0.0
         for chunk in audio_chunks:
             # Then write to file
             if path is not None:
+                start = time.monotonic()
                 writer.write_pcm_data(chunk)
+                write_start = write_start or start
+                write_time += time.monotonic() - start
 
         if path is not None:
             writer.finalize()
+            trace = tracing.current_trace()
+            if trace is not None and write_start is not None:
+                trace.record("wav_write", write_start, write_start + write_time)
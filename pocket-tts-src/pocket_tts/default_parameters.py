@@ -5,3 +5,8 @@ DEFAULT_LSD_DECODE_STEPS = 1
 DEFAULT_NOISE_CLAMP = None
 DEFAULT_EOS_THRESHOLD = -4.0
 DEFAULT_FRAMES_AFTER_EOS = None
+# Rows of `pocket-tts generate --batch` sent to a worker at once.
+DEFAULT_ROWS_PER_TASK = 8
+# Sizes of the utterance cache of `pocket-tts serve`, in RAM and on disk.
+DEFAULT_UTTERANCE_CACHE_MB = 64
+DEFAULT_UTTERANCE_CACHE_DISK_MB = 1024
@@ -0,0 +1,172 @@
+"""Threads of their own for the generations, sized together with the torch threads.
+
+A generation runs the FlowLM and the Mimi decoder in two threads, and each of them runs its
+torch operators on an intra-op pool of `torch.get_num_threads()` threads, all the cores by
+default. With `asyncio.to_thread`, the generations also share the default executor of the
+event loop with every other blocking call. Several generations at once then run many times
+more torch threads than there are cores, and the throughput collapses.
+
+`GenerationExecutor` runs the generations in a pool of its own, sized for `num_workers`
+generations at once, and sets the number of torch threads to `threads_per_worker`. That
+number is shared by the whole process, so the executor is built once the models are loaded,
+and all the generations run with it. With `pin_cpus`, each
+running generation is also pinned to a group of cores of its own (Linux only). The number of
+generations at once is still limited by the admission control, whose `max_concurrency`
+should be `num_workers`: the pool has `max_threads` threads, so that the generations paused
+by preemption do not hold back the ones preempting them.
+
+`auto_tune` measures the frames generated per second by a few combinations of workers and
+threads per worker on the host, and returns the best one.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import torch
+
+from pocket_tts.warmup import WARMUP_TEXT
+
+logger = logging.getLogger(__name__)
+
+
+def available_cpus() -> list[int]:
+    """The cores this process can run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def default_threads_per_worker(num_workers: int, num_cpus: int | None = None) -> int:
+    """Torch threads per generation so that `num_workers` generations share the cores.
+
+    Each generation runs two threads, the FlowLM and the Mimi decoder.
+    """
+    num_cpus = num_cpus or len(available_cpus())
+    return max(1, num_cpus // (2 * num_workers))
+
+
+class GenerationExecutor:
+    """Runs the generations in a pool of threads, with `threads_per_worker` torch threads.
+
+    Sets the number of torch threads of the whole process when built.
+    """
+
+    def __init__(
+        self,
+        num_workers: int,
+        threads_per_worker: int | None = None,
+        pin_cpus: bool = False,
+        max_threads: int | None = None,
+    ):
+        if num_workers < 1:
+            raise ValueError("num_workers must be at least 1.")
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or default_threads_per_worker(num_workers)
+        self.pin_cpus = pin_cpus and hasattr(os, "sched_setaffinity")
+        cpus = available_cpus()
+        self._all_cpus = set(cpus)
+        cpus_per_worker = max(1, len(cpus) // num_workers)
+        # The groups of cores not taken by a running generation.
+        self._free_cpus = [
+            set(cpus[i * cpus_per_worker : (i + 1) * cpus_per_worker])
+            for i in range(min(num_workers, len(cpus)))
+        ]
+        self._lock = threading.Lock()
+        torch.set_num_threads(self.threads_per_worker)
+        self._pool = ThreadPoolExecutor(
+            max_threads or num_workers, thread_name_prefix="pocket-tts-generation"
+        )
+
+    def _run(self, fn: Callable, *args, **kwargs):
+        if not self.pin_cpus:
+            return fn(*args, **kwargs)
+        with self._lock:
+            cpus = self._free_cpus.pop() if self._free_cpus else None
+        try:
+            # The threads started by the generation inherit the affinity of this one.
+            os.sched_setaffinity(0, cpus or self._all_cpus)
+            return fn(*args, **kwargs)
+        finally:
+            if cpus is not None:
+                with self._lock:
+                    self._free_cpus.append(cpus)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        return self._pool.submit(self._run, fn, *args, **kwargs)
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """Like `asyncio.to_thread`, in a thread of the executor."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+
+
+def candidate_sizes(num_cpus: int, num_workers: int | None = None) -> list[tuple[int, int]]:
+    """The (workers, threads per worker) tried by `auto_tune`, with `num_workers` if given.
+
+    The numbers of workers are powers of two, and each worker has as many torch threads as
+    its share of the cores, or half as many (a generation runs two threads).
+    """
+    if num_workers is not None:
+        workers = [num_workers]
+    else:
+        workers = [2**i for i in range(num_cpus.bit_length())]
+    sizes = []
+    for w in workers:
+        cores = max(1, num_cpus // w)
+        for threads in sorted({max(1, cores // 2), cores}):
+            sizes.append((w, threads))
+    return sizes
+
+
+def measure_frames_per_second(
+    tts_model, model_state: dict, executor: GenerationExecutor, text: str = WARMUP_TEXT
+) -> float:
+    """Frames generated per second by `executor.num_workers` generations of `text` at once."""
+
+    def generate() -> int:
+        audio_chunks = tts_model.generate_audio_stream(
+            model_state=model_state, text_to_generate=text
+        )
+        return sum(1 for _ in audio_chunks)
+
+    start = time.monotonic()
+    futures = [executor.submit(generate) for _ in range(executor.num_workers)]
+    num_frames = sum(future.result() for future in futures)
+    return num_frames / (time.monotonic() - start)
+
+
+def auto_tune(
+    tts_model,
+    model_state: dict,
+    num_workers: int | None = None,
+    pin_cpus: bool = False,
+    text: str = WARMUP_TEXT,
+) -> tuple[int, int]:
+    """The (workers, threads per worker) generating the most frames per second on this host.
+
+    Each combination of `candidate_sizes` generates `text` once to warm up, then once more to
+    be measured.
+    """
+    sizes = candidate_sizes(len(available_cpus()), num_workers)
+    best, best_frames_per_second = sizes[0], 0.0
+    for workers, threads in sizes:
+        executor = GenerationExecutor(workers, threads, pin_cpus)
+        try:
+            measure_frames_per_second(tts_model, model_state, executor, text)
+            frames_per_second = measure_frames_per_second(tts_model, model_state, executor, text)
+        finally:
+            executor.shutdown()
+        logger.info(
+            "%d workers with %d torch threads: %.1f frames/s", workers, threads, frames_per_second
+        )
+        if frames_per_second > best_frames_per_second:
+            best, best_frames_per_second = (workers, threads), frames_per_second
+    logger.info("Auto-tune picked %d workers with %d torch threads", *best)
+    return best
@@ -0,0 +1,3 @@
+"""Export of the streaming model to ONNX graphs, and a runtime to run them without PyTorch."""
+
+MANIFEST_NAME = "manifest.json"
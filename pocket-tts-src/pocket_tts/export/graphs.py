@@ -0,0 +1,318 @@
+"""Export of the streaming model to per-step ONNX graphs.
+
+The state of every `StatefulModule` is passed as explicit graph inputs and returned as graph
+outputs, so that a runtime can drive the model one step at a time without PyTorch.
+Three graphs are exported:
+* `flow_lm_step`: one call of the FlowLM backbone (text, audio conditioning or latents).
+* `flow_net`: the `SimpleMLPAdaLN` flow head, called `lsd_decode_steps` times per frame.
+* `mimi_decoder_step`: decoding of one latent frame into audio with Mimi.
+"""
+
+import json
+import logging
+import shutil
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import nn
+
+from pocket_tts.conditioners.base import TokenizedText
+from pocket_tts.export import MANIFEST_NAME
+from pocket_tts.modules.stateful_module import increment_steps, init_states
+from pocket_tts.utils.utils import PREDEFINED_VOICES, download_if_necessary
+
+logger = logging.getLogger(__name__)
+
+OPSET_VERSION = 17
+# Same sequence length as the one used by `TTSModel` to initialize its states.
+STATE_SEQUENCE_LENGTH = 1000
+PARITY_TOLERANCE = 1e-3
+
+
+def flatten_state(model_state: dict) -> dict[str, torch.Tensor]:
+    """Flattens a model state into `{"<module name>/<key>": tensor}`."""
+    return {
+        f"{module_name}/{key}": value
+        for module_name, module_state in model_state.items()
+        for key, value in module_state.items()
+    }
+
+
+def unflatten_state(flat_state: dict) -> dict:
+    model_state = {}
+    for name, value in flat_state.items():
+        module_name, key = name.rsplit("/", 1)
+        model_state.setdefault(module_name, {})[key] = value
+    return model_state
+
+
+class _StreamingStep(nn.Module):
+    """A streaming step taking the flattened state as extra inputs and returning it updated."""
+
+    def __init__(self, root: nn.Module, state_names: list[str]):
+        super().__init__()
+        self.root = root
+        self.state_names = state_names
+
+    def _unpack_state(self, flat_state: tuple[torch.Tensor, ...]) -> dict:
+        # The streaming modules update their state in place, so we never write to the inputs.
+        return unflatten_state(
+            {name: value.clone() for name, value in zip(self.state_names, flat_state)}
+        )
+
+    def _pack_state(self, model_state: dict) -> tuple[torch.Tensor, ...]:
+        flat_state = flatten_state(model_state)
+        return tuple(flat_state[name] for name in self.state_names)
+
+
+class FlowLMStep(_StreamingStep):
+    """Same computation as `TTSModel._run_flow_lm_and_increment_step`, without the sampling.
+
+    Returns the conditioning of the flow head and the EOS logit, the latent itself is sampled
+    by the runtime with the `flow_net` graph so that the noise stays under its control.
+    """
+
+    def forward(
+        self,
+        text_tokens: torch.Tensor,
+        audio_conditioning: torch.Tensor,
+        latents: torch.Tensor,
+        *flat_state: torch.Tensor,
+    ):
+        flow_lm = self.root
+        model_state = self._unpack_state(flat_state)
+
+        text_embeddings = flow_lm.conditioner(TokenizedText(text_tokens))
+        text_embeddings = torch.cat([text_embeddings, audio_conditioning], dim=1)
+        # NaN values signal a BOS position.
+        sequence = torch.where(torch.isnan(latents), flow_lm.bos_emb, latents)
+        input_ = torch.cat([text_embeddings, flow_lm.input_linear(sequence)], dim=1)
+        transformer_out = flow_lm.out_norm(flow_lm.transformer(input_, model_state))
+        transformer_out = transformer_out[:, -1].to(torch.float32)
+        eos_logit = flow_lm.out_eos(transformer_out)
+
+        increment_steps(flow_lm, model_state, increment=input_.shape[1])
+        return (transformer_out, eos_logit, *self._pack_state(model_state))
+
+
+class MimiDecoderStep(_StreamingStep):
+    """Same computation as one iteration of `TTSModel._decode_audio_worker`."""
+
+    def __init__(
+        self, mimi: nn.Module, state_names: list[str], emb_std: torch.Tensor, emb_mean: torch.Tensor
+    ):
+        super().__init__(mimi, state_names)
+        self.register_buffer("emb_std", emb_std.detach().clone())
+        self.register_buffer("emb_mean", emb_mean.detach().clone())
+        # Number of steps of the Mimi transformer for one latent frame.
+        self.increment = int(mimi.encoder_frame_rate / mimi.frame_rate)
+
+    def forward(self, latent: torch.Tensor, *flat_state: torch.Tensor):
+        mimi = self.root
+        model_state = self._unpack_state(flat_state)
+
+        mimi_decoding_input = latent * self.emb_std + self.emb_mean
+        quantized = mimi.quantizer(mimi_decoding_input.transpose(-1, -2))
+        audio_frame = mimi.decode_from_latent(quantized, model_state)
+
+        increment_steps(mimi, model_state, increment=self.increment)
+        return (audio_frame, *self._pack_state(model_state))
+
+
+def _describe_state(flat_state: dict[str, torch.Tensor]) -> list[dict]:
+    """All initial states are constant tensors, so we only store their shape and value."""
+    description = []
+    for name, value in flat_state.items():
+        flat_value = value.flatten()
+        if flat_value.numel() == 0:
+            fill = 0.0
+        elif torch.isnan(flat_value[0]):
+            if not torch.isnan(flat_value).all():
+                raise ValueError(f"Initial state {name} is not constant, cannot export it.")
+            fill = float("nan")
+        else:
+            if not (flat_value == flat_value[0]).all():
+                raise ValueError(f"Initial state {name} is not constant, cannot export it.")
+            fill = flat_value[0].item()
+        description.append(
+            {
+                "name": name,
+                "shape": list(value.shape),
+                "dtype": str(value.dtype).removeprefix("torch."),
+                "fill": fill,
+            }
+        )
+    return description
+
+
+def _dynamic_state_axes(state_names: list[str]) -> dict[str, dict[int, str]]:
+    # The FlowLM attention stores its position as the length of `current_end`.
+    return {name: {0: f"{name}_length"} for name in state_names if name.endswith("/current_end")}
+
+
+@torch.no_grad
+def _export_graph(
+    module: nn.Module,
+    path: Path,
+    example_inputs: dict[str, torch.Tensor],
+    output_names: list[str],
+    dynamic_axes: dict[str, dict[int, str]],
+    keep_initializers_as_inputs: bool = False,
+):
+    logger.info("Exporting %s", path)
+    torch.onnx.export(
+        module,
+        tuple(example_inputs.values()),
+        str(path),
+        input_names=list(example_inputs),
+        output_names=output_names,
+        dynamic_axes=dynamic_axes,
+        opset_version=OPSET_VERSION,
+        keep_initializers_as_inputs=keep_initializers_as_inputs,
+        dynamo=False,
+    )
+
+
+@torch.no_grad
+def _check_parity(module: nn.Module, path: Path, example_inputs: dict[str, torch.Tensor]):
+    """Runs the exported graph with onnxruntime and compares it with the torch module."""
+    try:
+        import onnxruntime
+    except ImportError:
+        logger.warning("onnxruntime is not installed, skipping the parity check of %s", path)
+        return
+    session_options = onnxruntime.SessionOptions()
+    session_options.log_severity_level = 3
+    session = onnxruntime.InferenceSession(
+        str(path), session_options, providers=["CPUExecutionProvider"]
+    )
+    feeds = {name: value.numpy() for name, value in example_inputs.items()}
+    onnx_outputs = session.run(None, feeds)
+    torch_outputs = module(*example_inputs.values())
+    if isinstance(torch_outputs, torch.Tensor):
+        torch_outputs = (torch_outputs,)
+    for output, onnx_output in zip(torch_outputs, onnx_outputs):
+        output = output.numpy()
+        if output.dtype == bool:
+            continue
+        # Uninitialized parts of the FlowLM cache are NaN.
+        finite = ~np.isnan(output)
+        max_diff = np.abs(output[finite] - onnx_output[finite]).max(initial=0.0)
+        if max_diff > PARITY_TOLERANCE:
+            raise RuntimeError(
+                f"Exported graph {path} differs from the torch model (max diff {max_diff})."
+            )
+    logger.info("Parity check passed for %s", path.name)
+
+
+def export_onnx(tts_model: nn.Module, output_dir: str | Path, include_voices: bool = True) -> Path:
+    """Exports `tts_model` to per-step ONNX graphs in `output_dir`.
+
+    The directory also contains the tokenizer, the predefined voices and a manifest
+    describing the graphs and their states. It can be loaded with
+    `pocket_tts.export.runtime.OnnxTTSModel`.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    flow_lm = tts_model.flow_lm
+    mimi = tts_model.mimi
+    dtype = flow_lm.dtype
+    graphs = {}
+
+    # FlowLM backbone step.
+    flow_lm_state = flatten_state(
+        init_states(flow_lm, batch_size=1, sequence_length=STATE_SEQUENCE_LENGTH)
+    )
+    state_names = list(flow_lm_state)
+    step = FlowLMStep(flow_lm, state_names).eval()
+    # We trace with a non-empty state so that no size gets specialized to zero.
+    example_state = unflatten_state({k: v.clone() for k, v in flow_lm_state.items()})
+    increment_steps(flow_lm, example_state, increment=2)
+    example_inputs = {
+        "text_tokens": torch.zeros((1, 3), dtype=torch.int64),
+        "audio_conditioning": torch.zeros((1, 2, flow_lm.dim), dtype=dtype),
+        "latents": torch.full((1, 1, flow_lm.ldim), float("NaN"), dtype=dtype),
+        **flatten_state(example_state),
+    }
+    path = output_dir / "flow_lm_step.onnx"
+    _export_graph(
+        step,
+        path,
+        example_inputs,
+        output_names=["conditioning", "eos_logit", *[f"next/{n}" for n in state_names]],
+        dynamic_axes={
+            "text_tokens": {1: "text_length"},
+            "audio_conditioning": {1: "audio_length"},
+            "latents": {1: "latents_length"},
+            **_dynamic_state_axes(state_names),
+        },
+    )
+    _check_parity(step, path, example_inputs)
+    graphs["flow_lm_step"] = {"file": path.name, "state": _describe_state(flow_lm_state)}
+
+    # Flow head.
+    example_inputs = {
+        "c": torch.randn((1, flow_lm.dim), dtype=dtype),
+        "s": torch.zeros((1, 1), dtype=dtype),
+        "t": torch.ones((1, 1), dtype=dtype),
+        "x": torch.randn((1, flow_lm.ldim), dtype=dtype),
+    }
+    path = output_dir / "flow_net.onnx"
+    _export_graph(
+        flow_lm.flow_net,
+        path,
+        example_inputs,
+        output_names=["flow"],
+        dynamic_axes={name: {0: "batch"} for name in example_inputs},
+        # The two time embedders have identical frequency buffers, which the initializer
+        # deduplication of the exporter breaks unless the initializers are kept as inputs.
+        keep_initializers_as_inputs=True,
+    )
+    _check_parity(flow_lm.flow_net, path, example_inputs)
+    graphs["flow_net"] = {"file": path.name, "state": []}
+
+    # Mimi decoder step.
+    mimi_state = flatten_state(
+        init_states(mimi, batch_size=1, sequence_length=STATE_SEQUENCE_LENGTH)
+    )
+    state_names = list(mimi_state)
+    step = MimiDecoderStep(mimi, state_names, flow_lm.emb_std, flow_lm.emb_mean).eval()
+    example_inputs = {
+        "latent": torch.randn((1, 1, flow_lm.ldim), dtype=dtype),
+        **{k: v.clone() for k, v in mimi_state.items()},
+    }
+    path = output_dir / "mimi_decoder_step.onnx"
+    _export_graph(
+        step,
+        path,
+        example_inputs,
+        output_names=["audio", *[f"next/{n}" for n in state_names]],
+        dynamic_axes={},
+    )
+    _check_parity(step, path, example_inputs)
+    graphs["mimi_decoder_step"] = {"file": path.name, "state": _describe_state(mimi_state)}
+
+    tokenizer_file = download_if_necessary(tts_model.config.flow_lm.lookup_table.tokenizer_path)
+    shutil.copy(tokenizer_file, output_dir / "tokenizer.model")
+
+    voices = {}
+    if include_voices:
+        (output_dir / "embeddings").mkdir(exist_ok=True)
+        for voice_name, voice_url in PREDEFINED_VOICES.items():
+            voices[voice_name] = f"embeddings/{voice_name}.safetensors"
+            shutil.copy(download_if_necessary(voice_url), output_dir / voices[voice_name])
+
+    manifest = {
+        "sample_rate": tts_model.config.mimi.sample_rate,
+        "frame_rate": tts_model.config.mimi.frame_rate,
+        "dim": flow_lm.dim,
+        "ldim": flow_lm.ldim,
+        "tokenizer": "tokenizer.model",
+        "voices": voices,
+        "graphs": graphs,
+    }
+    with open(output_dir / MANIFEST_NAME, "w") as f:
+        json.dump(manifest, f, indent=2)
+    logger.info("ONNX export written in %s", output_dir)
+    return output_dir
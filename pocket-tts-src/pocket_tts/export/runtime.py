@@ -0,0 +1,330 @@
+"""Runtime for the graphs exported by `pocket_tts.export.graphs`.
+
+It only depends on numpy, onnxruntime, sentencepiece and safetensors, so it can be shipped
+where PyTorch cannot. Voice cloning from raw audio needs the Mimi encoder which is not
+exported, voices must be given as pre-computed embeddings (like the predefined voices).
+"""
+
+import itertools
+import json
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+import onnxruntime
+import sentencepiece
+from beartype.typing import Iterator
+from safetensors.numpy import load_file
+
+from pocket_tts.default_parameters import (
+    DEFAULT_EOS_THRESHOLD,
+    DEFAULT_LSD_DECODE_STEPS,
+    DEFAULT_NOISE_CLAMP,
+    DEFAULT_TEMPERATURE,
+)
+from pocket_tts.export import MANIFEST_NAME
+
+logger = logging.getLogger(__name__)
+
+MAX_NB_TOKENS_IN_A_CHUNK = 50
+
+
+class OnnxTTSModel:
+    """Runs the exported graphs with the same generation interface as `TTSModel`.
+
+    Audio chunks are yielded as float32 numpy arrays instead of torch tensors.
+
+    Args:
+        export_dir: Directory written by `pocket-tts export-onnx`.
+        temp: Sampling temperature for generation.
+        lsd_decode_steps: Number of steps for Lagrangian Self Distillation decoding.
+        noise_clamp: Maximum value for noise sampling, no clamping if None.
+        eos_threshold: Threshold for end-of-sequence detection.
+        seed: Seed of the random generator used to sample the noise.
+    """
+
+    def __init__(
+        self,
+        export_dir: str | Path,
+        temp: float = DEFAULT_TEMPERATURE,
+        lsd_decode_steps: int = DEFAULT_LSD_DECODE_STEPS,
+        noise_clamp: float | None = DEFAULT_NOISE_CLAMP,
+        eos_threshold: float = DEFAULT_EOS_THRESHOLD,
+        seed: int | None = None,
+    ):
+        self.export_dir = Path(export_dir)
+        with open(self.export_dir / MANIFEST_NAME) as f:
+            self.manifest = json.load(f)
+        self.temp = temp
+        self.lsd_decode_steps = lsd_decode_steps
+        self.noise_clamp = noise_clamp
+        self.eos_threshold = eos_threshold
+        self.rng = np.random.default_rng(seed)
+
+        session_options = onnxruntime.SessionOptions()
+        # The flow head keeps its initializers as inputs, which onnxruntime warns about.
+        session_options.log_severity_level = 3
+        self.sessions = {
+            name: onnxruntime.InferenceSession(
+                str(self.export_dir / graph["file"]),
+                session_options,
+                providers=["CPUExecutionProvider"],
+            )
+            for name, graph in self.manifest["graphs"].items()
+        }
+        self.tokenizer = sentencepiece.SentencePieceProcessor(
+            str(self.export_dir / self.manifest["tokenizer"])
+        )
+        self.dim = self.manifest["dim"]
+        self.ldim = self.manifest["ldim"]
+
+    @property
+    def device(self) -> str:
+        return "cpu"
+
+    @property
+    def sample_rate(self) -> int:
+        return self.manifest["sample_rate"]
+
+    def _init_state(self, graph_name: str) -> dict[str, np.ndarray]:
+        return {
+            state["name"]: np.full(state["shape"], state["fill"], dtype=state["dtype"])
+            for state in self.manifest["graphs"][graph_name]["state"]
+        }
+
+    def _run_step(
+        self, graph_name: str, inputs: dict[str, np.ndarray], state: dict[str, np.ndarray]
+    ) -> tuple[list[np.ndarray], dict[str, np.ndarray]]:
+        """Runs one streaming step, the updated state is returned as a new dict."""
+        outputs = self.sessions[graph_name].run(None, {**inputs, **state})
+        nb_outputs = len(outputs) - len(state)
+        return outputs[:nb_outputs], dict(zip(state, outputs[nb_outputs:]))
+
+    def _run_flow_lm(
+        self,
+        model_state: dict[str, np.ndarray],
+        text_tokens: np.ndarray | None = None,
+        audio_conditioning: np.ndarray | None = None,
+        latents: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, dict[str, np.ndarray]]:
+        if text_tokens is None:
+            text_tokens = np.zeros((1, 0), dtype=np.int64)
+        if audio_conditioning is None:
+            audio_conditioning = np.zeros((1, 0, self.dim), dtype=np.float32)
+        if latents is None:
+            latents = np.zeros((1, 0, self.ldim), dtype=np.float32)
+        (conditioning, eos_logit), model_state = self._run_step(
+            "flow_lm_step",
+            {
+                "text_tokens": text_tokens,
+                "audio_conditioning": audio_conditioning,
+                "latents": latents,
+            },
+            model_state,
+        )
+        return conditioning, eos_logit, model_state
+
+    def _sample_noise(self, shape: tuple[int, ...], temp: float) -> np.ndarray:
+        std = temp**0.5
+        noise = self.rng.normal(0.0, std, size=shape)
+        if self.noise_clamp is not None:
+            # Truncated normal distribution, like `torch.nn.init.trunc_normal_`.
+            out_of_range = np.abs(noise) > self.noise_clamp
+            while out_of_range.any():
+                noise[out_of_range] = self.rng.normal(0.0, std, size=out_of_range.sum())
+                out_of_range = np.abs(noise) > self.noise_clamp
+        return noise.astype(np.float32)
+
+    def _lsd_decode(self, conditioning: np.ndarray, temp: float, num_steps: int) -> np.ndarray:
+        """Same as `lsd_decode` in the FlowLM model, with the `flow_net` graph."""
+        current = self._sample_noise((conditioning.shape[0], self.ldim), temp)
+        for i in range(num_steps):
+            s = np.full((conditioning.shape[0], 1), i / num_steps, dtype=np.float32)
+            t = np.full((conditioning.shape[0], 1), (i + 1) / num_steps, dtype=np.float32)
+            (flow_dir,) = self.sessions["flow_net"].run(
+                None, {"c": conditioning, "s": s, "t": t, "x": current}
+            )
+            current = current + flow_dir / num_steps
+        return current
+
+    def get_state_for_audio_prompt(
+        self, audio_conditioning: Path | str | np.ndarray
+    ) -> dict[str, np.ndarray]:
+        """Create the model state for a voice.
+
+        Args:
+            audio_conditioning: Name of a predefined voice, path to a safetensors file
+                with an `audio_prompt` embedding, or the embedding itself.
+        """
+        voices = self.manifest["voices"]
+        if isinstance(audio_conditioning, str) and audio_conditioning in voices:
+            audio_conditioning = self.export_dir / voices[audio_conditioning]
+        if isinstance(audio_conditioning, (str, Path)):
+            if Path(audio_conditioning).suffix != ".safetensors":
+                raise ValueError(
+                    "The ONNX runtime cannot encode audio files, use one of the predefined "
+                    f"voices {list(voices)} or a safetensors file with an `audio_prompt`."
+                )
+            audio_conditioning = load_file(audio_conditioning)["audio_prompt"]
+
+        model_state = self._init_state("flow_lm_step")
+        _, _, model_state = self._run_flow_lm(
+            model_state, audio_conditioning=audio_conditioning.astype(np.float32)
+        )
+        return model_state
+
+    def generate_audio(
+        self,
+        model_state: dict[str, np.ndarray],
+        text_to_generate: str,
+        frames_after_eos: int | None = None,
+        copy_state: bool = True,
+    ) -> np.ndarray:
+        """Generate the complete audio, see `generate_audio_stream`."""
+        audio_chunks = list(
+            self.generate_audio_stream(
+                model_state=model_state,
+                text_to_generate=text_to_generate,
+                frames_after_eos=frames_after_eos,
+                copy_state=copy_state,
+            )
+        )
+        return np.concatenate(audio_chunks, axis=0)
+
+    def generate_audio_stream(
+        self,
+        model_state: dict[str, np.ndarray],
+        text_to_generate: str,
+        frames_after_eos: int | None = None,
+        copy_state: bool = True,
+    ) -> Iterator[np.ndarray]:
+        """Generate audio chunks from text, one chunk per latent frame.
+
+        The arguments are the same as `TTSModel.generate_audio_stream`, and like it the
+        temperature and the LSD decode steps are the `temp` and `lsd_decode_steps` attributes.
+        """
+        for chunk in self._split_into_best_sentences(text_to_generate):
+            _, frames_after_eos_guess = prepare_text_prompt(chunk)
+            yield from self._generate_audio_stream_short_text(
+                model_state=model_state,
+                text_to_generate=chunk,
+                frames_after_eos=(
+                    frames_after_eos if frames_after_eos is not None else frames_after_eos_guess + 2
+                ),
+                copy_state=copy_state,
+            )
+
+    def _generate_audio_stream_short_text(
+        self,
+        model_state: dict[str, np.ndarray],
+        text_to_generate: str,
+        frames_after_eos: int,
+        copy_state: bool,
+    ) -> Iterator[np.ndarray]:
+        # Steps return new arrays, so the input state is only modified if asked to.
+        state = dict(model_state)
+        gen_len_sec = len(text_to_generate.split()) * 1 + 2.0
+        max_gen_len = int(gen_len_sec * 12.5)
+        text_tokens = np.array([self.tokenizer.encode(text_to_generate)], dtype=np.int64)
+
+        t_generating = time.monotonic()
+        _, _, state = self._run_flow_lm(state, text_tokens=text_tokens)
+
+        mimi_state = self._init_state("mimi_decoder_step")
+        latent = np.full((1, 1, self.ldim), np.nan, dtype=np.float32)
+        total_generated_samples = 0
+        eos_step = None
+        for generation_step in range(max_gen_len):
+            conditioning, eos_logit, state = self._run_flow_lm(state, latents=latent)
+            if eos_logit.item() > self.eos_threshold and eos_step is None:
+                eos_step = generation_step
+            if eos_step is not None and generation_step >= eos_step + frames_after_eos:
+                break
+            latent = self._lsd_decode(conditioning, self.temp, self.lsd_decode_steps)[:, None, :]
+            (audio_frame,), mimi_state = self._run_step(
+                "mimi_decoder_step", {"latent": latent}, mimi_state
+            )
+            total_generated_samples += audio_frame.shape[-1]
+            yield audio_frame[0, 0]
+        else:
+            logger.warning(
+                "Maximum generation length reached without EOS, this very often indicates an error."
+            )
+
+        if not copy_state:
+            model_state.update(state)
+
+        duration_generated_audio = int(total_generated_samples * 1000 / self.sample_rate)
+        generation_time = int((time.monotonic() - t_generating) * 1000)
+        logger.info(
+            "Generated: %d ms of audio in %d ms so %.2fx faster than real-time",
+            duration_generated_audio,
+            generation_time,
+            duration_generated_audio / max(generation_time, 1),
+        )
+
+    def _split_into_best_sentences(self, text_to_generate: str) -> list[str]:
+        """Same splitting as `split_into_best_sentences` in the torch model."""
+        text_to_generate, _ = prepare_text_prompt(text_to_generate)
+        list_of_tokens = self.tokenizer.encode(text_to_generate.strip())
+        _, *end_of_sentence_tokens = self.tokenizer.encode(".!...?")
+
+        end_of_sentences_indices = [0]
+        previous_was_end_of_sentence_token = False
+        for token_idx, token in enumerate(list_of_tokens):
+            if token in end_of_sentence_tokens:
+                previous_was_end_of_sentence_token = True
+            else:
+                if previous_was_end_of_sentence_token:
+                    end_of_sentences_indices.append(token_idx)
+                previous_was_end_of_sentence_token = False
+        end_of_sentences_indices.append(len(list_of_tokens))
+
+        chunks = []
+        current_chunk = ""
+        current_nb_of_tokens_in_chunk = 0
+        for start, end in itertools.pairwise(end_of_sentences_indices):
+            sentence = self.tokenizer.decode(list_of_tokens[start:end])
+            nb_tokens = end - start
+            if current_chunk == "":
+                current_chunk = sentence
+                current_nb_of_tokens_in_chunk = nb_tokens
+            elif current_nb_of_tokens_in_chunk + nb_tokens > MAX_NB_TOKENS_IN_A_CHUNK:
+                chunks.append(current_chunk.strip())
+                current_chunk = sentence
+                current_nb_of_tokens_in_chunk = nb_tokens
+            else:
+                current_chunk += " " + sentence
+                current_nb_of_tokens_in_chunk += nb_tokens
+        if current_chunk != "":
+            chunks.append(current_chunk.strip())
+        return chunks
+
+
+def prepare_text_prompt(text: str) -> tuple[str, int]:
+    """Same as `prepare_text_prompt` in the torch model, which cannot be imported without torch."""
+    text = text.strip()
+    if text == "":
+        raise ValueError("Text prompt cannot be empty")
+    text = text.replace("\n", " ").replace("\r", " ").replace("  ", " ")
+    number_of_words = len(text.split())
+    if number_of_words <= 4:
+        frames_after_eos_guess = 3
+    else:
+        frames_after_eos_guess = 1
+
+    # Make sure it starts with an uppercase letter
+    if not text[0].isupper():
+        text = text[0].upper() + text[1:]
+
+    # If it ends with a letter or digit, we add a period.
+    if text[-1].isalnum():
+        text = text + "."
+
+    # The model does not perform well when there are very few tokens, so
+    # we can add empty spaces at the beginning to increase the token count.
+    if len(text.split()) < 5:
+        text = " " * 8 + text
+
+    return text, frames_after_eos_guess
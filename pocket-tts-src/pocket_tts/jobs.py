@@ -0,0 +1,325 @@
+"""Long-form generation jobs, checkpointed to disk so that they survive restarts.
+
+A job generates a long text in the background, and its audio is downloaded once completed.
+The text is split into chunks of sentences, like `TTSModel.generate_audio_stream` does, and
+each chunk is generated from the state of the voice. So between two chunks, the whole state
+of a job is the index of its next chunk, the state of its random generator and the length of
+the audio written so far. After each chunk, the audio is appended to `audio.pcm` and synced,
+then this checkpoint is written to `checkpoint.pt`.
+
+A job interrupted by a restart or a crash of the server resumes from its last checkpoint,
+dropping the audio written after it, so its WAV is byte-identical to an uninterrupted run.
+The noise of a job is drawn from a generator of its own (see `pocket_tts.seeding`), so its
+audio only depends on its text, voice and seed, even when other generations run at the same
+time or preempt it.
+
+Each job is a directory of `jobs_dir`:
+
+- `job.json`: the text, its chunks, the status and progress of the job.
+- `voice_state.pt`: the model state of the voice.
+- `checkpoint.pt`: the last checkpoint.
+- `audio.pcm` while the job runs, then `audio.wav` once completed.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import secrets
+import shutil
+import threading
+import time
+import uuid
+import wave
+from contextlib import nullcontext
+from functools import partial
+from pathlib import Path
+
+import torch
+
+from pocket_tts import metrics
+from pocket_tts.admission import (
+    AdmissionController,
+    QueueFullError,
+    QueueTimeoutError,
+    estimate_cost,
+)
+from pocket_tts.preemption import get_preemption, new_generation
+from pocket_tts.seeding import get_seeding
+
+logger = logging.getLogger(__name__)
+
+# Client of the jobs for the "fair" scheduling policy.
+JOBS_CLIENT_ID = "jobs"
+# Seconds between two looks for a queued job.
+JOB_POLL_SECONDS = 0.5
+
+
+def split_text(tts_model, text: str) -> list[str]:
+    """The chunks generated one after the other by `TTSModel.generate_audio_stream`."""
+    from pocket_tts.models.tts_model import split_into_best_sentences
+
+    return split_into_best_sentences(tts_model.flow_lm.conditioner.tokenizer, text)
+
+
+def _save_atomically(path: Path, save):
+    # A crash leaves either the old or the new file, never a partial one.
+    temp_path = path.with_name(path.name + ".tmp")
+    save(temp_path)
+    os.replace(temp_path, path)
+
+
+class Job:
+    """A long-form generation, stored in `job_dir`.
+
+    Its status is "queued", "running", "completed", "failed" or "cancelled".
+    """
+
+    def __init__(
+        self,
+        job_dir: Path,
+        text: str,
+        chunks: list[str],
+        seed: int,
+        cost: float,
+        sample_rate: int,
+        status: str = "queued",
+        chunks_done: int = 0,
+        audio_bytes: int = 0,
+        error: str | None = None,
+        created_at: float | None = None,
+    ):
+        self.job_dir = job_dir
+        self.text = text
+        self.chunks = chunks
+        self.seed = seed
+        self.cost = cost
+        self.sample_rate = sample_rate
+        self.status = status
+        self.chunks_done = chunks_done
+        self.audio_bytes = audio_bytes
+        self.error = error
+        self.created_at = created_at or time.time()
+
+    @property
+    def job_id(self) -> str:
+        return self.job_dir.name
+
+    @property
+    def audio_path(self) -> Path:
+        return self.job_dir / "audio.wav"
+
+    @property
+    def audio_seconds(self) -> float:
+        # 16-bit mono samples.
+        return self.audio_bytes / 2 / self.sample_rate
+
+    def as_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "chunks_done": self.chunks_done,
+            "num_chunks": len(self.chunks),
+            "progress": self.chunks_done / len(self.chunks),
+            "audio_seconds": self.audio_seconds,
+            "error": self.error,
+            "created_at": self.created_at,
+        }
+
+    def save(self):
+        info = {
+            "text": self.text,
+            "chunks": self.chunks,
+            "seed": self.seed,
+            "cost": self.cost,
+            "sample_rate": self.sample_rate,
+            "status": self.status,
+            "chunks_done": self.chunks_done,
+            "audio_bytes": self.audio_bytes,
+            "error": self.error,
+            "created_at": self.created_at,
+        }
+        _save_atomically(self.job_dir / "job.json", lambda path: path.write_text(json.dumps(info)))
+
+    @classmethod
+    def load(cls, job_dir: Path) -> "Job":
+        return cls(job_dir, **json.loads((job_dir / "job.json").read_text()))
+
+
+class JobManager:
+    """The jobs stored in `jobs_dir`, run one at a time by `serve`.
+
+    The jobs found in `jobs_dir` which did not finish are resumed from their checkpoint.
+    """
+
+    def __init__(self, jobs_dir: str | Path, tts_model):
+        self.jobs_dir = Path(jobs_dir)
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        self.tts_model = tts_model
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        for job_dir in self.jobs_dir.iterdir():
+            if not (job_dir / "job.json").exists():
+                continue
+            job = Job.load(job_dir)
+            if job.status == "running":
+                logger.info("Resuming job %s at chunk %d", job.job_id, job.chunks_done)
+                job.status = "queued"
+            self._jobs[job.job_id] = job
+
+    def submit(self, text: str, model_state: dict, seed: int | None = None) -> Job:
+        """Queues the generation of `text` with the voice of `model_state`."""
+        chunks = split_text(self.tts_model, text)
+        if not chunks:
+            raise ValueError("Text cannot be empty")
+        if seed is None:
+            seed = secrets.randbits(63)
+        job = Job(
+            self.jobs_dir / uuid.uuid4().hex,
+            text,
+            chunks,
+            seed,
+            estimate_cost(self.tts_model, text),
+            self.tts_model.sample_rate,
+        )
+        job.job_dir.mkdir()
+        torch.save(model_state, job.job_dir / "voice_state.pt")
+        rng_state = torch.Generator().manual_seed(seed).get_state()
+        self._write_checkpoint(job, {"next_chunk": 0, "rng_state": rng_state, "audio_bytes": 0})
+        job.save()
+        with self._lock:
+            self._jobs[job.job_id] = job
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def jobs(self) -> list[Job]:
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: job.created_at)
+
+    def next_job(self) -> Job | None:
+        """The oldest queued job."""
+        return next((job for job in self.jobs() if job.status == "queued"), None)
+
+    def cancel(self, job_id: str) -> Job | None:
+        """Stops the job at its next frame, and deletes its files."""
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job is None:
+            return None
+        if job.status in ("queued", "running"):
+            job.status = "cancelled"
+        shutil.rmtree(job.job_dir, ignore_errors=True)
+        return job
+
+    def _write_checkpoint(self, job: Job, checkpoint: dict):
+        _save_atomically(job.job_dir / "checkpoint.pt", lambda path: torch.save(checkpoint, path))
+
+    def run(self, job: Job, on_start=None):
+        """Generates the remaining chunks of `job`, from its last checkpoint.
+
+        If given, `on_start` receives the `Generation` which pauses and resumes the job.
+        """
+        try:
+            if job.status in ("completed", "cancelled"):
+                return
+            job.status = "running"
+            job.save()
+            if on_start is not None:
+                generation = new_generation()
+                tracked = get_preemption(self.tts_model).track(generation)
+                on_start(generation)
+            else:
+                tracked = nullcontext()
+            with tracked:
+                self._generate(job)
+        except Exception as e:
+            if job.status == "cancelled":
+                return
+            logger.exception("Job %s failed", job.job_id)
+            job.status = "failed"
+            job.error = str(e)
+            job.save()
+
+    def _generate(self, job: Job):
+        checkpoint = torch.load(job.job_dir / "checkpoint.pt")
+        model_state = torch.load(job.job_dir / "voice_state.pt")
+        pcm_path = job.job_dir / "audio.pcm"
+        generator = torch.Generator()
+        with open(pcm_path, "ab") as f:
+            # Drops the audio written after the checkpoint.
+            f.truncate(checkpoint["audio_bytes"])
+            for i in range(checkpoint["next_chunk"], len(job.chunks)):
+                generator.set_state(checkpoint["rng_state"])
+                audio_chunks = metrics.instrument_stream(
+                    self.tts_model.generate_audio_stream(model_state, job.chunks[i]),
+                    self.tts_model.sample_rate,
+                )
+                with get_seeding(self.tts_model).use(generator):
+                    for audio_chunk in audio_chunks:
+                        if job.status == "cancelled":
+                            audio_chunks.close()
+                            return
+                        f.write(
+                            (audio_chunk.clamp(-1, 1) * 32767)
+                            .short()
+                            .detach()
+                            .cpu()
+                            .numpy()
+                            .tobytes()
+                        )
+                f.flush()
+                os.fsync(f.fileno())
+                checkpoint = {
+                    "next_chunk": i + 1,
+                    "rng_state": generator.get_state(),
+                    "audio_bytes": f.tell(),
+                }
+                self._write_checkpoint(job, checkpoint)
+                job.chunks_done = i + 1
+                job.audio_bytes = checkpoint["audio_bytes"]
+                job.save()
+
+        _save_atomically(job.audio_path, partial(_write_wav, pcm_path, job.sample_rate))
+        pcm_path.unlink()
+        job.status = "completed"
+        job.save()
+
+    async def serve(self, admission: AdmissionController, executor=None):
+        """Runs the queued jobs one after the other, each in a generation slot of `admission`.
+
+        The jobs are scheduled with the other requests and can be preempted by them. They run
+        in the threads of `executor` if given, a `pocket_tts.executor.GenerationExecutor`.
+        """
+        run = executor.run if executor is not None else asyncio.to_thread
+        while True:
+            job = self.next_job()
+            if job is None:
+                await asyncio.sleep(JOB_POLL_SECONDS)
+                continue
+            try:
+                ticket = await admission.acquire(
+                    job.job_id, cost=job.cost, client_id=JOBS_CLIENT_ID
+                )
+            except QueueFullError as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except QueueTimeoutError:
+                continue
+            on_start = None
+            if admission.preemption_ratio is not None:
+                on_start = partial(admission.set_preemptible, ticket)
+            try:
+                await run(self.run, job, on_start)
+            finally:
+                admission.release(ticket)
+
+
+def _write_wav(pcm_path: Path, sample_rate: int, wav_path: Path, block_size: int = 1 << 20):
+    with open(pcm_path, "rb") as pcm, wave.open(str(wav_path), "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        while block := pcm.read(block_size):
+            wav_file.writeframes(block)
@@ -1,31 +1,39 @@
-import io
+"""The `pocket-tts` command line.
+
+Each command imports what it needs when it runs, so that `--help` and the commands
+which do not need the web server (or the model) start fast.
+"""
+
 import logging
 import os
-import tempfile
-import threading
+import sys
+from functools import partial
 from pathlib import Path
-from queue import Queue
 
 import typer
-import uvicorn
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
 from typing_extensions import Annotated
 
-from pocket_tts.data.audio import stream_audio_chunks
+from pocket_tts.admission import (
+    DEFAULT_MAX_CONCURRENCY,
+    DEFAULT_MAX_QUEUE_LENGTH,
+    DEFAULT_PREEMPTION_RATIO,
+    DEFAULT_QUEUE_TIMEOUT,
+    DEFAULT_SCHEDULING_POLICY,
+    DEFAULT_STARVATION_SECONDS,
+)
 from pocket_tts.default_parameters import (
     DEFAULT_AUDIO_PROMPT,
     DEFAULT_EOS_THRESHOLD,
     DEFAULT_FRAMES_AFTER_EOS,
     DEFAULT_LSD_DECODE_STEPS,
     DEFAULT_NOISE_CLAMP,
+    DEFAULT_ROWS_PER_TASK,
     DEFAULT_TEMPERATURE,
+    DEFAULT_UTTERANCE_CACHE_DISK_MB,
+    DEFAULT_UTTERANCE_CACHE_MB,
     DEFAULT_VARIANT,
 )
-from pocket_tts.models.tts_model import TTSModel
 from pocket_tts.utils.logging_utils import enable_logging
-from pocket_tts.utils.utils import PREDEFINED_VOICES, size_of_dict
 
 logger = logging.getLogger(__name__)
 
@@ -38,138 +46,6 @@ cli_app = typer.Typer(
 # The pocket-tts server implementation
 # ------------------------------------------------------
 
-# Global model instance
-tts_model = None
-global_model_state = None
-
-web_app = FastAPI(
-    title="Kyutai Pocket TTS API", description="Text-to-Speech generation API", version="1.0.0"
-)
-web_app.add_middleware(
-    CORSMiddleware,
-    allow_origins=[
-        "http://localhost:3000",
-        "https://pod1-10007.internal.kyutai.org",
-        "https://kyutai.org",
-    ],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-
-@web_app.get("/")
-async def root():
-    """Serve the frontend."""
-    static_path = Path(__file__).parent / "static" / "index.html"
-    return FileResponse(static_path)
-
-
-@web_app.get("/health")
-async def health():
-    return {"status": "healthy"}
-
-
-def write_to_queue(queue, text_to_generate, model_state):
-    """Allows writing to the StreamingResponse as if it were a file."""
-
-    class FileLikeToQueue(io.IOBase):
-        def __init__(self, queue):
-            self.queue = queue
-
-        def write(self, data):
-            self.queue.put(data)
-
-        def flush(self):
-            pass
-
-        def close(self):
-            self.queue.put(None)
-
-    audio_chunks = tts_model.generate_audio_stream(
-        model_state=model_state, text_to_generate=text_to_generate
-    )
-    stream_audio_chunks(FileLikeToQueue(queue), audio_chunks, tts_model.config.mimi.sample_rate)
-
-
-def generate_data_with_state(text_to_generate: str, model_state: dict):
-    queue = Queue()
-
-    # Run your function in a thread
-    thread = threading.Thread(target=write_to_queue, args=(queue, text_to_generate, model_state))
-    thread.start()
-
-    # Yield data as it becomes available
-    i = 0
-    while True:
-        data = queue.get()
-        if data is None:
-            break
-        i += 1
-        yield data
-
-    thread.join()
-
-
-@web_app.post("/tts")
-def text_to_speech(
-    text: str = Form(...),
-    voice_url: str | None = Form(None),
-    voice_wav: UploadFile | None = File(None),
-):
-    """
-    Generate speech from text using the pre-loaded voice prompt or a custom voice.
-
-    Args:
-        text: Text to convert to speech
-        voice_url: Optional voice URL (http://, https://, or hf://)
-        voice_wav: Optional uploaded voice file (mutually exclusive with voice_url)
-    """
-    if not text.strip():
-        raise HTTPException(status_code=400, detail="Text cannot be empty")
-
-    if voice_url is not None and voice_wav is not None:
-        raise HTTPException(status_code=400, detail="Cannot provide both voice_url and voice_wav")
-
-    # Use the appropriate model state
-    if voice_url is not None:
-        if not (
-            voice_url.startswith("http://")
-            or voice_url.startswith("https://")
-            or voice_url.startswith("hf://")
-            or voice_url in PREDEFINED_VOICES
-        ):
-            raise HTTPException(
-                status_code=400, detail="voice_url must start with http://, https://, or hf://"
-            )
-        model_state = tts_model._cached_get_state_for_audio_prompt(voice_url, truncate=True)
-        logging.warning("Using voice from URL: %s", voice_url)
-    elif voice_wav is not None:
-        # Use uploaded voice file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_file:
-            content = voice_wav.file.read()
-            temp_file.write(content)
-            temp_file.flush()
-
-            try:
-                model_state = tts_model.get_state_for_audio_prompt(
-                    Path(temp_file.name), truncate=True
-                )
-            finally:
-                os.unlink(temp_file.name)
-    else:
-        # Use default global model state
-        model_state = global_model_state
-
-    return StreamingResponse(
-        generate_data_with_state(text, model_state),
-        media_type="audio/wav",
-        headers={
-            "Content-Disposition": "attachment; filename=generated_speech.wav",
-            "Transfer-Encoding": "chunked",
-        },
-    )
-
 
 @cli_app.command()
 def serve(
@@ -179,17 +55,188 @@ def serve(
     host: Annotated[str, typer.Option(help="Host to bind to")] = "localhost",
     port: Annotated[int, typer.Option(help="Port to bind to")] = 8000,
     reload: Annotated[bool, typer.Option(help="Enable auto-reload")] = False,
+    bundle: Annotated[
+        str | None, typer.Option(help="Bundle written by `pack`, to load the model from")
+    ] = None,
+    warmup: Annotated[
+        bool, typer.Option(help="Synthesize some text before reporting ready on /health")
+    ] = True,
+    warmup_text: Annotated[str | None, typer.Option(help="Text synthesized by the warmup")] = None,
+    max_concurrency: Annotated[
+        int | None,
+        typer.Option(help="Maximum number of generations at once (default: half the CPUs)"),
+    ] = None,
+    max_queue_length: Annotated[
+        int, typer.Option(help="Maximum number of requests waiting for a generation")
+    ] = DEFAULT_MAX_QUEUE_LENGTH,
+    queue_timeout: Annotated[
+        float, typer.Option(help="Maximum time a request waits in the queue, in seconds")
+    ] = DEFAULT_QUEUE_TIMEOUT,
+    scheduling_policy: Annotated[
+        str,
+        typer.Option(
+            help="Order of the waiting requests: fifo, sjf (shortest job first) or fair "
+            "(weighted fair between clients)"
+        ),
+    ] = DEFAULT_SCHEDULING_POLICY,
+    starvation_seconds: Annotated[
+        float, typer.Option(help="Requests waiting longer than this go first, in seconds")
+    ] = DEFAULT_STARVATION_SECONDS,
+    client_weights: Annotated[
+        str, typer.Option(help="Weights of the clients for the fair policy, as 'alice=2,bob=1'")
+    ] = "",
+    preemption_ratio: Annotated[
+        float,
+        typer.Option(
+            help="Pause a running generation for a request this many times cheaper, 0 to never "
+            "preempt"
+        ),
+    ] = DEFAULT_PREEMPTION_RATIO,
+    preemption_spill_dir: Annotated[
+        str | None,
+        typer.Option(help="Directory where the states of the paused generations are saved"),
+    ] = None,
+    jobs_dir: Annotated[
+        str | None, typer.Option(help="Directory of the long-form jobs, enables the /jobs API")
+    ] = None,
+    results_dir: Annotated[
+        str | None,
+        typer.Option(help="Directory of the results of the batches, enables the /batches API"),
+    ] = None,
+    segment_workers: Annotated[
+        int, typer.Option(help="Number of segments of a long text generated at once")
+    ] = 1,
+    low_latency: Annotated[
+        bool,
+        typer.Option(
+            help="Generate the first clause of a text on its own, and adapt the first write "
+            "of the audio to the speed of the generation"
+        ),
+    ] = False,
+    utterance_cache_mb: Annotated[
+        int,
+        typer.Option(
+            help="Size of the cache of the seeded or temperature 0 utterances in RAM, in MB, "
+            "0 to disable it"
+        ),
+    ] = DEFAULT_UTTERANCE_CACHE_MB,
+    utterance_cache_dir: Annotated[
+        str | None,
+        typer.Option(help="Directory where the cached utterances are kept across restarts"),
+    ] = None,
+    utterance_cache_disk_mb: Annotated[
+        int, typer.Option(help="Size of the utterance cache on disk, in MB")
+    ] = DEFAULT_UTTERANCE_CACHE_DISK_MB,
+    coalesce: Annotated[
+        bool,
+        typer.Option(
+            help="Let the identical seeded or temperature 0 requests running at once share one "
+            "generation"
+        ),
+    ] = True,
+    threads_per_worker: Annotated[
+        int | None,
+        typer.Option(
+            help="Torch threads of the process, set once the model is loaded (default: the "
+            "CPUs divided by twice the maximum concurrency)"
+        ),
+    ] = None,
+    pin_cpus: Annotated[
+        bool, typer.Option(help="Pin each running generation to cores of its own (Linux)")
+    ] = False,
+    auto_tune: Annotated[
+        bool,
+        typer.Option(
+            help="Measure the frames per second of a few concurrencies and torch threads per "
+            "generation at startup, and use the best"
+        ),
+    ] = False,
 ):
     """Start the FastAPI server."""
+    import uvicorn
+
+    from pocket_tts import executor, server
+    from pocket_tts.admission import AdmissionController, parse_client_weights
+    from pocket_tts.preemption import SPILL_DIR_ENV
+    from pocket_tts.utils.utils import size_of_dict
+
+    if bundle is not None:
+        from pocket_tts.bundle import load_model_from_bundle
+
+        tts_model = load_model_from_bundle(
+            bundle,
+            DEFAULT_TEMPERATURE,
+            DEFAULT_LSD_DECODE_STEPS,
+            DEFAULT_NOISE_CLAMP,
+            DEFAULT_EOS_THRESHOLD,
+        )
+    else:
+        from pocket_tts.variants import load_model
 
-    global tts_model, global_model_state
-    tts_model = TTSModel.load_model(DEFAULT_VARIANT)
+        tts_model = load_model(DEFAULT_VARIANT)
 
     # Pre-load the voice prompt
     global_model_state = tts_model.get_state_for_audio_prompt(voice)
     logger.info(f"The size of the model state is {size_of_dict(global_model_state) // 1e6} MB")
+    server.tts_model = tts_model
+    server.global_model_state = global_model_state
+    server.segment_workers = segment_workers
+    server.low_latency = low_latency
+    server.model_identity = bundle or DEFAULT_VARIANT
+    server.default_voice_identity = voice
+    if utterance_cache_mb > 0:
+        from pocket_tts.utterance_cache import UtteranceCache
+
+        server.utterance_cache = UtteranceCache(
+            utterance_cache_mb * 1024 * 1024,
+            utterance_cache_dir,
+            utterance_cache_disk_mb * 1024 * 1024,
+        )
+    if not coalesce:
+        server.single_flight = None
+    if auto_tune:
+        # Keeps the maximum concurrency if given.
+        with enable_logging("pocket_tts", logging.INFO):
+            max_concurrency, threads_per_worker = executor.auto_tune(
+                tts_model, global_model_state, max_concurrency, pin_cpus
+            )
+    max_concurrency = max_concurrency or DEFAULT_MAX_CONCURRENCY
+    # The generations paused by preemption keep their threads.
+    server.generation_executor = executor.GenerationExecutor(
+        max_concurrency, threads_per_worker, pin_cpus, max_concurrency + max_queue_length
+    )
+    server.admission = AdmissionController(
+        max_concurrency,
+        max_queue_length,
+        queue_timeout,
+        scheduling_policy,
+        starvation_seconds,
+        parse_client_weights(client_weights),
+        preemption_ratio or None,
+    )
+    if preemption_spill_dir is not None:
+        os.environ[SPILL_DIR_ENV] = preemption_spill_dir
+    if jobs_dir is not None:
+        from pocket_tts.jobs import JobManager
+
+        server.jobs = JobManager(jobs_dir, tts_model)
+    if results_dir is not None:
+        from pocket_tts.batches import BatchManager
+
+        server.batches = BatchManager(
+            results_dir,
+            server.synthesize_batch_item,
+            server.estimate_batch_item_cost,
+            tts_model.sample_rate,
+        )
+    if not warmup:
+        server.warmup_text = None
+    elif warmup_text is not None:
+        server.warmup_text = warmup_text
 
-    uvicorn.run("pocket_tts.main:web_app", host=host, port=port, reload=reload)
+    # The warmup and the profiles of requests are logged.
+    with enable_logging("pocket_tts", logging.INFO):
+        uvicorn.run("pocket_tts.server:web_app", host=host, port=port, reload=reload)
 
 
 # ------------------------------------------------------
@@ -222,28 +269,121 @@ def generate(
         str, typer.Option(help="Output path for generated audio")
     ] = "./tts_output.wav",
     device: Annotated[str, typer.Option(help="Device to use")] = "cpu",
+    onnx_dir: Annotated[
+        str | None,
+        typer.Option(help="Directory written by `export-onnx`, to generate with onnxruntime"),
+    ] = None,
+    bundle: Annotated[
+        str | None, typer.Option(help="Bundle written by `pack`, to load the model from")
+    ] = None,
+    profile: Annotated[
+        bool, typer.Option(help="Log the time spent in each module of the model")
+    ] = False,
+    batch: Annotated[
+        str | None,
+        typer.Option(
+            help="JSONL file of texts to generate ('-' for stdin), each line with its text, "
+            "voice and parameters"
+        ),
+    ] = None,
+    output_dir: Annotated[
+        str, typer.Option(help="Directory of the audio files generated by --batch")
+    ] = "./tts_outputs",
+    num_workers: Annotated[
+        int, typer.Option(help="Number of processes generating the --batch rows")
+    ] = 1,
+    rows_per_task: Annotated[
+        int, typer.Option(help="Number of --batch rows sent to a process at once")
+    ] = DEFAULT_ROWS_PER_TASK,
+    segment_workers: Annotated[
+        int, typer.Option(help="Number of segments of a long text generated at once")
+    ] = 1,
+    low_latency: Annotated[
+        bool,
+        typer.Option(
+            help="Generate the first clause of the text on its own, and adapt the first write "
+            "of the audio to the speed of the generation"
+        ),
+    ] = False,
 ):
     """Generate speech using Kyutai Pocket TTS."""
     if "cuda" in device:
         # Cuda graphs capturing does not play nice with multithreading.
         os.environ["NO_CUDA_GRAPH"] = "1"
 
+    if onnx_dir is not None and (batch is not None or segment_workers > 1):
+        raise typer.BadParameter("--batch and --segment-workers do not support --onnx-dir")
+    if batch is not None:
+        _generate_batch(
+            batch,
+            output_dir,
+            num_workers,
+            rows_per_task,
+            (variant, bundle, device, temperature, lsd_decode_steps, noise_clamp, eos_threshold),
+            voice,
+            logging.ERROR if quiet else logging.INFO,
+        )
+        return
+
+    from pocket_tts.data.audio import (
+        FIRST_CHUNK_LENGTH_SECONDS,
+        estimate_speech_seconds,
+        stream_audio_chunks,
+    )
+    from pocket_tts.utils.profiling import profile_generation
+
     log_level = logging.ERROR if quiet else logging.INFO
     with enable_logging("pocket_tts", log_level):
-        tts_model = TTSModel.load_model(
-            variant, temperature, lsd_decode_steps, noise_clamp, eos_threshold
-        )
-        tts_model.to(device)
+        if onnx_dir is not None:
+            from pocket_tts.export.runtime import OnnxTTSModel
+
+            tts_model = OnnxTTSModel(
+                onnx_dir, temperature, lsd_decode_steps, noise_clamp, eos_threshold
+            )
+        else:
+            if bundle is not None:
+                from pocket_tts.bundle import load_model_from_bundle
+
+                tts_model = load_model_from_bundle(
+                    bundle, temperature, lsd_decode_steps, noise_clamp, eos_threshold
+                )
+            else:
+                from pocket_tts.variants import load_model
+
+                tts_model = load_model(
+                    variant, temperature, lsd_decode_steps, noise_clamp, eos_threshold
+                )
+            tts_model.to(device)
 
         model_state_for_voice = tts_model.get_state_for_audio_prompt(voice)
         # Stream audio generation directly to file or stdout
-        audio_chunks = tts_model.generate_audio_stream(
-            model_state=model_state_for_voice,
-            text_to_generate=text,
-            frames_after_eos=frames_after_eos,
-        )
+        if onnx_dir is not None:
+            # The WAV writer takes the numpy chunks as they are.
+            audio_chunks = tts_model.generate_audio_stream(
+                model_state=model_state_for_voice,
+                text_to_generate=text,
+                frames_after_eos=frames_after_eos,
+            )
+        else:
+            from pocket_tts.parallel import generate_parallel_audio_stream
+
+            audio_chunks = generate_parallel_audio_stream(
+                tts_model,
+                model_state_for_voice,
+                text,
+                segment_workers,
+                first_clause=low_latency,
+                frames_after_eos=frames_after_eos,
+            )
 
-        stream_audio_chunks(output_path, audio_chunks, tts_model.config.mimi.sample_rate)
+        with profile_generation(tts_model, profile):
+            stream_audio_chunks(
+                output_path,
+                audio_chunks,
+                tts_model.sample_rate,
+                None if low_latency else FIRST_CHUNK_LENGTH_SECONDS,
+                estimate_speech_seconds(text),
+            )
 
         # Only print the result message if not writing to stdout
         if output_path != "-":
@@ -257,5 +397,150 @@ def generate(
         )
 
 
+def _generate_batch(
+    batch: str,
+    output_dir: str,
+    num_workers: int,
+    rows_per_task: int,
+    model_args: tuple,
+    default_voice: str,
+    log_level: int,
+):
+    from pocket_tts.offline import load_tts_model, read_rows, run_batch
+
+    with enable_logging("pocket_tts", log_level):
+        try:
+            if batch == "-":
+                rows = read_rows(sys.stdin, default_voice)
+            else:
+                with open(batch) as f:
+                    rows = read_rows(f, default_voice)
+        except ValueError as e:
+            raise typer.BadParameter(str(e), param_hint="--batch") from e
+        if not rows:
+            raise typer.BadParameter("The batch has no rows.", param_hint="--batch")
+        summary = run_batch(
+            rows,
+            partial(load_tts_model, *model_args),
+            output_dir,
+            num_workers,
+            rows_per_task,
+            log_level,
+        )
+        logger.info(
+            "%d rows generated in %.1f s (%d failed), %.1f rows/s, %.1f seconds of audio per "
+            "second",
+            summary["rows_done"],
+            summary["wall_seconds"],
+            summary["rows_failed"],
+            summary["rows_per_second"],
+            summary["audio_seconds_per_second"],
+        )
+        logger.info("Results written in %s", output_dir)
+    if summary["rows_failed"]:
+        raise typer.Exit(1)
+
+
+# ------------------------------------------------------
+# Export to ONNX
+# ------------------------------------------------------
+
+
+@cli_app.command()
+def export_onnx(
+    output_dir: Annotated[
+        str, typer.Option(help="Directory to write the ONNX graphs to")
+    ] = "./pocket_tts_onnx",
+    variant: Annotated[str, typer.Option(help="Model signature")] = DEFAULT_VARIANT,
+    include_voices: Annotated[
+        bool, typer.Option(help="Also copy the predefined voices in the output directory")
+    ] = True,
+    quiet: Annotated[bool, typer.Option("-q", "--quiet", help="Disable logging output")] = False,
+):
+    """Export the model to per-step ONNX graphs, to run it without PyTorch."""
+    from pocket_tts.export.graphs import export_onnx as export_onnx_graphs
+    from pocket_tts.variants import load_model
+
+    log_level = logging.ERROR if quiet else logging.INFO
+    with enable_logging("pocket_tts", log_level):
+        tts_model = load_model(variant)
+        export_onnx_graphs(tts_model, output_dir, include_voices=include_voices)
+        logger.info("Use it with `pocket-tts generate --onnx-dir %s`", output_dir)
+
+
+# ------------------------------------------------------
+# Single-file bundle
+# ------------------------------------------------------
+
+
+@cli_app.command()
+def pack(
+    output_path: Annotated[
+        str, typer.Option(help="Path of the bundle to write")
+    ] = "./pocket_tts.bundle",
+    variant: Annotated[str, typer.Option(help="Model signature")] = DEFAULT_VARIANT,
+    quiet: Annotated[bool, typer.Option("-q", "--quiet", help="Disable logging output")] = False,
+):
+    """Pack the weights, tokenizer and voices of a model in a single file, for fast startup."""
+    from pocket_tts.bundle import pack_bundle
+    from pocket_tts.utils.config import load_config
+
+    log_level = logging.ERROR if quiet else logging.INFO
+    with enable_logging("pocket_tts", log_level):
+        config = load_config(Path(__file__).parent / f"config/{variant}.yaml")
+        pack_bundle(config, output_path)
+        logger.info("Use it with `pocket-tts generate --bundle %s`", output_path)
+
+
+@cli_app.command()
+def bench(
+    output_path: Annotated[
+        str, typer.Option(help="Path of the JSON results to write")
+    ] = "./bench_results.json",
+    lsd_decode_steps: Annotated[
+        list[int] | None, typer.Option(help="Numbers of generation steps to benchmark, repeatable")
+    ] = None,
+    num_threads: Annotated[
+        list[int] | None, typer.Option(help="Numbers of torch threads to benchmark, repeatable")
+    ] = None,
+    batch_size: Annotated[
+        list[int] | None,
+        typer.Option(help="Numbers of concurrent generations to benchmark, repeatable"),
+    ] = None,
+    variant: Annotated[str, typer.Option(help="Model signature")] = DEFAULT_VARIANT,
+    bundle: Annotated[
+        str | None, typer.Option(help="Bundle written by `pack`, to load the model from")
+    ] = None,
+    quiet: Annotated[bool, typer.Option("-q", "--quiet", help="Disable logging output")] = False,
+):
+    """Benchmark the real-time factor, latency and memory of the generation."""
+    from pocket_tts.bench import run_benchmark, write_results
+
+    lsd_decode_steps = lsd_decode_steps or [DEFAULT_LSD_DECODE_STEPS]
+    num_threads = num_threads or [1]
+    batch_size = batch_size or [1]
+
+    log_level = logging.ERROR if quiet else logging.INFO
+    with enable_logging("pocket_tts", log_level):
+        if bundle is not None:
+            from pocket_tts.bundle import load_model_from_bundle
+
+            tts_model = load_model_from_bundle(
+                bundle,
+                DEFAULT_TEMPERATURE,
+                DEFAULT_LSD_DECODE_STEPS,
+                DEFAULT_NOISE_CLAMP,
+                DEFAULT_EOS_THRESHOLD,
+            )
+        else:
+            from pocket_tts.variants import load_model
+
+            tts_model = load_model(variant)
+
+        results = run_benchmark(tts_model, lsd_decode_steps, num_threads, batch_size)
+        write_results(results, output_path)
+        logger.info("Results written in %s", output_path)
+
+
 if __name__ == "__main__":
     cli_app()
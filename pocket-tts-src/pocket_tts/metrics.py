@@ -0,0 +1,267 @@
+"""Metrics of the servers, exposed in the Prometheus text format on `/metrics`.
+
+The metrics are recorded by `instrument_stream`, which wraps the audio stream of each
+request, and by the request handlers. The few metric types needed are implemented here,
+so that serving does not need another dependency.
+"""
+
+import math
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+
+import torch
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def collect(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {_format_value(self.value)}",
+        ]
+
+
+class Gauge:
+    """A value that goes up and down, or is computed by a function at each scrape."""
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0.0
+        self._function: Callable[[], float] | None = None
+        self._lock = threading.Lock()
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]):
+        self._function = function
+
+    def get(self) -> float:
+        return float(self._function()) if self._function is not None else self.value
+
+    def collect(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {_format_value(self.get())}",
+        ]
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = (*sorted(buckets), math.inf)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    self.bucket_counts[i] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            cumulative_count = 0
+            for upper_bound, count in zip(self.buckets, self.bucket_counts):
+                cumulative_count += count
+                lines.append(
+                    f'{self.name}_bucket{{le="{_format_value(upper_bound)}"}} {cumulative_count}'
+                )
+            lines.append(f"{self.name}_sum {_format_value(self.sum)}")
+            lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self) -> str:
+        """All the metrics, in the Prometheus text format."""
+        return "\n".join(line for metric in self.metrics for line in metric.collect()) + "\n"
+
+
+REGISTRY = Registry()
+
+TIME_TO_FIRST_AUDIO = REGISTRY.register(
+    Histogram(
+        "pocket_tts_time_to_first_audio_seconds",
+        "Time from the start of a generation to its first audio chunk.",
+        (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0, 5.0, 10.0),
+    )
+)
+GENERATION_SECONDS = REGISTRY.register(
+    Histogram(
+        "pocket_tts_generation_seconds",
+        "Total time of a completed generation.",
+        (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0),
+    )
+)
+REAL_TIME_FACTOR = REGISTRY.register(
+    Histogram(
+        "pocket_tts_real_time_factor",
+        "Generation time divided by the duration of the generated audio.",
+        (0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0),
+    )
+)
+FRAMES_PER_REQUEST = REGISTRY.register(
+    Histogram(
+        "pocket_tts_frames_per_request",
+        "Number of audio frames generated by a completed generation.",
+        (10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0, 2500.0),
+    )
+)
+ACTIVE_GENERATIONS = REGISTRY.register(
+    Gauge("pocket_tts_active_generations", "Number of generations running.")
+)
+QUEUE_DEPTH = REGISTRY.register(
+    Gauge("pocket_tts_queue_depth", "Number of accepted requests waiting for their generation.")
+)
+VOICE_CACHE_BYTES = REGISTRY.register(
+    Gauge("pocket_tts_voice_cache_bytes", "Memory used by the preloaded voice states.")
+)
+VOICE_CACHE_HITS = REGISTRY.register(
+    Counter("pocket_tts_voice_cache_hits_total", "Voice states found in a cache.")
+)
+VOICE_CACHE_MISSES = REGISTRY.register(
+    Counter("pocket_tts_voice_cache_misses_total", "Voice states computed for a request.")
+)
+VOICE_CACHE_HIT_RATIO = REGISTRY.register(
+    Gauge("pocket_tts_voice_cache_hit_ratio", "Fraction of the voice lookups found in a cache.")
+)
+VOICE_CACHE_HIT_RATIO.set_function(
+    lambda: VOICE_CACHE_HITS.value / max(VOICE_CACHE_HITS.value + VOICE_CACHE_MISSES.value, 1)
+)
+UTTERANCE_CACHE_HITS = REGISTRY.register(
+    Counter(
+        "pocket_tts_utterance_cache_hits_total",
+        "Requests answered from the utterance cache, in RAM or on disk.",
+    )
+)
+UTTERANCE_CACHE_DISK_HITS = REGISTRY.register(
+    Counter(
+        "pocket_tts_utterance_cache_disk_hits_total",
+        "Requests answered from the disk tier of the utterance cache.",
+    )
+)
+UTTERANCE_CACHE_MISSES = REGISTRY.register(
+    Counter(
+        "pocket_tts_utterance_cache_misses_total",
+        "Deterministic requests not found in the utterance cache.",
+    )
+)
+UTTERANCE_CACHE_HIT_RATIO = REGISTRY.register(
+    Gauge(
+        "pocket_tts_utterance_cache_hit_ratio",
+        "Fraction of the deterministic requests answered from the utterance cache.",
+    )
+)
+UTTERANCE_CACHE_HIT_RATIO.set_function(
+    lambda: (
+        UTTERANCE_CACHE_HITS.value
+        / max(UTTERANCE_CACHE_HITS.value + UTTERANCE_CACHE_MISSES.value, 1)
+    )
+)
+UTTERANCE_CACHE_BYTES = REGISTRY.register(
+    Gauge("pocket_tts_utterance_cache_bytes", "Memory used by the utterance cache.")
+)
+COALESCED_REQUESTS = REGISTRY.register(
+    Counter(
+        "pocket_tts_coalesced_requests_total",
+        "Requests which streamed the audio of an identical request running at once.",
+    )
+)
+CANCELLATIONS = REGISTRY.register(
+    Counter("pocket_tts_cancellations_total", "Generations stopped before their end.")
+)
+ERRORS = REGISTRY.register(Counter("pocket_tts_errors_total", "Generations which failed."))
+
+
+def record_voice_lookup(hit: bool):
+    (VOICE_CACHE_HITS if hit else VOICE_CACHE_MISSES).inc()
+
+
+def cached_voice_state(tts_model, voice, **kwargs) -> dict:
+    """`tts_model._cached_get_state_for_audio_prompt`, recording whether the cache was hit."""
+    cache_info = getattr(tts_model._cached_get_state_for_audio_prompt, "cache_info", None)
+    hits_before = cache_info().hits if cache_info is not None else 0
+    model_state = tts_model._cached_get_state_for_audio_prompt(voice, **kwargs)
+    record_voice_lookup(cache_info is not None and cache_info().hits > hits_before)
+    return model_state
+
+
+def instrument_stream(
+    audio_chunks: Iterable[torch.Tensor], sample_rate: int
+) -> Iterator[torch.Tensor]:
+    """Yields the chunks of `audio_chunks` (one per frame), recording the generation metrics.
+
+    Closing the returned generator before the end counts as a cancellation.
+    """
+    ACTIVE_GENERATIONS.inc()
+    start = time.monotonic()
+    num_frames = 0
+    num_samples = 0
+    try:
+        for chunk in audio_chunks:
+            if num_frames == 0:
+                TIME_TO_FIRST_AUDIO.observe(time.monotonic() - start)
+            num_frames += 1
+            num_samples += chunk.shape[-1]
+            yield chunk
+    except GeneratorExit:
+        CANCELLATIONS.inc()
+        # Stops the generation itself.
+        if hasattr(audio_chunks, "close"):
+            audio_chunks.close()
+        raise
+    except Exception:
+        ERRORS.inc()
+        raise
+    else:
+        elapsed = time.monotonic() - start
+        GENERATION_SECONDS.observe(elapsed)
+        FRAMES_PER_REQUEST.observe(float(num_frames))
+        if num_samples > 0:
+            REAL_TIME_FACTOR.observe(elapsed / (num_samples / sample_rate))
+    finally:
+        ACTIVE_GENERATIONS.dec()
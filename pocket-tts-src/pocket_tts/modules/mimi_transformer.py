@@ -84,7 +84,7 @@ class MimiStreamingMultiheadAttention(StatefulModule):
         state["end_offset"] = torch.zeros(batch_size, dtype=torch.long)
         return state
 
-    def increment_step(self, state, increment: int = 1):
+    def increment_step(self, state, increment: int | torch.Tensor = 1):
         state["offset"] += increment
 
     def _complete_kv(self, k, v, model_state: dict | None) -> KVCacheResult:
@@ -18,7 +18,9 @@ def init_states(
 
 
 def increment_steps(
-    module: nn.Module, model_state: dict[str, dict[str, torch.Tensor]], increment: int = 1
+    module: nn.Module,
+    model_state: dict[str, dict[str, torch.Tensor]],
+    increment: int | torch.Tensor = 1,
 ):
     # print("incrementing steps by", increment)
     for module_name, module in module.named_modules():
@@ -37,7 +39,7 @@ class StatefulModule(ABC, nn.Module):
         """Initialize the state."""
         raise NotImplementedError
 
-    def increment_step(self, state: dict, increment: int = 1):
+    def increment_step(self, state: dict, increment: int | torch.Tensor = 1):
         pass
 
     def get_state(self, model_state: dict[str, dict[str, torch.Tensor]]) -> dict[str, torch.Tensor]:
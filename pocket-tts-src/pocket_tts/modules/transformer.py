@@ -18,17 +18,17 @@ def complete_kv(
 
 
 def _materialize_causal_mask(
-    shape: tuple[int, ...], shift: int, device: str | torch.device = "cpu"
+    num_queries: int | torch.Tensor,
+    num_keys: int | torch.Tensor,
+    device: str | torch.device = "cpu",
 ) -> torch.Tensor:
-    dtype = torch.float32
-
-    num_queries, num_keys = shape[-2:]
+    # The mask is built from positions rather than with `torch.tril` so that it stays
+    # correct when the sizes are traced, e.g. when exporting a streaming step to ONNX.
     shift = num_keys - num_queries
-
-    tensor = torch.full(shape, dtype=dtype, fill_value=1, device=device)
-    mask = torch.tril(tensor, diagonal=shift).to(dtype)
-    mask = torch.log(mask)
-    return mask.to(dtype)
+    query_positions = torch.arange(num_queries, device=device).view(-1, 1) + shift
+    key_positions = torch.arange(num_keys, device=device).view(1, -1)
+    zero = torch.zeros((), dtype=torch.float32, device=device)
+    return torch.where(key_positions <= query_positions, zero, zero - float("inf"))
 
 
 class StreamingMultiheadAttention(StatefulModule):
@@ -59,8 +59,10 @@ class StreamingMultiheadAttention(StatefulModule):
         self.in_proj = nn.Linear(embed_dim, mult * out_dim, bias=False)
         self.out_proj = nn.Linear(embed_dim, mult * embed_dim, bias=False)
 
-    def _get_mask(self, shape: tuple[int, int], shift: int, device: torch.device) -> torch.Tensor:
-        return _materialize_causal_mask(shape, shift=shift, device=device)
+    def _get_mask(
+        self, num_queries: int | torch.Tensor, num_keys: int | torch.Tensor, device: torch.device
+    ) -> torch.Tensor:
+        return _materialize_causal_mask(num_queries, num_keys, device=device)
 
     def init_state(self, batch_size: int, sequence_length: int) -> dict[str, torch.Tensor]:
         dim_per_head = self.embed_dim // self.num_heads
@@ -75,7 +77,7 @@ class StreamingMultiheadAttention(StatefulModule):
             ),
         )
 
-    def increment_step(self, state: dict, increment: int = 1):
+    def increment_step(self, state: dict, increment: int | torch.Tensor = 1):
         new_size = state["current_end"].shape[0] + increment
         state["current_end"] = torch.zeros((new_size,)).to(state["current_end"].device)
 
@@ -108,10 +110,9 @@ class StreamingMultiheadAttention(StatefulModule):
         q, k = self._apply_rope(q, k, state)
         k, v = self._complete_kv(k, v, state)
 
-        mask_shape = (query.shape[1], query.shape[1] + state["current_end"].shape[0])
-        shift = state["current_end"].shape[0]
-
-        attn_mask = self._get_mask(mask_shape, shift=shift, device=q.device)
+        num_queries = query.shape[1]
+        num_keys = num_queries + state["current_end"].shape[0]
+        attn_mask = self._get_mask(num_queries, num_keys, device=q.device)
 
         q, k, v = [x.transpose(1, 2) for x in (q, k, v)]
         x = F.scaled_dot_product_attention(q, k, v, attn_mask)
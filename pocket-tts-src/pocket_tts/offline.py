@@ -0,0 +1,260 @@
+"""Offline generation of many texts, see `pocket-tts generate --batch`.
+
+Calling `pocket-tts generate` once per text loads the model and computes the state of the
+voice every time. In batch mode, the texts are read as JSON lines, each an object with a
+"text" and optionally its "voice", "output" file and generation parameters (see
+`ROW_PARAMETERS`). The rows are sorted by voice and grouped in tasks of `rows_per_task`
+rows, run by a pool of `num_workers` processes. Each process loads the model once, keeps
+the state of each voice it has seen, and writes the WAV files of its rows, so the files are
+written in parallel too.
+
+The results of the rows are written to `manifest.jsonl` in the output directory.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import time
+import wave
+from collections.abc import Callable, Iterable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+
+from pocket_tts.default_parameters import DEFAULT_ROWS_PER_TASK
+from pocket_tts.utils.logging_utils import enable_logging
+
+logger = logging.getLogger(__name__)
+
+# Generation parameters of a row, and the attribute of the model they set.
+ROW_PARAMETERS = {
+    "temperature": "temp",
+    "lsd_decode_steps": "lsd_decode_steps",
+    "noise_clamp": "noise_clamp",
+    "eos_threshold": "eos_threshold",
+}
+# Seconds between two progress logs.
+PROGRESS_LOG_SECONDS = 5.0
+
+
+def load_tts_model(
+    variant: str,
+    bundle: str | None,
+    device: str,
+    temperature: float,
+    lsd_decode_steps: int,
+    noise_clamp: float | None,
+    eos_threshold: float,
+):
+    """The model of `pocket-tts generate`, from `bundle` if given."""
+    if bundle is not None:
+        from pocket_tts.bundle import load_model_from_bundle
+
+        tts_model = load_model_from_bundle(
+            bundle, temperature, lsd_decode_steps, noise_clamp, eos_threshold
+        )
+    else:
+        from pocket_tts.variants import load_model
+
+        tts_model = load_model(variant, temperature, lsd_decode_steps, noise_clamp, eos_threshold)
+    return tts_model.to(device)
+
+
+def read_rows(lines: Iterable[str], default_voice: str) -> list[dict]:
+    """Parses the JSON lines of a batch, skipping the blank ones.
+
+    Each row gets its "index" (its number among the rows), its "voice" and its "output"
+    file name, "00000.wav", "00001.wav", ... unless given.
+    """
+    rows = []
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {line_number} is not valid JSON: {e}") from e
+        text = row.get("text") if isinstance(row, dict) else None
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError(f"Line {line_number} needs to be an object with a non-empty text.")
+        unknown = set(row) - {"text", "voice", "output", "frames_after_eos", *ROW_PARAMETERS}
+        if unknown:
+            raise ValueError(f"Line {line_number} has unknown keys: {sorted(unknown)}")
+        index = len(rows)
+        rows.append(
+            {
+                **row,
+                "index": index,
+                "voice": row.get("voice") or default_voice,
+                "output": row.get("output") or f"{index:05d}.wav",
+            }
+        )
+    return rows
+
+
+def split_tasks(rows: list[dict], rows_per_task: int) -> list[list[dict]]:
+    """Groups the rows with the same voice, so that a worker computes fewer voice states."""
+    rows = sorted(rows, key=lambda row: row["voice"])
+    return [rows[i : i + rows_per_task] for i in range(0, len(rows), rows_per_task)]
+
+
+@contextmanager
+def _row_parameters(tts_model, row: dict):
+    previous = {attribute: getattr(tts_model, attribute) for attribute in ROW_PARAMETERS.values()}
+    try:
+        for key, attribute in ROW_PARAMETERS.items():
+            if row.get(key) is not None:
+                setattr(tts_model, attribute, row[key])
+        yield
+    finally:
+        for attribute, value in previous.items():
+            setattr(tts_model, attribute, value)
+
+
+class BatchWorker:
+    """Generates rows with one model, keeping the state of each voice."""
+
+    def __init__(self, tts_model, output_dir: str | Path):
+        self.tts_model = tts_model
+        self.output_dir = Path(output_dir)
+        self.voice_states: dict[str, dict] = {}
+
+    def generate_row(self, row: dict) -> dict:
+        """Writes the audio of `row` to its output file, returns its result for the manifest."""
+        output_path = self.output_dir / row["output"]
+        start = time.monotonic()
+        num_samples = 0
+        try:
+            if row["voice"] not in self.voice_states:
+                self.voice_states[row["voice"]] = self.tts_model.get_state_for_audio_prompt(
+                    row["voice"]
+                )
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            with _row_parameters(self.tts_model, row):
+                audio_chunks = self.tts_model.generate_audio_stream(
+                    model_state=self.voice_states[row["voice"]],
+                    text_to_generate=row["text"],
+                    frames_after_eos=row.get("frames_after_eos"),
+                )
+                with wave.open(str(output_path), "wb") as wav_file:
+                    wav_file.setnchannels(1)
+                    wav_file.setsampwidth(2)
+                    wav_file.setframerate(self.tts_model.sample_rate)
+                    for chunk in audio_chunks:
+                        chunk_int16 = (chunk.clamp(-1, 1) * 32767).short()
+                        wav_file.writeframes(chunk_int16.detach().cpu().numpy().tobytes())
+                        num_samples += chunk.shape[-1]
+        except Exception as e:
+            logger.exception("Row %d failed", row["index"])
+            output_path.unlink(missing_ok=True)
+            return {
+                "index": row["index"],
+                "output": None,
+                "audio_seconds": 0.0,
+                "generation_seconds": time.monotonic() - start,
+                "error": str(e),
+            }
+        return {
+            "index": row["index"],
+            "output": row["output"],
+            "audio_seconds": num_samples / self.tts_model.sample_rate,
+            "generation_seconds": time.monotonic() - start,
+            "error": None,
+        }
+
+    def generate_rows(self, rows: list[dict]) -> list[dict]:
+        return [self.generate_row(row) for row in rows]
+
+
+# The worker of each process of the pool.
+_worker: BatchWorker | None = None
+
+
+def _init_worker(load_model: Callable, output_dir: str, num_threads: int, log_level: int):
+    global _worker
+    torch.set_num_threads(num_threads)
+    with enable_logging("pocket_tts", log_level):
+        _worker = BatchWorker(load_model(), output_dir)
+
+
+def _generate_rows(rows: list[dict], log_level: int) -> list[dict]:
+    with enable_logging("pocket_tts", log_level):
+        return _worker.generate_rows(rows)
+
+
+class _Progress:
+    def __init__(self, num_rows: int):
+        self.num_rows = num_rows
+        self.results = []
+        self.start = time.monotonic()
+        self.logged_at = self.start
+
+    def add(self, results: list[dict]):
+        self.results.extend(results)
+        now = time.monotonic()
+        if now - self.logged_at >= PROGRESS_LOG_SECONDS or len(self.results) == self.num_rows:
+            self.logged_at = now
+            summary = self.summary()
+            logger.info(
+                "%d/%d rows, %.1f rows/s, %.1f seconds of audio per second",
+                summary["rows_done"],
+                self.num_rows,
+                summary["rows_per_second"],
+                summary["audio_seconds_per_second"],
+            )
+
+    def summary(self) -> dict:
+        wall_time = time.monotonic() - self.start
+        audio_seconds = sum(result["audio_seconds"] for result in self.results)
+        return {
+            "rows_done": len(self.results),
+            "rows_failed": sum(result["error"] is not None for result in self.results),
+            "audio_seconds": audio_seconds,
+            "wall_seconds": wall_time,
+            "rows_per_second": len(self.results) / wall_time,
+            "audio_seconds_per_second": audio_seconds / wall_time,
+        }
+
+
+def run_batch(
+    rows: list[dict],
+    load_model: Callable,
+    output_dir: str | Path,
+    num_workers: int = 1,
+    rows_per_task: int = DEFAULT_ROWS_PER_TASK,
+    log_level: int = logging.INFO,
+) -> dict:
+    """Generates `rows` (from `read_rows`) into `output_dir`, returns a summary of the run.
+
+    `load_model` is called once per worker, and must be picklable when `num_workers` is above
+    1. With one worker, the rows are generated in this process.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    tasks = split_tasks(rows, rows_per_task)
+    progress = _Progress(len(rows))
+    if num_workers == 1:
+        worker = BatchWorker(load_model(), output_dir)
+        for task in tasks:
+            progress.add(worker.generate_rows(task))
+    else:
+        # The torch threads of the workers share the cores.
+        num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        # Forking a process which already runs torch threads can deadlock.
+        with ProcessPoolExecutor(
+            num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(load_model, str(output_dir), num_threads, log_level),
+        ) as pool:
+            futures = [pool.submit(_generate_rows, task, log_level) for task in tasks]
+            for future in as_completed(futures):
+                progress.add(future.result())
+
+    results = sorted(progress.results, key=lambda result: result["index"])
+    with open(output_dir / "manifest.jsonl", "w") as f:
+        f.writelines(json.dumps({**rows[result["index"]], **result}) + "\n" for result in results)
+    return progress.summary()
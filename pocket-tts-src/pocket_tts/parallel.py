@@ -0,0 +1,170 @@
+"""Generation of long texts with several segments at once.
+
+`TTSModel.generate_audio_stream` splits a text into chunks of sentences and generates them
+one after the other, each from a copy of the state of the voice, so the chunks do not depend
+on each other. `generate_parallel_audio_stream` splits the text the same way (never across
+paragraphs) and generates the segments in a pool of worker threads, each from its own copy of
+the state. The audio of the first segment is yielded as soon as it is decoded, the next
+segments are buffered until their turn, and consecutive segments are joined with a short
+crossfade.
+
+With `num_workers` workers, a long text is generated up to `num_workers` times faster when
+the cores are free, at the cost of more memory (one model state and audio buffer per
+segment in flight). The outputs differ from a sequential generation when the temperature is
+above 0. With a `generator`, each segment draws its noise from a generator of its own seeded
+from it (see `pocket_tts.seeding`), so the output does not depend on the order in which the
+workers run; without one, the segments draw from the shared torch RNG.
+
+With `first_clause`, the first clause of the text (up to its first comma, semicolon, colon
+or dash) is a segment of its own, even with one worker. Its prompt is shorter and its audio
+comes sooner, while the rest of the text is generated after it, or along with it.
+"""
+
+import logging
+import threading
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractContextManager, nullcontext
+from queue import Queue
+
+import torch
+from beartype.typing import Iterator
+
+from pocket_tts.jobs import split_text
+from pocket_tts.seeding import get_seeding, split_generator
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CROSSFADE_SECONDS = 0.02
+# Shorter clauses are not split from the rest of their sentence, the model needs some context.
+MIN_CLAUSE_WORDS = 4
+CLAUSE_ENDS = (",", ";", ":", " -", "\u2014")
+
+
+def split_first_clause(segment: str) -> list[str]:
+    """`segment` split after its first clause of at least `MIN_CLAUSE_WORDS` words."""
+    words = segment.split(" ")
+    for i in range(MIN_CLAUSE_WORDS - 1, len(words) - MIN_CLAUSE_WORDS):
+        clause = " ".join(words[: i + 1])
+        if clause.endswith(CLAUSE_ENDS) and len(clause.split()) >= MIN_CLAUSE_WORDS:
+            return [clause, " ".join(words[i + 1 :])]
+    return [segment]
+
+
+def split_segments(tts_model, text: str, first_clause: bool = False) -> list[str]:
+    """The chunks of `split_text` for each paragraph of `text`."""
+    paragraphs = [paragraph for paragraph in text.split("\n\n") if paragraph.strip()]
+    segments = [segment for paragraph in paragraphs for segment in split_text(tts_model, paragraph)]
+    if first_clause and segments:
+        segments[:1] = split_first_clause(segments[0])
+    return segments
+
+
+def crossfade_segments(
+    segments: Iterable[Iterable[torch.Tensor]], crossfade_samples: int
+) -> Iterator[torch.Tensor]:
+    """Joins the audio chunks of consecutive segments, crossfading the segments.
+
+    The last `crossfade_samples` samples of a segment are held back until the next segment
+    starts, so the chunks of a segment are yielded as they come.
+    """
+    tail = None
+    for segment in segments:
+        buffer = torch.zeros(0)
+        faded = tail is None
+        for chunk in segment:
+            buffer = torch.cat([buffer, chunk])
+            if not faded:
+                num_samples = min(tail.shape[-1], crossfade_samples)
+                if buffer.shape[-1] < num_samples:
+                    continue
+                fade_in = torch.linspace(0.0, 1.0, num_samples + 2)[1:-1]
+                mixed = tail[-num_samples:] * (1 - fade_in) + buffer[:num_samples] * fade_in
+                if tail.shape[-1] > num_samples:
+                    yield tail[: tail.shape[-1] - num_samples]
+                buffer = torch.cat([mixed, buffer[num_samples:]])
+                faded = True
+            if buffer.shape[-1] > crossfade_samples:
+                yield buffer[: buffer.shape[-1] - crossfade_samples]
+                buffer = buffer[buffer.shape[-1] - crossfade_samples :]
+        # A segment shorter than the crossfade is appended as is.
+        tail = buffer if faded else torch.cat([tail, buffer])
+    if tail is not None and tail.shape[-1] > 0:
+        yield tail
+
+
+def generate_parallel_audio_stream(
+    tts_model,
+    model_state: dict,
+    text_to_generate: str,
+    num_workers: int,
+    crossfade_seconds: float = DEFAULT_CROSSFADE_SECONDS,
+    worker_context: Callable[[], AbstractContextManager] = nullcontext,
+    first_clause: bool = False,
+    generator: torch.Generator | None = None,
+    **kwargs,
+) -> Iterator[torch.Tensor]:
+    """Like `tts_model.generate_audio_stream`, with `num_workers` segments generated at once.
+
+    Each worker thread generates its segments inside `worker_context()`, and `kwargs` are
+    passed to `generate_audio_stream`. The noise is drawn from `generator` if given. With one
+    worker and not `first_clause`, or one segment, this is `generate_audio_stream`. Closing
+    the returned generator stops the workers.
+    """
+    seeding = get_seeding(tts_model) if generator is not None else None
+    if num_workers > 1 or first_clause:
+        segments = split_segments(tts_model, text_to_generate, first_clause)
+    else:
+        segments = []
+    if len(segments) <= 1:
+        with seeding.use(generator) if seeding is not None else nullcontext():
+            yield from tts_model.generate_audio_stream(
+                model_state=model_state, text_to_generate=text_to_generate, **kwargs
+            )
+        return
+
+    if generator is not None:
+        generators = split_generator(generator, len(segments))
+    else:
+        generators = [None] * len(segments)
+
+    # The audio chunks of each segment, then None.
+    queues = [Queue() for _ in segments]
+    stopped = threading.Event()
+
+    def generate_segment(index: int):
+        try:
+            seeded = seeding.use(generators[index]) if seeding is not None else nullcontext()
+            with worker_context(), seeded:
+                audio_chunks = tts_model.generate_audio_stream(
+                    model_state=model_state, text_to_generate=segments[index], **kwargs
+                )
+                for chunk in audio_chunks:
+                    if stopped.is_set():
+                        audio_chunks.close()
+                        return
+                    queues[index].put(chunk)
+        except Exception as e:
+            logger.exception("Segment %d failed", index)
+            queues[index].put(e)
+        finally:
+            queues[index].put(None)
+
+    def segment_chunks(index: int) -> Iterator[torch.Tensor]:
+        while (chunk := queues[index].get()) is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    # The segments start in order, so the first one is generated first.
+    executor = ThreadPoolExecutor(num_workers, thread_name_prefix="pocket-tts-segment")
+    for index in range(len(segments)):
+        executor.submit(generate_segment, index)
+    try:
+        yield from crossfade_segments(
+            (segment_chunks(index) for index in range(len(segments))),
+            int(crossfade_seconds * tts_model.sample_rate),
+        )
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,162 @@
+"""Pause and resume of running generations, at frame boundaries.
+
+The whole state of a generation is its model state (the KV cache of the FlowLM) and the
+position of its threads, so a generation can be suspended between two frames and resumed
+later without changing its output. `Preemption` installs a hook on the FlowLM transformer of
+a model which, before each frame, blocks the generations which were paused. While paused,
+a generation uses no CPU, and its model state stays in RAM or is spilled to a directory.
+
+A generation is recognized by its model state: `generate_audio_stream` copies the state of
+the voice and prompts the text in the thread which iterates over it, then runs the frames in
+a thread of its own with the same state. Iterate over the audio chunks inside
+`track(generation)`, and inside `join(generation)` in the threads generating parts of the
+same text.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# Directory where the model states of the paused generations are spilled, if set.
+SPILL_DIR_ENV = "POCKET_TTS_PREEMPT_SPILL_DIR"
+
+
+class Generation:
+    """A generation which can be paused and resumed, from any thread."""
+
+    def __init__(self, spill_dir: str | Path | None = None):
+        self.spill_dir = spill_dir
+        self.num_pauses = 0
+        self._running = threading.Event()
+        self._running.set()
+
+    @property
+    def is_paused(self) -> bool:
+        return not self._running.is_set()
+
+    def pause(self):
+        """The generation stops before its next frame."""
+        if self._running.is_set():
+            self.num_pauses += 1
+            self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def wait_if_paused(self, model_state: dict):
+        """Called by the generation before each frame, blocks while it is paused."""
+        if self._running.is_set():
+            return
+        if self.spill_dir is None:
+            self._running.wait()
+            return
+        path = _spill(model_state, Path(self.spill_dir))
+        try:
+            self._running.wait()
+        finally:
+            _restore(model_state, path)
+
+
+def _spill(model_state: dict, spill_dir: Path) -> Path:
+    spill_dir.mkdir(parents=True, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".pt", prefix="pocket_tts_state_", dir=spill_dir)
+    os.close(fd)
+    torch.save(model_state, path)
+    # The model reads its state from the dict at each step, nothing else refers to it.
+    for module_state in model_state.values():
+        for key in module_state:
+            module_state[key] = None
+    logger.info("Spilled a paused generation to %s", path)
+    return Path(path)
+
+
+def _restore(model_state: dict, path: Path):
+    for module_name, module_state in torch.load(path).items():
+        model_state[module_name].update(module_state)
+    path.unlink()
+
+
+class Preemption:
+    """Lets the generations of `tts_model` be paused, see the module docstring."""
+
+    def __init__(self, tts_model):
+        self._by_thread: dict[int, Generation] = {}
+        # The model states being generated, kept alive so that their ids are not reused, with
+        # their generation and the thread which prompted them.
+        self._by_state: dict[int, tuple[dict, Generation, int]] = {}
+        self._lock = threading.Lock()
+        self._handle = tts_model.flow_lm.transformer.register_forward_pre_hook(self._before_step)
+
+    def _before_step(self, module, args):
+        model_state = args[1]
+        thread_id = threading.get_ident()
+        with self._lock:
+            generation = self._by_thread.get(thread_id)
+            if generation is not None:
+                # The text prompt, run by the tracked thread on the copied model state.
+                self._by_state[id(model_state)] = (model_state, generation, thread_id)
+                return
+            entry = self._by_state.get(id(model_state))
+        if entry is not None:
+            entry[1].wait_if_paused(model_state)
+
+    @contextmanager
+    def track(self, generation: Generation):
+        """The generations started by this thread inside the context can be paused."""
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._by_thread[thread_id] = generation
+        try:
+            yield generation
+        finally:
+            generation.resume()
+            with self._lock:
+                del self._by_thread[thread_id]
+                self._forget_states(lambda entry: entry[1] is generation)
+
+    @contextmanager
+    def join(self, generation: Generation):
+        """Like `track`, from another thread working for the tracking one.
+
+        The generation is still resumed when the tracking thread leaves `track`. The model
+        states prompted by this thread are forgotten when it leaves the context.
+        """
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._by_thread[thread_id] = generation
+        try:
+            yield generation
+        finally:
+            with self._lock:
+                del self._by_thread[thread_id]
+                self._forget_states(lambda entry: entry[2] == thread_id)
+
+    def _forget_states(self, predicate):
+        for state_id in [k for k, entry in self._by_state.items() if predicate(entry)]:
+            del self._by_state[state_id]
+
+    def remove(self):
+        self._handle.remove()
+
+
+_preemptions: dict[int, Preemption] = {}
+_preemptions_lock = threading.Lock()
+
+
+def get_preemption(tts_model) -> Preemption:
+    """The `Preemption` of `tts_model`, installed at the first call."""
+    with _preemptions_lock:
+        if id(tts_model) not in _preemptions:
+            _preemptions[id(tts_model)] = Preemption(tts_model)
+        return _preemptions[id(tts_model)]
+
+
+def new_generation() -> Generation:
+    return Generation(os.environ.get(SPILL_DIR_ENV))
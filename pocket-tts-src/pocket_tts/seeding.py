@@ -0,0 +1,114 @@
+"""Random generators of their own for the generations, so that seeded outputs are reproducible.
+
+The FlowLM draws the noise of each frame from the global torch RNG, which is shared by all the
+threads of the process. With `torch.manual_seed`, generations running at once draw from the
+same sequence in an order which depends on the scheduling, so none of them is reproducible.
+`Seeding` installs hooks on the FlowLM of a model: in the generations started inside
+`use(generator)`, the noise of each frame is drawn again from `generator`, with the same
+distribution, before the first step of the LSD decoding. Two generations with generators
+seeded alike give the same audio, whatever runs next to them.
+
+A generation is recognized like in `pocket_tts.preemption`: `generate_audio_stream` prompts
+the text in the thread which iterates over it, then runs the frames in a thread of its own
+with the same model state. Iterate over the audio chunks inside `use(generator)`.
+"""
+
+import threading
+from contextlib import contextmanager
+
+import torch
+
+
+class Seeding:
+    """Draws the noise of the generations of `tts_model` from their generators."""
+
+    def __init__(self, tts_model):
+        self.tts_model = tts_model
+        self._by_thread: dict[int, torch.Generator] = {}
+        # The model states being generated, kept alive so that their ids are not reused.
+        self._by_state: dict[int, tuple[dict, torch.Generator]] = {}
+        self._lock = threading.Lock()
+        # The generator of the frame being sampled by each thread, until its noise is drawn.
+        self._pending = threading.local()
+        flow_lm = tts_model.flow_lm
+        self._handles = [
+            flow_lm.transformer.register_forward_pre_hook(self._before_step),
+            flow_lm.flow_net.register_forward_pre_hook(self._before_flow),
+        ]
+
+    def _before_step(self, module, args):
+        model_state = args[1]
+        with self._lock:
+            generator = self._by_thread.get(threading.get_ident())
+            if generator is not None:
+                # The text prompt, run by the thread on the copied model state.
+                self._by_state[id(model_state)] = (model_state, generator)
+            else:
+                entry = self._by_state.get(id(model_state))
+                generator = entry[1] if entry is not None else None
+        self._pending.generator = generator
+
+    def _before_flow(self, module, args):
+        generator = getattr(self._pending, "generator", None)
+        if generator is None:
+            return
+        # Only the first step of the LSD decoding starts from the noise, in place.
+        self._pending.generator = None
+        noise = args[3]
+        std = self.tts_model.temp**0.5
+        redrawn = torch.empty(noise.shape, dtype=noise.dtype, device=generator.device)
+        if self.tts_model.noise_clamp is None:
+            torch.nn.init.normal_(redrawn, mean=0.0, std=std, generator=generator)
+        else:
+            clamp = self.tts_model.noise_clamp
+            torch.nn.init.trunc_normal_(
+                redrawn, mean=0.0, std=std, a=-clamp, b=clamp, generator=generator
+            )
+        noise.copy_(redrawn)
+
+    @contextmanager
+    def use(self, generator: torch.Generator | None):
+        """The generations started by this thread inside the context draw from `generator`.
+
+        With None, they draw from the global RNG as usual.
+        """
+        if generator is None:
+            yield
+            return
+        thread_id = threading.get_ident()
+        with self._lock:
+            self._by_thread[thread_id] = generator
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._by_thread[thread_id]
+                for state_id in [k for k, v in self._by_state.items() if v[1] is generator]:
+                    del self._by_state[state_id]
+
+    def remove(self):
+        for handle in self._handles:
+            handle.remove()
+
+
+_seedings: dict[int, Seeding] = {}
+_seedings_lock = threading.Lock()
+
+
+def get_seeding(tts_model) -> Seeding:
+    """The `Seeding` of `tts_model`, installed at the first call."""
+    with _seedings_lock:
+        if id(tts_model) not in _seedings:
+            _seedings[id(tts_model)] = Seeding(tts_model)
+        return _seedings[id(tts_model)]
+
+
+def seeded_generator(seed: int | None) -> torch.Generator | None:
+    """A new generator seeded with `seed`, None without a seed."""
+    return None if seed is None else torch.Generator().manual_seed(seed)
+
+
+def split_generator(generator: torch.Generator, num_generators: int) -> list[torch.Generator]:
+    """Generators seeded from `generator`, one per part of a generation run at once."""
+    seeds = torch.randint(2**62, (num_generators,), generator=generator, device=generator.device)
+    return [torch.Generator(device=generator.device).manual_seed(int(seed)) for seed in seeds]
@@ -0,0 +1,666 @@
+"""The FastAPI server started by `pocket-tts serve`."""
+
+import asyncio
+import io
+import logging
+import math
+import os
+import tempfile
+import threading
+from contextlib import asynccontextmanager, nullcontext
+from functools import partial
+from pathlib import Path
+from queue import Queue
+
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from pydantic import BaseModel
+
+from pocket_tts import metrics
+from pocket_tts.admission import (
+    CLIENT_ID_HEADER,
+    AdmissionController,
+    QueueFullError,
+    QueueTimeoutError,
+    estimate_cost,
+)
+from pocket_tts.batches import BatchManager
+from pocket_tts.data.audio import (
+    FIRST_CHUNK_LENGTH_SECONDS,
+    encode_wav,
+    estimate_speech_seconds,
+    stream_audio_chunks,
+)
+from pocket_tts.executor import GenerationExecutor
+from pocket_tts.jobs import JobManager
+from pocket_tts.parallel import generate_parallel_audio_stream
+from pocket_tts.preemption import get_preemption, new_generation
+from pocket_tts.seeding import seeded_generator
+from pocket_tts.single_flight import Flight, SingleFlight
+from pocket_tts.utils import tracing
+from pocket_tts.utils.profiling import profile_generation
+from pocket_tts.utils.utils import PREDEFINED_VOICES, size_of_dict
+from pocket_tts.utterance_cache import UtteranceCache, utterance_key, voice_file_identity
+from pocket_tts.variants import with_parameters
+from pocket_tts.warmup import WARMUP_TEXT, Readiness
+
+logger = logging.getLogger(__name__)
+
+# Global model instance
+tts_model = None
+global_model_state = None
+# Text synthesized before reporting ready, None to skip the warmup
+warmup_text: str | None = WARMUP_TEXT
+readiness = Readiness()
+# Limits the generations running at once, the others wait in a bounded queue
+admission = AdmissionController()
+# Checkpointed long-form jobs, None when the server has no jobs directory
+jobs: JobManager | None = None
+# Batches of generations with their results on disk, None when the server has no results
+# directory
+batches: BatchManager | None = None
+# Segments of a long text generated at once by a request
+segment_workers = 1
+# Generates the first clause of a text on its own, and adapts the first write of the audio to
+# the speed of the generation
+low_latency = False
+# WAV files of the deterministic requests, None to disable the cache
+utterance_cache: UtteranceCache | None = None
+# Threads of the generations with their torch threads, None runs each in a thread of its own
+generation_executor: GenerationExecutor | None = None
+# Identical deterministic requests running at once share one generation, None to disable it
+single_flight: SingleFlight | None = SingleFlight()
+# Identities of the model and of the default voice, in the keys of the utterance cache
+model_identity = "default"
+default_voice_identity = "default"
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The warmup runs in the background, so that `/health` can report it.
+    if tts_model is not None:
+        metrics.VOICE_CACHE_BYTES.set(float(size_of_dict(global_model_state)))
+        readiness.start_warm_up(tts_model, {"default": global_model_state}, warmup_text)
+    tasks = []
+    if jobs is not None:
+        tasks.append(asyncio.create_task(jobs.serve(admission, generation_executor)))
+    if batches is not None:
+        tasks.append(asyncio.create_task(batches.serve(admission, generation_executor)))
+    yield
+    for task in tasks:
+        task.cancel()
+
+
+web_app = FastAPI(
+    title="Kyutai Pocket TTS API",
+    description="Text-to-Speech generation API",
+    version="1.0.0",
+    lifespan=lifespan,
+)
+web_app.add_middleware(
+    CORSMiddleware,
+    allow_origins=[
+        "http://localhost:3000",
+        "https://pod1-10007.internal.kyutai.org",
+        "https://kyutai.org",
+    ],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+@web_app.get("/")
+async def root():
+    """Serve the frontend."""
+    static_path = Path(__file__).parent / "static" / "index.html"
+    return FileResponse(static_path)
+
+
+@web_app.get("/health")
+async def health():
+    """Readiness probe: 503 until the model is loaded and warmed up."""
+    if not readiness.is_ready:
+        return JSONResponse(status_code=503, content=readiness.as_dict())
+    return {"status": "healthy", "warm_latency": readiness.warm_latency}
+
+
+@web_app.get("/queue")
+async def queue_status():
+    """Generations running and waiting, with the estimated wait of a new request."""
+    return admission.status()
+
+
+@web_app.get("/queue/{request_id}")
+async def request_queue_status(request_id: str):
+    """Position and estimated wait of a request, by the ID of its `X-Request-ID` header."""
+    status = admission.request_status(request_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown request, or already finished")
+    return status
+
+
+@web_app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics of the server."""
+    return PlainTextResponse(metrics.REGISTRY.exposition(), media_type=metrics.CONTENT_TYPE)
+
+
+def write_to_queue(
+    queue,
+    text_to_generate,
+    model_state,
+    profile=False,
+    trace=None,
+    on_done=None,
+    on_start=None,
+    seed=None,
+    cache_key=None,
+    flight=None,
+):
+    """Allows writing to the StreamingResponse as if it were a file.
+
+    If given, `on_start` receives the `Generation` which pauses and resumes the generation,
+    the audio is stored in the utterance cache under `cache_key` once complete, and the bytes
+    are also written to the `flight` of the identical requests.
+    """
+
+    class FileLikeToQueue(io.IOBase):
+        def __init__(self, queue):
+            self.queue = queue
+
+        def write(self, data):
+            if flight is not None:
+                flight.write(data)
+            self.queue.put(data)
+
+        def flush(self):
+            pass
+
+        def close(self):
+            self.queue.put(None)
+
+    if on_start is not None:
+        generation = new_generation()
+        tracked = get_preemption(tts_model).track(generation)
+        # The workers of the segments are paused with the request.
+        worker_context = partial(get_preemption(tts_model).join, generation)
+        on_start(generation)
+    else:
+        tracked = nullcontext()
+        worker_context = nullcontext
+    generated_chunks = []
+
+    def kept(audio_chunks):
+        for chunk in audio_chunks:
+            if cache_key is not None and utterance_cache is not None:
+                generated_chunks.append(chunk)
+            yield chunk
+
+    with tracing.activate(trace), tracked:
+        audio_chunks = tracing.traced_stream(
+            metrics.instrument_stream(
+                kept(
+                    generate_parallel_audio_stream(
+                        tts_model,
+                        model_state,
+                        text_to_generate,
+                        segment_workers,
+                        worker_context=worker_context,
+                        first_clause=low_latency,
+                        generator=seeded_generator(seed),
+                    )
+                ),
+                tts_model.sample_rate,
+            )
+        )
+        try:
+            with profile_generation(tts_model, profile, label=f"request {text_to_generate[:20]!r}"):
+                stream_audio_chunks(
+                    FileLikeToQueue(queue),
+                    audio_chunks,
+                    tts_model.config.mimi.sample_rate,
+                    None if low_latency else FIRST_CHUNK_LENGTH_SECONDS,
+                    estimate_speech_seconds(text_to_generate),
+                )
+            if cache_key is not None and utterance_cache is not None:
+                utterance_cache.put(cache_key, encode_wav(generated_chunks, tts_model.sample_rate))
+        finally:
+            if flight is not None:
+                flight.close()
+            if on_done is not None:
+                on_done()
+            if trace is not None:
+                tracing.export(trace)
+
+
+def generate_data_with_state(
+    text_to_generate: str,
+    model_state: dict,
+    profile: bool = False,
+    trace: tracing.Trace | None = None,
+    on_done=None,
+    on_start=None,
+    seed: int | None = None,
+    cache_key: str | None = None,
+    flight: Flight | None = None,
+):
+    queue = Queue()
+
+    # Run your function in a thread of the generation executor, or of its own
+    args = (queue, text_to_generate, model_state, profile, trace, on_done, on_start)
+    kwargs = {"seed": seed, "cache_key": cache_key, "flight": flight}
+    if generation_executor is not None:
+        future = generation_executor.submit(write_to_queue, *args, **kwargs)
+    else:
+        thread = threading.Thread(target=write_to_queue, args=args, kwargs=kwargs)
+        thread.start()
+
+    # Yield data as it becomes available
+    i = 0
+    while True:
+        data = queue.get()
+        if data is None:
+            break
+        i += 1
+        yield data
+
+    if generation_executor is not None:
+        future.result()
+    else:
+        thread.join()
+
+
+def check_voice_url(voice_url: str):
+    if not (
+        voice_url.startswith("http://")
+        or voice_url.startswith("https://")
+        or voice_url.startswith("hf://")
+        or voice_url in PREDEFINED_VOICES
+    ):
+        raise HTTPException(
+            status_code=400, detail="voice_url must start with http://, https://, or hf://"
+        )
+
+
+def get_model_state(voice_url: str | None, voice_wav) -> dict:
+    """The model state of the voice of a request, see `text_to_speech`."""
+    if voice_url is not None and voice_wav is not None:
+        raise HTTPException(status_code=400, detail="Cannot provide both voice_url and voice_wav")
+
+    # Use the appropriate model state
+    if voice_url is not None:
+        check_voice_url(voice_url)
+        with tracing.span("voice_prompt"):
+            model_state = metrics.cached_voice_state(tts_model, voice_url, truncate=True)
+        logging.warning("Using voice from URL: %s", voice_url)
+    elif voice_wav is not None:
+        # Use uploaded voice file
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_file:
+            with tracing.span("upload"):
+                content = voice_wav.file.read()
+            temp_file.write(content)
+            temp_file.flush()
+
+            try:
+                with tracing.span("voice_prompt"):
+                    model_state = tts_model.get_state_for_audio_prompt(
+                        Path(temp_file.name), truncate=True
+                    )
+                metrics.record_voice_lookup(hit=False)
+            finally:
+                os.unlink(temp_file.name)
+    else:
+        # Use default global model state
+        model_state = global_model_state
+        metrics.record_voice_lookup(hit=True)
+    return model_state
+
+
+async def utterance_cache_key(text: str, voice_url: str | None, voice_wav, seed: int | None):
+    """Key of a request in the utterance cache, see `pocket_tts.utterance_cache`."""
+    if voice_url is not None:
+        voice = voice_url
+    elif voice_wav is not None:
+        voice = voice_file_identity(await voice_wav.read())
+        await voice_wav.seek(0)
+    else:
+        voice = default_voice_identity
+    return utterance_key(
+        text,
+        voice,
+        seed=seed,
+        model=model_identity,
+        temperature=tts_model.temp,
+        lsd_decode_steps=tts_model.lsd_decode_steps,
+        noise_clamp=tts_model.noise_clamp,
+        eos_threshold=tts_model.eos_threshold,
+        segment_workers=segment_workers,
+        low_latency=low_latency,
+    )
+
+
+def close_flight(flight: Flight | None):
+    """Ends the flight of a request which failed before generating."""
+    if flight is not None:
+        flight.close()
+
+
+@web_app.post("/tts")
+async def text_to_speech(
+    request: Request,
+    text: str = Form(...),
+    voice_url: str | None = Form(None),
+    voice_wav: UploadFile | None = File(None),
+    profile: bool = Form(False),
+    timeout: float | None = Form(None),
+    seed: int | None = Form(None),
+):
+    """
+    Generate speech from text using the pre-loaded voice prompt or a custom voice.
+
+    Args:
+        text: Text to convert to speech
+        voice_url: Optional voice URL (http://, https://, or hf://)
+        voice_wav: Optional uploaded voice file (mutually exclusive with voice_url)
+        profile: Log the time spent in each module of the model for this request
+        timeout: Maximum time to wait for a generation slot, in seconds
+        seed: Seed of the random generator of the request, a seeded request gives the same
+            audio whatever runs at the same time, and can be served from the utterance cache
+
+    Waiting requests are admitted by the scheduling policy of the server, see
+    `pocket_tts.admission`, which can pause a long generation for a much shorter request.
+    When the queue of the server is full, the request is rejected with a 429 status and a
+    `Retry-After` header. If it waited longer than its timeout, it is dropped with a 503.
+
+    The request ID is taken from the `X-Request-ID` header, or generated, and returned in the
+    same header. `Server-Timing` reports the spans recorded before the audio starts streaming.
+
+    A seeded request, or any request when the temperature is 0, which was generated before is
+    answered from the utterance cache with an `X-Cache: HIT` header, without waiting. While an
+    identical request is running, it streams the same audio from the start, with an
+    `X-Cache: COALESCED` header, see `pocket_tts.single_flight`.
+    """
+    if not text.strip():
+        raise HTTPException(status_code=400, detail="Text cannot be empty")
+
+    trace = tracing.Trace(request.headers.get(tracing.REQUEST_ID_HEADER))
+    cache_key = None
+    deterministic = seed is not None or (tts_model is not None and tts_model.temp == 0)
+    if deterministic and (utterance_cache is not None or single_flight is not None):
+        cache_key = await utterance_cache_key(text, voice_url, voice_wav, seed)
+    if cache_key is not None and utterance_cache is not None:
+        wav = await asyncio.to_thread(utterance_cache.get, cache_key)
+        if wav is not None:
+            return Response(
+                wav,
+                media_type="audio/wav",
+                headers={
+                    "Content-Disposition": "attachment; filename=generated_speech.wav",
+                    "X-Cache": "HIT",
+                    tracing.REQUEST_ID_HEADER: trace.request_id,
+                },
+            )
+
+    flight = None
+    while cache_key is not None and single_flight is not None and flight is None:
+        flight, leading = single_flight.join(cache_key)
+        if leading:
+            break
+        if await flight.wait_started():
+            metrics.COALESCED_REQUESTS.inc()
+            return StreamingResponse(
+                flight.read(),
+                media_type="audio/wav",
+                headers={
+                    "Content-Disposition": "attachment; filename=generated_speech.wav",
+                    "X-Cache": "COALESCED",
+                    tracing.REQUEST_ID_HEADER: trace.request_id,
+                },
+            )
+        # The identical request failed before its audio started, this one generates it.
+        flight = None
+
+    client_id = request.headers.get(CLIENT_ID_HEADER) or (request.client and request.client.host)
+    metrics.QUEUE_DEPTH.inc()
+    try:
+        with trace.span("queue"):
+            ticket = await admission.acquire(
+                trace.request_id, timeout, estimate_cost(tts_model, text), client_id or "default"
+            )
+    except QueueFullError as e:
+        close_flight(flight)
+        return JSONResponse(
+            status_code=429,
+            content={"detail": str(e), **admission.status()},
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    except QueueTimeoutError as e:
+        close_flight(flight)
+        return JSONResponse(status_code=503, content={"detail": str(e)})
+    except BaseException:
+        close_flight(flight)
+        raise
+    finally:
+        metrics.QUEUE_DEPTH.dec()
+
+    try:
+        with tracing.activate(trace):
+            model_state = await asyncio.to_thread(get_model_state, voice_url, voice_wav)
+    except BaseException:
+        admission.release(ticket)
+        close_flight(flight)
+        raise
+
+    return StreamingResponse(
+        generate_data_with_state(
+            text,
+            model_state,
+            profile,
+            trace,
+            on_done=partial(admission.release, ticket),
+            on_start=partial(admission.set_preemptible, ticket)
+            if admission.preemption_ratio is not None
+            else None,
+            seed=seed,
+            cache_key=cache_key,
+            flight=flight,
+        ),
+        media_type="audio/wav",
+        headers={
+            "Content-Disposition": "attachment; filename=generated_speech.wav",
+            "Transfer-Encoding": "chunked",
+            tracing.REQUEST_ID_HEADER: trace.request_id,
+            "Server-Timing": trace.server_timing(),
+        },
+    )
+
+
+def get_jobs() -> JobManager:
+    if jobs is None:
+        raise HTTPException(
+            status_code=404, detail="Jobs are disabled, start the server with --jobs-dir"
+        )
+    return jobs
+
+
+def get_job(job_id: str):
+    job = get_jobs().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
+
+
+@web_app.post("/jobs", status_code=202)
+async def create_job(
+    text: str = Form(...),
+    voice_url: str | None = Form(None),
+    voice_wav: UploadFile | None = File(None),
+    seed: int | None = Form(None),
+):
+    """
+    Start a long-form generation job, checkpointed so that it survives restarts.
+
+    Args:
+        text: Text to convert to speech
+        voice_url: Optional voice URL (http://, https://, or hf://)
+        voice_wav: Optional uploaded voice file (mutually exclusive with voice_url)
+        seed: Seed of the sampling, random if not given
+
+    Poll `/jobs/{job_id}` for the progress, and download `/jobs/{job_id}/audio` once the
+    status is "completed". See `pocket_tts.jobs`.
+    """
+    manager = get_jobs()
+    if not text.strip():
+        raise HTTPException(status_code=400, detail="Text cannot be empty")
+    model_state = await asyncio.to_thread(get_model_state, voice_url, voice_wav)
+    job = await asyncio.to_thread(manager.submit, text, model_state, seed)
+    return job.as_dict()
+
+
+@web_app.get("/jobs")
+async def list_jobs():
+    return [job.as_dict() for job in get_jobs().jobs()]
+
+
+@web_app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    return get_job(job_id).as_dict()
+
+
+@web_app.get("/jobs/{job_id}/audio")
+async def job_audio(job_id: str):
+    job = get_job(job_id)
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail=f"The job is {job.status}")
+    return FileResponse(job.audio_path, media_type="audio/wav", filename=f"{job_id}.wav")
+
+
+@web_app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Stop a job and delete its files."""
+    job = get_jobs().cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job.as_dict()
+
+
+def synthesize_batch_item(item: dict):
+    """The audio chunks of an item of a batch, with its optional "voice" URL or name, and its
+    optional "temperature" and "lsd_steps" (the defaults of the model otherwise)."""
+    model_state = get_model_state(item.get("voice"), None)
+    model = with_parameters(tts_model, item.get("temperature"), item.get("lsd_steps"))
+    return metrics.instrument_stream(
+        model.generate_audio_stream(model_state=model_state, text_to_generate=item["text"]),
+        model.sample_rate,
+    )
+
+
+def estimate_batch_item_cost(item: dict) -> float:
+    return estimate_cost(tts_model, item["text"], item.get("lsd_steps"))
+
+
+def check_batch_item_params(item: dict):
+    temperature, lsd_steps = item.get("temperature"), item.get("lsd_steps")
+    if temperature is not None and (
+        not isinstance(temperature, int | float) or isinstance(temperature, bool) or temperature < 0
+    ):
+        raise HTTPException(status_code=400, detail="temperature must be a number >= 0")
+    if lsd_steps is not None and (
+        not isinstance(lsd_steps, int) or isinstance(lsd_steps, bool) or lsd_steps < 1
+    ):
+        raise HTTPException(status_code=400, detail="lsd_steps must be an integer >= 1")
+
+
+def get_batches() -> BatchManager:
+    if batches is None:
+        raise HTTPException(
+            status_code=404, detail="Batches are disabled, start the server with --results-dir"
+        )
+    return batches
+
+
+def get_batch(batch_id: str):
+    batch = get_batches().get(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Unknown batch")
+    return batch
+
+
+class BatchRequest(BaseModel):
+    items: list[dict]
+
+
+@web_app.post("/batches", status_code=202)
+async def create_batch(request: BatchRequest):
+    """
+    Start a batch of generations, processed in the background.
+
+    The body is `{"items": [{"text": "...", "voice": "...", "temperature": 0.7,
+    "lsd_steps": 1}, ...]}`. Only the text is required: the voice is a URL (http://,
+    https://, or hf://) or the name of a predefined voice, and the temperature and the number
+    of LSD decode steps of an item default to the ones of the model.
+    Poll `/batches/{batch_id}` for the progress, then download the results from
+    `/batches/{batch_id}/archive` (a zip) or from the `/batches/{batch_id}/manifest` and
+    `/batches/{batch_id}/items/{index}`. See `pocket_tts.batches`.
+    """
+    manager = get_batches()
+    for item in request.items:
+        if item.get("voice") is not None:
+            check_voice_url(item["voice"])
+        check_batch_item_params(item)
+    try:
+        batch = await asyncio.to_thread(manager.submit, request.items)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from None
+    return batch.as_dict()
+
+
+@web_app.get("/batches")
+async def list_batches():
+    return [batch.as_dict() for batch in get_batches().batches()]
+
+
+@web_app.get("/batches/{batch_id}")
+async def batch_status(batch_id: str):
+    return get_batch(batch_id).as_dict()
+
+
+@web_app.get("/batches/{batch_id}/manifest")
+async def batch_manifest(batch_id: str):
+    return get_batch(batch_id).manifest()
+
+
+@web_app.get("/batches/{batch_id}/items/{index}")
+async def batch_item_audio(batch_id: str, index: int):
+    batch = get_batch(batch_id)
+    if not 0 <= index < len(batch.items):
+        raise HTTPException(status_code=404, detail="Unknown item")
+    item = batch.items[index]
+    if item["file"] is None:
+        raise HTTPException(status_code=409, detail=f"The item is {item['status']}")
+    return FileResponse(batch.batch_dir / item["file"], media_type="audio/wav")
+
+
+@web_app.get("/batches/{batch_id}/archive")
+async def batch_archive(batch_id: str):
+    """A zip of the manifest and of the audio of the items completed so far."""
+    batch = get_batch(batch_id)
+    archive_path = await asyncio.to_thread(get_batches().write_archive, batch)
+    return FileResponse(archive_path, media_type="application/zip", filename=f"{batch_id}.zip")
+
+
+@web_app.delete("/batches/{batch_id}")
+async def cancel_batch(batch_id: str):
+    """Stop a batch and delete its results."""
+    batch = get_batches().cancel(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Unknown batch")
+    return batch.as_dict()
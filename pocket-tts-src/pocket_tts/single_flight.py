@@ -0,0 +1,99 @@
+"""Coalescing of identical requests running at once.
+
+A notification fan-out can send hundreds of identical seeded requests within a second, before
+the first one has reached the utterance cache. The first request of a key (the same key as
+`pocket_tts.utterance_cache.utterance_key`) leads a `Flight`: it generates, and writes the
+bytes of its response to the flight. The identical requests arriving while it runs follow
+it: they read the same bytes from the first one, each at its own position, so a slow client
+does not hold back the generation nor the other clients.
+
+A flight is forgotten once its leader is done, the next identical requests are answered by
+the utterance cache. When a leader fails before its first bytes (a full queue, a voice which
+cannot be loaded), its followers generate the audio themselves.
+"""
+
+import asyncio
+import threading
+from collections.abc import AsyncIterator, Callable
+
+
+class Flight:
+    """The bytes of the response of a leading request, read by the identical requests.
+
+    It is created on the event loop, and written and closed from any thread.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, on_close: Callable[[], None]):
+        self._loop = loop
+        self._on_close = on_close
+        self._chunks: list[bytes] = []
+        self._done = False
+        # Set, and replaced, on the event loop each time a chunk is written or the flight ends.
+        self._changed = asyncio.Event()
+
+    def write(self, data: bytes):
+        self._chunks.append(data)
+        self._wake_up()
+
+    def close(self):
+        if self._done:
+            return
+        self._done = True
+        self._on_close()
+        self._wake_up()
+
+    def _wake_up(self):
+        if not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._notify)
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait_started(self) -> bool:
+        """Waits for the first bytes of the flight, False if it ended without any."""
+        while not self._chunks and not self._done:
+            await self._changed.wait()
+        return bool(self._chunks)
+
+    async def read(self) -> AsyncIterator[bytes]:
+        """All the bytes of the flight, from the first ones, as they are written."""
+        index = 0
+        while True:
+            changed = self._changed
+            if index < len(self._chunks):
+                index += 1
+                yield self._chunks[index - 1]
+            elif self._done:
+                return
+            else:
+                await changed.wait()
+
+
+class SingleFlight:
+    """The flights of the requests running, by key."""
+
+    def __init__(self):
+        self._flights: dict[str, Flight] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def join(self, key: str) -> tuple[Flight, bool]:
+        """The flight of `key`, and whether the caller leads it, on the event loop.
+
+        The leader writes the bytes of its response to the flight, and closes it when done.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = Flight(asyncio.get_running_loop(), on_close=lambda: self._remove(key, flight))
+            self._flights[key] = flight
+            return flight, True
+
+    def _remove(self, key: str, flight: Flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
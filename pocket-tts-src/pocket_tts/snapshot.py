@@ -0,0 +1,226 @@
+"""Snapshots of a ready-to-serve process, for fast warm starts.
+
+A snapshot holds everything a server computes at startup: the weights of every loaded
+variant, the tokenizer, the config and the states of the predefined voices (the FlowLM
+attention caches after the voice prompt). It is a safetensors file which is memory-mapped
+at restore time, so restoring takes a fraction of a second instead of a full load.
+
+Tensors with the same content (like the weights shared by the variants, see
+`pocket_tts.variants`) are stored once. A snapshot records a fingerprint of its inputs,
+`load_snapshot` refuses a snapshot whose fingerprint does not match.
+"""
+
+import hashlib
+import json
+import logging
+from collections import defaultdict
+from pathlib import Path
+
+import safetensors.torch
+import torch
+
+from pocket_tts.bundle import materialize_tokenizer
+from pocket_tts.modules.stateful_module import init_states
+from pocket_tts.utils.config import Config
+from pocket_tts.utils.utils import MISSING_FILE_ERRORS, PREDEFINED_VOICES, download_if_necessary
+from pocket_tts.utils.weights_loading import (
+    assign_state_dict,
+    content_hash,
+    load_safetensors_metadata,
+    load_safetensors_mmap,
+    skip_weight_init,
+)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = "pocket-tts-snapshot"
+SNAPSHOT_VERSION = "1"
+
+
+def compute_fingerprint(files: list[str | Path], extra: str = "") -> str:
+    """Cheap fingerprint of the inputs of a snapshot.
+
+    It covers the size and modification time of `files` (missing files included) and of
+    the pocket_tts source code, so no file content is read.
+    """
+    package_dir = Path(__file__).parent
+    all_files = [Path(file) for file in files] + sorted(package_dir.rglob("*.py"))
+    description = [extra]
+    for file in all_files:
+        if file.exists():
+            stat = file.stat()
+            description.append((str(file), stat.st_size, stat.st_mtime_ns))
+        else:
+            description.append((str(file), None, None))
+    return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+
+def compute_voice_states(models: dict, voices: list[str] | None = None) -> dict:
+    """Computes the state of each predefined voice for each model.
+
+    Returns:
+        `{variant: {voice: model_state}}`, voices whose file is missing are skipped.
+    """
+    if voices is None:
+        voices = list(PREDEFINED_VOICES)
+    voice_states = {}
+    for variant, tts_model in models.items():
+        voice_states[variant] = {}
+        for voice in voices:
+            try:
+                voice_states[variant][voice] = tts_model.get_state_for_audio_prompt(voice)
+            except MISSING_FILE_ERRORS as e:
+                logger.warning("Could not compute the state of voice %s: %s", voice, e)
+    return voice_states
+
+
+def _compact_state(model_state: dict) -> dict[str, torch.Tensor]:
+    flat_state = {}
+    for module_name, module_state in model_state.items():
+        for key, value in module_state.items():
+            if key == "cache" and "current_end" in module_state:
+                # Only the filled part of the attention cache is stored.
+                value = value[:, :, : module_state["current_end"].shape[0]]
+            flat_state[f"{module_name}/{key}"] = value
+    return flat_state
+
+
+def _expand_state(flat_state: dict[str, torch.Tensor], sequence_length: int) -> dict:
+    model_state = {}
+    for name, value in flat_state.items():
+        module_name, key = name.rsplit("/", 1)
+        if key == "cache":
+            # Only the filled part of the cache is ever read, the rest is left uninitialized
+            # so that its memory is only allocated when the generation writes to it.
+            cache = torch.empty(
+                (*value.shape[:2], sequence_length, *value.shape[3:]), dtype=value.dtype
+            )
+            cache[:, :, : value.shape[2]] = value
+            value = cache
+        else:
+            value = value.clone()
+        model_state.setdefault(module_name, {})[key] = value
+    return model_state
+
+
+def save_snapshot(path: str | Path, models: dict, voice_states: dict, fingerprint: str):
+    """Writes a snapshot of `models` and of their `voice_states`.
+
+    Args:
+        path: Where to write the snapshot.
+        models: Maps each variant name to a `TTSModel`, they must share the same config.
+        voice_states: `{variant: {voice: model_state}}`, see `compute_voice_states`.
+        fingerprint: Fingerprint of the inputs, see `compute_fingerprint`.
+    """
+    tensors, aliases, names_by_content = {}, {}, {}
+
+    def add_tensor(name: str, tensor: torch.Tensor):
+        content_key = (str(tensor.dtype), tuple(tensor.shape), content_hash(tensor))
+        if content_key in names_by_content:
+            aliases[name] = names_by_content[content_key]
+        else:
+            names_by_content[content_key] = name
+            tensors[name] = tensor.contiguous()
+
+    sequence_length = None
+    for variant, tts_model in models.items():
+        for key, tensor in tts_model.state_dict().items():
+            add_tensor(f"models/{variant}/{key}", tensor)
+        for voice, model_state in voice_states.get(variant, {}).items():
+            for key, tensor in _compact_state(model_state).items():
+                add_tensor(f"voice_states/{variant}/{voice}/{key}", tensor)
+            for module_state in model_state.values():
+                if "cache" in module_state:
+                    sequence_length = module_state["cache"].shape[2]
+
+    config = next(iter(models.values())).config
+    tokenizer_file = download_if_necessary(config.flow_lm.lookup_table.tokenizer_path)
+    tensors["tokenizer"] = torch.frombuffer(
+        bytearray(tokenizer_file.read_bytes()), dtype=torch.uint8
+    )
+    snapshot_config = config.model_copy(deep=True)
+    snapshot_config.weights_path = None
+    snapshot_config.weights_path_without_voice_cloning = None
+    snapshot_config.flow_lm.lookup_table.tokenizer_path = ""
+
+    metadata = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "fingerprint": fingerprint,
+        "config": snapshot_config.model_dump_json(),
+        "variants": json.dumps(
+            {variant: tts_model.has_voice_cloning for variant, tts_model in models.items()}
+        ),
+        "aliases": json.dumps(aliases),
+        "sequence_length": json.dumps(sequence_length),
+    }
+    # Written next to the destination first, so a crash never leaves a truncated snapshot.
+    temporary_path = Path(f"{path}.tmp")
+    safetensors.torch.save_file(tensors, temporary_path, metadata=metadata)
+    temporary_path.replace(path)
+    logger.info("Snapshot written in %s, %d duplicated tensors stored once", path, len(aliases))
+
+
+def load_snapshot(
+    path: str | Path,
+    fingerprint: str,
+    temp,
+    lsd_decode_steps,
+    noise_clamp: float | None,
+    eos_threshold,
+) -> tuple[dict, dict]:
+    """Restores the models and voice states saved by `save_snapshot`.
+
+    Raises:
+        ValueError: If `path` is not a snapshot, or if it was made from other inputs.
+
+    Returns:
+        The models by variant and the voice states, as given to `save_snapshot`.
+    """
+    from pocket_tts.models.tts_model import TTSModel
+
+    metadata = load_safetensors_metadata(path)
+    if metadata.get("format") != SNAPSHOT_FORMAT or metadata["version"] != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} is not a pocket-tts snapshot of version {SNAPSHOT_VERSION}.")
+    if metadata["fingerprint"] != fingerprint:
+        raise ValueError(f"The snapshot {path} is stale, its inputs have changed.")
+
+    tensors = load_safetensors_mmap(path)
+    for name, stored_name in json.loads(metadata["aliases"]).items():
+        tensors[name] = tensors[stored_name]
+    config = Config.model_validate_json(metadata["config"])
+    config.flow_lm.lookup_table.tokenizer_path = str(
+        materialize_tokenizer(tensors.pop("tokenizer"))
+    )
+
+    state_dicts = defaultdict(dict)
+    flat_states = defaultdict(lambda: defaultdict(dict))
+    for name, tensor in tensors.items():
+        kind, variant, key = name.split("/", 2)
+        if kind == "models":
+            state_dicts[variant][key] = tensor
+        else:
+            voice, key = key.split("/", 1)
+            flat_states[variant][voice][key] = tensor
+
+    models = {}
+    for variant, has_voice_cloning in json.loads(metadata["variants"]).items():
+        with skip_weight_init():
+            tts_model = TTSModel._from_pydantic_config_with_weights(
+                config, temp, lsd_decode_steps, noise_clamp, eos_threshold
+            )
+        assign_state_dict(tts_model, state_dicts[variant])
+        tts_model.has_voice_cloning = has_voice_cloning
+        # The voice states are looked up by module name, which `init_states` registers.
+        init_states(tts_model.flow_lm, batch_size=1, sequence_length=1)
+        models[variant] = tts_model
+
+    sequence_length = json.loads(metadata["sequence_length"])
+    voice_states = {
+        variant: {
+            voice: _expand_state(flat_state, sequence_length)
+            for voice, flat_state in variant_states.items()
+        }
+        for variant, variant_states in flat_states.items()
+    }
+    return models, voice_states
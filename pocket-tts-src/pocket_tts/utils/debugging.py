@@ -1,5 +1,8 @@
+from collections import Counter
+
 import torch
 from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_leaves
 
 
 def to_str(obj):
@@ -24,3 +27,47 @@ class LoggingMode(TorchDispatchMode):
             f"output: {to_str(output)}"
         )
         return output
+
+
+class CountingMode(TorchDispatchMode):
+    """Counts the aten ops and the tensor allocations, to catch performance regressions.
+
+    Unlike timings, the counts are deterministic. An allocation is an output whose storage
+    does not belong to an input, so views and in-place ops do not count.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.op_counts = Counter()
+        self.num_allocations = 0
+        self.allocated_bytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        output = func(*args, **kwargs)
+        self.op_counts[str(func)] += 1
+        seen_storages = {
+            x.untyped_storage().data_ptr()
+            for x in tree_leaves((args, kwargs))
+            if isinstance(x, torch.Tensor)
+        }
+        for x in tree_leaves(output):
+            if not isinstance(x, torch.Tensor):
+                continue
+            storage = x.untyped_storage()
+            if storage.nbytes() > 0 and storage.data_ptr() not in seen_storages:
+                seen_storages.add(storage.data_ptr())
+                self.num_allocations += 1
+                self.allocated_bytes += storage.nbytes()
+        return output
+
+    def summary(self, num_frames: int = 1) -> dict:
+        """The counts per generated frame, when `num_frames` frames were generated."""
+        return {
+            "ops": sum(self.op_counts.values()) / num_frames,
+            "allocations": self.num_allocations / num_frames,
+            "allocated_bytes": self.allocated_bytes / num_frames,
+            "op_counts": {
+                name: count / num_frames for name, count in sorted(self.op_counts.items())
+            },
+        }
@@ -0,0 +1,192 @@
+"""Opt-in profiling of the generation, with a timing breakdown per module.
+
+Forward hooks are attached to the hot modules of a `TTSModel` (the FlowLM layers, the flow
+head, the Mimi transformers and the SEANet stages) while a generation runs. The timings are
+aggregated per module and per generated frame, and can be exported as a Chrome trace
+(open it in chrome://tracing or https://ui.perfetto.dev).
+
+Profiling is enabled for every generation by setting `POCKET_TTS_PROFILE=1`, or for a single
+request with its `profile` flag. The hooks see every call to the model, so the breakdown of a
+request includes the work of the requests running at the same time.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ENV = "POCKET_TTS_PROFILE"
+# Directory where a Chrome trace of each profiled generation is written.
+PROFILE_TRACE_DIR_ENV = "POCKET_TTS_PROFILE_TRACE_DIR"
+
+# `*` matches one level of the module names.
+PROFILED_MODULES = [
+    "flow_lm.conditioner",
+    "flow_lm.transformer.layers.*",
+    "flow_lm.flow_net",
+    "mimi.encoder.model.*",
+    "mimi.encoder_transformer",
+    "mimi.downsample",
+    "mimi.upsample",
+    "mimi.decoder_transformer",
+    "mimi.decoder.model.*",
+]
+# Called once per generated frame.
+FRAME_MODULE = "mimi.decoder"
+
+
+def profiling_enabled(requested: bool = False) -> bool:
+    return requested or os.environ.get(PROFILE_ENV, "0") != "0"
+
+
+def _compile_pattern(pattern: str) -> re.Pattern:
+    return re.compile(r"[^.]+".join(re.escape(part) for part in pattern.split("*")) + "$")
+
+
+class ModuleProfiler:
+    """Times the forward calls of the modules of `model` matching `patterns`.
+
+    Use it as a context manager, the hooks are removed on exit.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        patterns: list[str] = PROFILED_MODULES,
+        frame_module: str = FRAME_MODULE,
+    ):
+        self.model = model
+        self.patterns = [_compile_pattern(pattern) for pattern in patterns]
+        self.frame_module = frame_module
+        self.num_frames = 0
+        # (module name, thread id, start, duration), times in seconds
+        self.events: list[tuple[str, int, float, float]] = []
+        self.wall_time = 0.0
+        self._module_types: dict[str, str] = {}
+        self._handles = []
+        self._starts = threading.local()
+
+    def _pre_hook(self, name: str):
+        def hook(module, args):
+            self._starts.__dict__[name] = time.perf_counter()
+
+        return hook
+
+    def _post_hook(self, name: str):
+        def hook(module, args, output):
+            start = self._starts.__dict__.pop(name, None)
+            if start is not None:
+                end = time.perf_counter()
+                self.events.append((name, threading.get_ident(), start, end - start))
+
+        return hook
+
+    def _count_frame(self, module, args, output):
+        self.num_frames += 1
+
+    def __enter__(self):
+        for name, module in self.model.named_modules():
+            if name == self.frame_module:
+                self._handles.append(module.register_forward_hook(self._count_frame))
+            if any(pattern.match(name) for pattern in self.patterns):
+                self._module_types[name] = type(module).__name__
+                self._handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+                self._handles.append(module.register_forward_hook(self._post_hook(name)))
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall_time = time.perf_counter() - self._start
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def breakdown(self) -> list[dict]:
+        """Total time of each module, sorted by decreasing time."""
+        totals, calls = {}, {}
+        for name, _, _, duration in self.events:
+            totals[name] = totals.get(name, 0.0) + duration
+            calls[name] = calls.get(name, 0) + 1
+        rows = []
+        for name, total in sorted(totals.items(), key=lambda item: -item[1]):
+            rows.append(
+                {
+                    "module": name,
+                    "type": self._module_types[name],
+                    "calls": calls[name],
+                    "total_ms": total * 1000,
+                    "ms_per_frame": total * 1000 / max(self.num_frames, 1),
+                    "percent_of_wall_time": 100 * total / self.wall_time if self.wall_time else 0,
+                }
+            )
+        return rows
+
+    def format_table(self) -> str:
+        header = (
+            f"{'module':<36} {'type':<26} {'calls':>6} {'total ms':>10} "
+            f"{'ms/frame':>9} {'% wall':>7}"
+        )
+        lines = [f"{self.num_frames} frames in {self.wall_time * 1000:.0f} ms", header]
+        for row in self.breakdown():
+            lines.append(
+                f"{row['module']:<36} {row['type']:<26} {row['calls']:>6} "
+                f"{row['total_ms']:>10.1f} {row['ms_per_frame']:>9.2f} "
+                f"{row['percent_of_wall_time']:>7.1f}"
+            )
+        return "\n".join(lines)
+
+    def chrome_trace(self) -> dict:
+        """The calls as complete events of the Chrome trace event format, one row per thread."""
+        return {
+            "traceEvents": [
+                {
+                    "name": name,
+                    "cat": self._module_types[name],
+                    "ph": "X",
+                    "ts": (start - self._start) * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": os.getpid(),
+                    "tid": thread_id,
+                }
+                for name, thread_id, start, duration in self.events
+            ],
+            "displayTimeUnit": "ms",
+            "otherData": {"num_frames": self.num_frames, "wall_time_ms": self.wall_time * 1000},
+        }
+
+    def write_chrome_trace(self, path: str | Path):
+        Path(path).write_text(json.dumps(self.chrome_trace()))
+
+
+@contextmanager
+def profile_generation(model, requested: bool = False, label: str = "generation"):
+    """Profiles the generations run inside the context if profiling is enabled.
+
+    The breakdown is logged on exit, and a Chrome trace is written in the directory set by
+    `POCKET_TTS_PROFILE_TRACE_DIR`, if any. Yields the profiler, or None when disabled.
+    """
+    if not profiling_enabled(requested):
+        yield None
+        return
+    if not isinstance(model, nn.Module):
+        logger.warning("Profiling is only supported for PyTorch models.")
+        yield None
+        return
+    profiler = ModuleProfiler(model)
+    with profiler:
+        yield profiler
+    logger.info("Profile of the %s:\n%s", label, profiler.format_table())
+    trace_dir = os.environ.get(PROFILE_TRACE_DIR_ENV)
+    if trace_dir is not None:
+        trace_path = Path(trace_dir) / f"pocket_tts_trace_{time.time_ns()}.json"
+        trace_path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.write_chrome_trace(trace_path)
+        logger.info("Chrome trace written in %s", trace_path)
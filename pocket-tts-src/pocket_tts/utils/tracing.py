@@ -0,0 +1,199 @@
+"""Request-scoped tracing of the generation pipeline.
+
+A `Trace` holds the timed spans of one request (upload, voice fetch, audio decoding and
+resampling, voice prompt, first audio, frames, WAV writing). The trace of the current
+request is found through a context variable, so that `span` can be called anywhere in the
+pipeline without passing the trace around. Threads do not inherit it: run their work inside
+`activate(trace)`.
+
+Finished traces are sent to the registered exporters. Set `POCKET_TTS_TRACE_FILE` to append
+every trace as a line of JSON to a file, or register another exporter with `add_exporter`.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any
+
+from beartype.typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+TRACE_FILE_ENV = "POCKET_TTS_TRACE_FILE"
+REQUEST_ID_HEADER = "X-Request-ID"
+
+
+class Trace:
+    """The spans of one request, with times in milliseconds since the start of the request."""
+
+    def __init__(self, request_id: str | None = None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.start_time = time.time()
+        self.spans: list[dict] = []
+        self._origin = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, name: str, start: float, end: float, **attributes):
+        """Records a span from `start` to `end`, two `time.monotonic()` values."""
+        span = {
+            "name": name,
+            "start_ms": (start - self._origin) * 1000,
+            "duration_ms": (end - start) * 1000,
+            "thread": threading.current_thread().name,
+        }
+        if attributes:
+            span["attributes"] = attributes
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.monotonic(), **attributes)
+
+    def durations(self) -> dict[str, float]:
+        """Total duration of the spans of each name, in milliseconds, in order of appearance."""
+        durations = {}
+        with self._lock:
+            for span in self.spans:
+                durations[span["name"]] = durations.get(span["name"], 0.0) + span["duration_ms"]
+        return durations
+
+    def server_timing(self) -> str:
+        """The spans recorded so far, as the value of a `Server-Timing` header."""
+        return ", ".join(
+            f'{_metric_name(name)};desc="{name}";dur={duration:.1f}'
+            for name, duration in self.durations().items()
+        )
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            spans = list(self.spans)
+        return {"request_id": self.request_id, "start_time": self.start_time, "spans": spans}
+
+
+def _metric_name(name: str) -> str:
+    return re.sub(r"[^a-z0-9_-]+", "_", name.lower())
+
+
+class SpanExporter:
+    """Receives the finished traces. Subclasses implement `export`."""
+
+    def export(self, trace: Trace):
+        raise NotImplementedError
+
+
+class JsonLinesExporter(SpanExporter):
+    """Appends each trace to a file, as one line of JSON."""
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def export(self, trace: Trace):
+        line = json.dumps(trace.as_dict()) + "\n"
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a") as f:
+                f.write(line)
+
+
+_exporters: list[SpanExporter] = []
+if os.environ.get(TRACE_FILE_ENV):
+    _exporters.append(JsonLinesExporter(os.environ[TRACE_FILE_ENV]))
+
+_current_trace: ContextVar[Trace | None] = ContextVar("pocket_tts_trace", default=None)
+
+
+def add_exporter(exporter: SpanExporter):
+    _exporters.append(exporter)
+
+
+def remove_exporter(exporter: SpanExporter):
+    _exporters.remove(exporter)
+
+
+def export(trace: Trace):
+    """Sends `trace` to the exporters. A failing exporter is logged, not raised."""
+    for exporter in _exporters:
+        try:
+            exporter.export(trace)
+        except Exception:
+            logger.exception("Could not export the trace of request %s", trace.request_id)
+
+
+def current_trace() -> Trace | None:
+    return _current_trace.get()
+
+
+@contextmanager
+def activate(trace: Trace | None):
+    """Makes `trace` the current trace inside the context, e.g. in a worker thread."""
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Times the context as a span of the current trace, if any."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(name, **attributes):
+        yield
+
+
+def traced_stream(audio_chunks: Iterator[Any], trace: Trace | None = None) -> Iterator[Any]:
+    """Yields the chunks of `audio_chunks`, recording two spans in `trace`.
+
+    `first_audio` lasts until the first chunk (text prefill, first FlowLM step and first Mimi
+    decoding), and `frames` is the time spent waiting for the other chunks.
+    """
+    trace = trace or _current_trace.get()
+    if trace is None:
+        yield from audio_chunks
+        return
+    first_chunk_time = None
+    frames_time = 0.0
+    num_chunks = 0
+    try:
+        for start, end, chunk in _timed_iteration(audio_chunks):
+            if first_chunk_time is None:
+                first_chunk_time = end
+                trace.record("first_audio", start, end)
+            else:
+                frames_time += end - start
+            num_chunks += 1
+            yield chunk
+    finally:
+        if hasattr(audio_chunks, "close"):
+            audio_chunks.close()
+        if first_chunk_time is not None:
+            trace.record(
+                "frames", first_chunk_time, first_chunk_time + frames_time, chunks=num_chunks
+            )
+
+
+def _timed_iteration(iterable) -> Iterator[tuple[float, float, Any]]:
+    iterator = iter(iterable)
+    while True:
+        start = time.monotonic()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        yield start, time.monotonic(), item
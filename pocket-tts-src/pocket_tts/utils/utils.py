@@ -7,8 +7,11 @@ import requests
 import safetensors.torch
 import torch
 from huggingface_hub import hf_hub_download
+from huggingface_hub.utils import EntryNotFoundError, GatedRepoError, LocalEntryNotFoundError
 from torch import nn
 
+from pocket_tts.utils import tracing
+
 PROJECT_ROOT = Path(__file__).parent.parent.parent
 
 _voices_names = ["alba", "marius", "javert", "jean", "fantine", "cosette", "eponine", "azelma"]
@@ -17,6 +20,16 @@ PREDEFINED_VOICES = {
     x: f"hf://kyutai/pocket-tts-without-voice-cloning/embeddings/{x}.safetensors@d4fdd22ae8c8e1cb3634e150ebeff1dab2d16df3"
     for x in _voices_names
 }
+# Voices loaded from a bundle (see `pocket_tts.bundle`), they are used instead of the files.
+BUNDLED_VOICES: dict[str, torch.Tensor] = {}
+# Raised by `download_if_necessary` for a file which does not exist or cannot be accessed
+# (gated repository, not in the cache when offline).
+MISSING_FILE_ERRORS = (
+    FileNotFoundError,
+    EntryNotFoundError,
+    LocalEntryNotFoundError,
+    GatedRepoError,
+)
 
 
 def make_cache_directory() -> Path:
@@ -60,6 +73,9 @@ class display_execution_time:
     def __exit__(self, exc_type, exc_val, exc_tb):
         end_time = time.monotonic()
         self.elapsed_time_ms = int((end_time - self.start_time) * 1000)
+        trace = tracing.current_trace()
+        if trace is not None:
+            trace.record(self.task_name, self.start_time, end_time)
         if self.print_output:
             self.logger.info("%s took %d ms", self.task_name, self.elapsed_time_ms)
         return False  # Don't suppress exceptions
@@ -72,7 +88,8 @@ def download_if_necessary(file_path: str) -> Path:
             hashlib.sha256(file_path.encode()).hexdigest() + "." + file_path.split(".")[-1]
         )
         if not cached_file.exists():
-            response = requests.get(file_path)
+            with tracing.span("download"):
+                response = requests.get(file_path)
             response.raise_for_status()
             with open(cached_file, "wb") as f:
                 f.write(response.content)
@@ -86,7 +103,8 @@ def download_if_necessary(file_path: str) -> Path:
             filename, revision = filename.split("@")
         else:
             revision = None
-        cached_file = hf_hub_download(repo_id=repo_id, filename=filename, revision=revision)
+        with tracing.span("download"):
+            cached_file = hf_hub_download(repo_id=repo_id, filename=filename, revision=revision)
         return Path(cached_file)
     else:
         return Path(file_path)
@@ -98,6 +116,8 @@ def load_predefined_voice(voice_name: str) -> torch.Tensor:
             f"Predefined voice '{voice_name}' not found"
             f", available voices are {list(PREDEFINED_VOICES)}."
         )
+    if voice_name in BUNDLED_VOICES:
+        return BUNDLED_VOICES[voice_name]
     voice_file = download_if_necessary(PREDEFINED_VOICES[voice_name])
     # There is only one tensor in the file.
     return safetensors.torch.load_file(voice_file)["audio_prompt"]
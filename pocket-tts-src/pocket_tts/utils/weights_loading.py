@@ -1,35 +1,188 @@
+import hashlib
+import json
+import os
+import struct
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import chain
 from pathlib import Path
 
-import safetensors
+import torch
+from torch import nn
+from torch.overrides import TorchFunctionMode
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def _read_safetensors_header(path: str | Path) -> tuple[dict, int]:
+    """Returns the JSON header of a safetensors file and the offset of its data."""
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    return header, 8 + header_size
+
+
+def load_safetensors_metadata(path: str | Path) -> dict[str, str]:
+    """Returns the `__metadata__` of a safetensors file, without reading the tensors."""
+    header, _ = _read_safetensors_header(path)
+    return header.get("__metadata__", {})
+
+
+def load_safetensors_mmap(path: str | Path) -> dict[str, torch.Tensor]:
+    """Loads the tensors of a safetensors file without copying them.
+
+    All tensors are views of a single private memory map of the file: the data is read
+    lazily from the page cache, and a tensor is only copied if it gets written to.
+    """
+    header, data_start = _read_safetensors_header(path)
+    header.pop("__metadata__", None)
+    storage = torch.UntypedStorage.from_file(str(path), shared=False, nbytes=os.path.getsize(path))
+
+    state_dict = {}
+    for key, info in header.items():
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        begin += data_start
+        end += data_start
+        itemsize = dtype.itemsize
+        if begin == end:
+            tensor = torch.empty(info["shape"], dtype=dtype)
+        elif begin % itemsize == 0:
+            tensor = torch.empty(0, dtype=dtype).set_(storage, begin // itemsize, info["shape"])
+        else:
+            # The tensor is not aligned in the file, so it cannot be a view of the storage.
+            raw_bytes = torch.empty(0, dtype=torch.uint8).set_(storage, begin, (end - begin,))
+            tensor = raw_bytes.clone().view(dtype).reshape(info["shape"])
+        state_dict[key] = tensor
+    return state_dict
+
+
+def content_hash(tensor: torch.Tensor) -> str:
+    data = tensor.contiguous().reshape(-1).view(torch.uint8).numpy()
+    return hashlib.sha256(data).hexdigest()
+
+
+def load_shared_state_dicts(paths: dict[str, str | Path]) -> dict[str, dict[str, torch.Tensor]]:
+    """Loads several safetensors files, keeping a single copy of the tensors they share.
+
+    Tensors with the same dtype, shape and content are replaced by the same tensor in all
+    the returned state dicts, whatever their name. Only the tensors which have a possible
+    duplicate (same dtype and shape) are hashed.
+
+    Args:
+        paths: Maps a name to each file to load.
+
+    Returns:
+        The state dict of each file, under the same names as `paths`.
+    """
+    state_dicts = {name: load_safetensors_mmap(path) for name, path in paths.items()}
+
+    candidates = defaultdict(list)
+    for state_dict in state_dicts.values():
+        for key, tensor in state_dict.items():
+            candidates[(tensor.dtype, tuple(tensor.shape))].append((state_dict, key))
+
+    unique_tensors = {}
+    for signature, entries in candidates.items():
+        if len(entries) < 2:
+            continue
+        for state_dict, key in entries:
+            content_key = (signature, content_hash(state_dict[key]))
+            state_dict[key] = unique_tensors.setdefault(content_key, state_dict[key])
+    return state_dicts
+
+
+# The random initializations run by the layers (`nn.Linear`, convolutions, `nn.Embedding`)
+# when they are built.
+_RANDOM_INITS = {
+    nn.init.uniform_,
+    nn.init.normal_,
+    nn.init.kaiming_uniform_,
+    nn.init.kaiming_normal_,
+    nn.init.xavier_uniform_,
+    nn.init.xavier_normal_,
+}
+
+
+class _SkipRandomInit(TorchFunctionMode):
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func in _RANDOM_INITS:
+            # Left as is, the tensor is passed either way.
+            return args[0] if args else kwargs["tensor"]
+        return func(*args, **kwargs)
+
+
+@contextmanager
+def skip_weight_init():
+    """Skips the random initialization of the layers built by this thread in this context.
+
+    Their parameters are left uninitialized (`torch.empty`), so this is only meant for
+    modules whose weights are assigned right after with `assign_state_dict`. Like the torch
+    function modes it relies on, it only applies to the calling thread: the other threads
+    keep using `torch.nn.init`, to sample noise during generation.
+
+    The `TTSModel` is built with this rather than on the meta device, because its
+    construction moves the Mimi model to the CPU with `.to()`, which meta tensors do not
+    support.
+    """
+    with _SkipRandomInit():
+        yield
+
+
+def assign_state_dict(module: nn.Module, state_dict: dict, strict: bool = True):
+    """Binds the tensors of `state_dict` as the parameters and buffers of `module`.
+
+    Unlike `load_state_dict`, the tensors are not copied, so `module` can be built on the
+    meta device (`with torch.device("meta"): ...`) to skip the random initialization, and
+    its parameters can be memory-mapped tensors from `load_safetensors_mmap`.
+    """
+    module.load_state_dict(state_dict, strict=strict, assign=True)
+    still_on_meta = [
+        name
+        for name, tensor in chain(module.named_parameters(), module.named_buffers())
+        if tensor.is_meta
+    ]
+    if still_on_meta:
+        raise ValueError(f"Those tensors were not found in the state dict: {still_on_meta}")
 
 
 def get_flow_lm_state_dict(path: Path) -> dict:
     state_dict = {}
-    with safetensors.safe_open(path, framework="pt", device="cpu") as f:
-        for key in f.keys():
-            if (
-                key.startswith("flow.w_s_t.")
-                or key == "condition_provider.conditioners.transcript_in_segment.learnt_padding"
-                or key == "condition_provider.conditioners.speaker_wavs.learnt_padding"
-            ):
-                # skip lookup table weights
-                continue
-            new_name = key
-            if key == "condition_provider.conditioners.transcript_in_segment.embed.weight":
-                new_name = "conditioner.embed.weight"
-            if key == "condition_provider.conditioners.speaker_wavs.output_proj.weight":
-                new_name = "speaker_proj_weight"
-            state_dict[new_name] = f.get_tensor(key)
+    for key, tensor in load_safetensors_mmap(path).items():
+        if (
+            key.startswith("flow.w_s_t.")
+            or key == "condition_provider.conditioners.transcript_in_segment.learnt_padding"
+            or key == "condition_provider.conditioners.speaker_wavs.learnt_padding"
+        ):
+            # skip lookup table weights
+            continue
+        new_name = key
+        if key == "condition_provider.conditioners.transcript_in_segment.embed.weight":
+            new_name = "conditioner.embed.weight"
+        if key == "condition_provider.conditioners.speaker_wavs.output_proj.weight":
+            new_name = "speaker_proj_weight"
+        state_dict[new_name] = tensor
     return state_dict
 
 
 def get_mimi_state_dict(path: Path) -> dict:
     state_dict = {}
-    with safetensors.safe_open(path, framework="pt", device="cpu") as f:
-        for key in f.keys():
-            if key.startswith("model.quantizer.vq.") or key == "model.quantizer.logvar_proj.weight":
-                # skip vq weights
-                continue
+    for key, tensor in load_safetensors_mmap(path).items():
+        if key.startswith("model.quantizer.vq.") or key == "model.quantizer.logvar_proj.weight":
+            # skip vq weights
+            continue
 
-            state_dict[key.removeprefix("model.")] = f.get_tensor(key)
+        state_dict[key.removeprefix("model.")] = tensor
     return state_dict
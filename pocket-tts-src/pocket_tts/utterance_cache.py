@@ -0,0 +1,151 @@
+"""Cache of whole generated utterances, for the texts requested again and again.
+
+IVR menus, UI strings and notification templates generate the same text with the same voice
+and parameters all day long. When such a generation is deterministic (seeded, or at
+temperature 0), its WAV file is cached under a key made of the normalized text, the
+identity of the voice and the generation parameters (`utterance_key`), and later requests
+are answered from the cache without a generation slot.
+
+The cache has two tiers: an LRU in RAM of at most `max_bytes`, and optionally a directory of
+at most `max_disk_bytes` which survives restarts. An entry found on disk is moved back to RAM.
+The hits and misses are exported as metrics.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+from pocket_tts import metrics
+from pocket_tts.default_parameters import (
+    DEFAULT_UTTERANCE_CACHE_DISK_MB,
+    DEFAULT_UTTERANCE_CACHE_MB,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = DEFAULT_UTTERANCE_CACHE_MB * 1024 * 1024
+DEFAULT_MAX_DISK_BYTES = DEFAULT_UTTERANCE_CACHE_DISK_MB * 1024 * 1024
+
+
+def normalize_text(text: str) -> str:
+    """`text` with the differences which do not change the generation removed."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def utterance_key(text: str, voice: str, **params) -> str:
+    """Key of the utterance of `text`, by the voice identified by `voice`, with `params`.
+
+    `params` hold everything else that changes the audio: the seed, the model variant and its
+    generation parameters.
+    """
+    identity = {"text": normalize_text(text), "voice": voice, **params}
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+def voice_file_identity(content: bytes) -> str:
+    """Identity of a voice uploaded as a file, from its content."""
+    return "sha256:" + hashlib.sha256(content).hexdigest()
+
+
+class UtteranceCache:
+    """WAV files of utterances, by `utterance_key`, in RAM and in `disk_dir` if given."""
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        disk_dir: str | Path | None = None,
+        max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir is not None else None
+        self.max_disk_bytes = max_disk_bytes
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._num_bytes = 0
+        # Sizes of the files of the disk tier, least recently used first.
+        self._disk_entries: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            paths = sorted(self.disk_dir.glob("*.wav"), key=lambda path: path.stat().st_mtime)
+            for path in paths:
+                self._disk_entries[path.stem] = path.stat().st_size
+                self._disk_bytes += self._disk_entries[path.stem]
+            logger.info("%d cached utterances found in %s", len(paths), self.disk_dir)
+        metrics.UTTERANCE_CACHE_BYTES.set_function(lambda: self._num_bytes)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _path(self, key: str) -> Path:
+        return self.disk_dir / f"{key}.wav"
+
+    def get(self, key: str) -> bytes | None:
+        """The WAV file of `key`, None if it is not cached."""
+        with self._lock:
+            wav = self._entries.get(key)
+            if wav is not None:
+                self._entries.move_to_end(key)
+                metrics.UTTERANCE_CACHE_HITS.inc()
+                return wav
+            on_disk = key in self._disk_entries
+            if on_disk:
+                self._disk_entries.move_to_end(key)
+        if on_disk:
+            try:
+                wav = self._path(key).read_bytes()
+                os.utime(self._path(key))
+            except FileNotFoundError:
+                # Evicted by a concurrent `put`, or removed from the directory.
+                wav = None
+                self._forget_missing_file(key)
+            if wav is not None:
+                metrics.UTTERANCE_CACHE_HITS.inc()
+                metrics.UTTERANCE_CACHE_DISK_HITS.inc()
+                self._put_in_memory(key, wav)
+                return wav
+        metrics.UTTERANCE_CACHE_MISSES.inc()
+        return None
+
+    def put(self, key: str, wav: bytes):
+        """Caches the WAV file of `key`, evicting the least recently used ones."""
+        self._put_in_memory(key, wav)
+        if self.disk_dir is None or len(wav) > self.max_disk_bytes:
+            return
+        path = self._path(key)
+        temp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        temp_path.write_bytes(wav)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._disk_bytes += len(wav) - self._disk_entries.pop(key, 0)
+            self._disk_entries[key] = len(wav)
+            evicted = []
+            while self._disk_bytes > self.max_disk_bytes:
+                evicted_key, size = self._disk_entries.popitem(last=False)
+                self._disk_bytes -= size
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            self._path(evicted_key).unlink(missing_ok=True)
+
+    def _forget_missing_file(self, key: str):
+        with self._lock:
+            # Unless a concurrent `put` wrote it again meanwhile.
+            if key in self._disk_entries and not self._path(key).exists():
+                self._disk_bytes -= self._disk_entries.pop(key)
+
+    def _put_in_memory(self, key: str, wav: bytes):
+        if len(wav) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._num_bytes -= len(self._entries.pop(key))
+            self._entries[key] = wav
+            self._num_bytes += len(wav)
+            while self._num_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._num_bytes -= len(evicted)
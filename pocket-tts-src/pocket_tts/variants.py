@@ -0,0 +1,154 @@
+"""Serving the model with and without voice cloning from a single process.
+
+The two weight files of a config only differ in a few tensors, so both models are built
+on the same memory-mapped tensors: the parameters they have in common are in memory once.
+The shared tensors must not be modified in place, since that would change both models.
+
+`load_model` loads a single variant the same way: its layers are not randomly initialized,
+and its weights are memory-mapped rather than copied into them.
+"""
+
+import copy
+import functools
+import logging
+from pathlib import Path
+
+from pocket_tts.default_parameters import (
+    DEFAULT_EOS_THRESHOLD,
+    DEFAULT_LSD_DECODE_STEPS,
+    DEFAULT_NOISE_CLAMP,
+    DEFAULT_TEMPERATURE,
+    DEFAULT_VARIANT,
+)
+from pocket_tts.utils.config import Config, load_config
+from pocket_tts.utils.utils import MISSING_FILE_ERRORS, download_if_necessary, size_of_dict
+from pocket_tts.utils.weights_loading import (
+    assign_state_dict,
+    load_safetensors_mmap,
+    load_shared_state_dicts,
+    skip_weight_init,
+)
+
+logger = logging.getLogger(__name__)
+
+VOICE_CLONING = "voice_cloning"
+WITHOUT_VOICE_CLONING = "without_voice_cloning"
+
+
+@functools.lru_cache(maxsize=16)
+def _copy_with_parameters(tts_model, temp, lsd_decode_steps):
+    model_copy = copy.copy(tts_model)
+    if temp is not None:
+        model_copy.temp = temp
+    if lsd_decode_steps is not None:
+        model_copy.lsd_decode_steps = lsd_decode_steps
+    return model_copy
+
+
+def with_parameters(tts_model, temp: float | None = None, lsd_decode_steps: int | None = None):
+    """A copy of `tts_model` generating with `temp` and `lsd_decode_steps`, if given.
+
+    The generations read their parameters from the model, so setting them on a model shared
+    by concurrent generations would change the others too. The copy shares the modules and
+    the weights of `tts_model`, and is kept for the next generations with the same parameters.
+    """
+    if temp is None and lsd_decode_steps is None:
+        return tts_model
+    return _copy_with_parameters(tts_model, temp, lsd_decode_steps)
+
+
+def _unique_size(state_dicts: dict) -> int:
+    unique = {}
+    for state_dict in state_dicts.values():
+        for tensor in state_dict.values():
+            unique[tensor.data_ptr()] = tensor
+    return size_of_dict(unique)
+
+
+def load_model_variants(
+    config: Config, temp, lsd_decode_steps, noise_clamp: float | None, eos_threshold
+) -> dict:
+    """Loads every variant of `config` whose weights are available.
+
+    Returns:
+        Maps `VOICE_CLONING` and/or `WITHOUT_VOICE_CLONING` to a `TTSModel`.
+    """
+    weights_files = {}
+    for variant, weights_path in [
+        (VOICE_CLONING, config.weights_path),
+        (WITHOUT_VOICE_CLONING, config.weights_path_without_voice_cloning),
+    ]:
+        if weights_path is None:
+            continue
+        try:
+            weights_file = download_if_necessary(weights_path)
+        except MISSING_FILE_ERRORS as e:
+            logger.warning("Weights of the %s variant not available: %s", variant, e)
+            continue
+        if weights_file.exists():
+            weights_files[variant] = weights_file
+    if not weights_files:
+        raise FileNotFoundError("The weights of neither variant could be found.")
+
+    state_dicts = load_shared_state_dicts(weights_files)
+    logger.info(
+        "Weights of %s take %d MB in total, %d MB once deduplicated",
+        list(state_dicts),
+        sum(size_of_dict(state_dict) for state_dict in state_dicts.values()) // 1e6,
+        _unique_size(state_dicts) // 1e6,
+    )
+
+    models = {}
+    for variant, state_dict in state_dicts.items():
+        models[variant] = _build_model(config, temp, lsd_decode_steps, noise_clamp, eos_threshold)
+        assign_state_dict(models[variant], state_dict)
+        models[variant].has_voice_cloning = variant == VOICE_CLONING
+    return models
+
+
+def resolve_weights(config: Config) -> tuple[Path, bool]:
+    """The weights file of `config`, and whether it is the one with voice cloning.
+
+    The weights without voice cloning are used if the ones with it are missing.
+    """
+    try:
+        weights_file = download_if_necessary(config.weights_path)
+        if not weights_file.exists():
+            raise FileNotFoundError(weights_file)
+        return weights_file, True
+    except MISSING_FILE_ERRORS:
+        logger.warning("Weights with voice cloning not available, using the ones without.")
+        return download_if_necessary(config.weights_path_without_voice_cloning), False
+
+
+def load_model(
+    variant: str = DEFAULT_VARIANT,
+    temp=DEFAULT_TEMPERATURE,
+    lsd_decode_steps=DEFAULT_LSD_DECODE_STEPS,
+    noise_clamp: float | None = DEFAULT_NOISE_CLAMP,
+    eos_threshold=DEFAULT_EOS_THRESHOLD,
+):
+    """Like `TTSModel.load_model`, with the weights memory-mapped instead of copied.
+
+    Returns:
+        A `TTSModel` with voice cloning if its weights are available, without otherwise.
+    """
+    config = load_config(Path(__file__).parent / f"config/{variant}.yaml")
+    tts_model = _build_model(config, temp, lsd_decode_steps, noise_clamp, eos_threshold)
+    weights_file, tts_model.has_voice_cloning = resolve_weights(config)
+    assign_state_dict(tts_model, load_safetensors_mmap(weights_file))
+    return tts_model
+
+
+def _build_model(config: Config, temp, lsd_decode_steps, noise_clamp, eos_threshold):
+    """The `TTSModel` of `config` without its weights, to be given with `assign_state_dict`."""
+    from pocket_tts.models.tts_model import TTSModel
+
+    # The weights are assigned afterwards, the model must not load them itself.
+    model_config = config.model_copy(deep=True)
+    model_config.weights_path = None
+    model_config.weights_path_without_voice_cloning = None
+    with skip_weight_init():
+        return TTSModel._from_pydantic_config_with_weights(
+            model_config, temp, lsd_decode_steps, noise_clamp, eos_threshold
+        )
@@ -0,0 +1,86 @@
+"""Warmup of a server before it reports itself as ready.
+
+The first generation of a process pays one-time costs (allocator growth, kernel selection,
+tokenizer warmup), so a server synthesizes some text with each of its preloaded voices
+before accepting traffic.
+"""
+
+import logging
+import threading
+import time
+
+from pocket_tts.utils.utils import display_execution_time
+
+logger = logging.getLogger(__name__)
+
+WARMUP_TEXT = "Hello! This sentence warms up the model, so that the first request is fast."
+
+
+def measure_generation(tts_model, model_state: dict, text: str) -> dict[str, float]:
+    """Generates `text` and returns its time to first chunk, total time and real-time factor."""
+    start = time.monotonic()
+    time_to_first_chunk = None
+    num_samples = 0
+    for chunk in tts_model.generate_audio_stream(model_state=model_state, text_to_generate=text):
+        if time_to_first_chunk is None:
+            time_to_first_chunk = time.monotonic() - start
+        num_samples += chunk.shape[-1]
+    total_time = time.monotonic() - start
+    return {
+        "time_to_first_chunk_ms": time_to_first_chunk * 1000,
+        "total_ms": total_time * 1000,
+        "real_time_factor": total_time / (num_samples / tts_model.sample_rate),
+    }
+
+
+class Readiness:
+    """Tracks the startup of a server: "loading", then "warming_up", then "ready".
+
+    If the warmup fails, the status is "failed". The warm-path latency is measured by the
+    last warmup generation.
+    """
+
+    def __init__(self):
+        self.status = "loading"
+        self.warm_latency: dict[str, float] | None = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self.status == "ready"
+
+    def as_dict(self) -> dict:
+        return {"status": self.status, "warm_latency": self.warm_latency}
+
+    def warm_up(self, tts_model, voice_states: dict[str, dict], text: str | None = WARMUP_TEXT):
+        """Generates `text` with each voice state, then once more to measure the warm path.
+
+        Args:
+            tts_model: The model to warm up.
+            voice_states: The preloaded voice states, by voice name.
+            text: The text to synthesize. If None, the server is marked ready right away.
+        """
+        self.status = "warming_up"
+        try:
+            if text is not None and voice_states:
+                with display_execution_time("Warmup"):
+                    for model_state in voice_states.values():
+                        measure_generation(tts_model, model_state, text)
+                    first_state = next(iter(voice_states.values()))
+                    self.warm_latency = measure_generation(tts_model, first_state, text)
+                logger.info("Warm-path latency: %s", self.warm_latency)
+        except Exception:
+            logger.exception("Warmup failed")
+            self.status = "failed"
+            return
+        self.status = "ready"
+
+    def start_warm_up(
+        self, tts_model, voice_states: dict[str, dict], text: str | None = WARMUP_TEXT
+    ) -> threading.Thread:
+        """Runs `warm_up` in a background thread, so that the server can report its status."""
+        self.status = "warming_up"
+        thread = threading.Thread(
+            target=self.warm_up, args=(tts_model, voice_states, text), daemon=True
+        )
+        thread.start()
+        return thread
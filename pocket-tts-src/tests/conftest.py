@@ -1,3 +1,213 @@
+import json
 import os
+import statistics
+import threading
+import time
+from pathlib import Path
+from queue import Queue
+
+import pytest
+import torch
 
 os.environ["POCKET_TTS_ERROR_WITHOUT_EOS"] = "1"
+
+MICROBENCHMARK_BASELINES = Path(__file__).parent / "microbenchmark_baselines.json"
+OP_COUNT_BASELINES = Path(__file__).parent / "op_count_baselines.json"
+
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", help="Run the microbenchmarks")
+    parser.addoption(
+        "--benchmark-save",
+        action="store_true",
+        help="Run the microbenchmarks and save their timings as the new baselines",
+    )
+    parser.addoption(
+        "--benchmark-tolerance",
+        type=float,
+        default=0.25,
+        help="Relative slowdown over the baseline above which a microbenchmark fails",
+    )
+    parser.addoption(
+        "--op-counts-save",
+        action="store_true",
+        help="Save the op and allocation counts as the new baselines",
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: microbenchmark, run with --benchmark")
+    config.microbenchmark_timings = {}
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark") or config.getoption("--benchmark-save"):
+        return
+    skip = pytest.mark.skip(reason="microbenchmark, run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    if not config.microbenchmark_timings:
+        return
+    terminalreporter.section("microbenchmarks")
+    for name, (milliseconds, baseline) in config.microbenchmark_timings.items():
+        baseline = "no baseline" if baseline is None else f"baseline {baseline:.3f} ms"
+        terminalreporter.write_line(f"{name}: {milliseconds:.3f} ms ({baseline})")
+
+
+def _median_time_per_call(fn, min_time: float = 0.2, min_calls: int = 10) -> float:
+    for _ in range(3):
+        fn()
+    times = []
+    start = time.perf_counter()
+    while len(times) < min_calls or time.perf_counter() - start < min_time:
+        call_start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - call_start)
+    return statistics.median(times)
+
+
+@pytest.fixture
+def microbenchmark(request):
+    """Times a function and compares it to its saved baseline, in milliseconds per call.
+
+    The baselines depend on the machine, save them with `--benchmark-save` on the machine
+    the microbenchmarks are compared on. Saving is not safe with pytest-xdist.
+    """
+    config = request.config
+    name = request.node.name
+
+    def run(fn) -> float:
+        # The model runs with one thread, see `pocket_tts.models.tts_model`.
+        num_threads = torch.get_num_threads()
+        torch.set_num_threads(1)
+        try:
+            with torch.inference_mode():
+                milliseconds = _median_time_per_call(fn) * 1000
+        finally:
+            torch.set_num_threads(num_threads)
+
+        baselines = {}
+        if MICROBENCHMARK_BASELINES.exists():
+            baselines = json.loads(MICROBENCHMARK_BASELINES.read_text())
+        baseline = baselines.get(name)
+        config.microbenchmark_timings[name] = (milliseconds, baseline)
+        if config.getoption("--benchmark-save"):
+            baselines[name] = round(milliseconds, 4)
+            MICROBENCHMARK_BASELINES.write_text(json.dumps(baselines, indent=2, sort_keys=True))
+        elif baseline is not None:
+            tolerance = config.getoption("--benchmark-tolerance")
+            assert milliseconds <= baseline * (1 + tolerance), (
+                f"{name} takes {milliseconds:.3f} ms, {milliseconds / baseline - 1:.0%} more "
+                f"than its baseline of {baseline:.3f} ms"
+            )
+        return milliseconds
+
+    return run
+
+
+@pytest.fixture
+def op_counts(request):
+    """Counts the aten ops and allocations of a function, and fails if they went up.
+
+    The counts are compared to `op_count_baselines.json`, only if it was saved (with
+    `--op-counts-save`) with the same torch version, since op decompositions change.
+    """
+    from pocket_tts.utils.debugging import CountingMode
+
+    config = request.config
+    name = request.node.name
+    torch_version = ".".join(torch.__version__.split(".")[:2])
+
+    def run(fn, num_frames: int = 1) -> dict:
+        with torch.inference_mode(), CountingMode() as mode:
+            fn()
+        counts = mode.summary(num_frames)
+
+        baselines = {}
+        if OP_COUNT_BASELINES.exists():
+            baselines = json.loads(OP_COUNT_BASELINES.read_text())
+        if config.getoption("--op-counts-save"):
+            if baselines.get("torch_version") != torch_version:
+                baselines = {"torch_version": torch_version}
+            baselines[name] = counts
+            OP_COUNT_BASELINES.write_text(json.dumps(baselines, indent=2, sort_keys=True))
+        elif baselines.get("torch_version") == torch_version and name in baselines:
+            baseline = baselines[name]
+            increased_ops = {
+                op: (baseline["op_counts"].get(op, 0), count)
+                for op, count in counts["op_counts"].items()
+                if count > baseline["op_counts"].get(op, 0)
+            }
+            for key in ["ops", "allocations", "allocated_bytes"]:
+                assert counts[key] <= baseline[key], (
+                    f"{name}: {key} per frame went up from {baseline[key]} to {counts[key]}, "
+                    f"increased ops (before, after): {increased_ops}"
+                )
+        return counts
+
+    return run
+
+
+class FakeTransformer(torch.nn.Module):
+    def forward(self, x, model_state):
+        return x
+
+
+class FakeFlowNet(torch.nn.Module):
+    def forward(self, c, s, t, x):
+        return x
+
+
+class FakeModel:
+    """A TTS model without weights, generating a frame of 10 samples per word of the text.
+
+    Like `TTSModel.generate_audio_stream`, the text is prompted on a copy of the model state in
+    the calling thread, and the frames are generated in a thread of their own. Each frame is the
+    length of its word times `lsd_decode_steps` plus noise drawn from the global RNG, passed
+    through the transformer and the flow net of `flow_lm` like the FlowLM does, so that their
+    hooks see it.
+    """
+
+    sample_rate = 100
+
+    def __init__(self, temp: float = 0.0, noise_clamp: float | None = None):
+        self.temp = temp
+        self.lsd_decode_steps = 1
+        self.noise_clamp = noise_clamp
+        self.flow_lm = torch.nn.Module()
+        self.flow_lm.transformer = FakeTransformer()
+        self.flow_lm.flow_net = FakeFlowNet()
+        # The threads which iterated over the generations.
+        self.threads = set()
+
+    def generate_frame(self, model_state: dict, word: str) -> torch.Tensor:
+        noise = torch.randn(10) * self.temp**0.5
+        self.flow_lm.transformer(noise, model_state)
+        return self.flow_lm.flow_net(None, None, None, noise) + len(word) * self.lsd_decode_steps
+
+    def generate_audio_stream(self, model_state, text_to_generate):
+        self.threads.add(threading.get_ident())
+        model_state = dict(model_state)
+        # The text prompt, in the thread of the caller.
+        self.flow_lm.transformer(torch.zeros(10), model_state)
+        frames = Queue()
+
+        def generate():
+            try:
+                for word in text_to_generate.split():
+                    frames.put(self.generate_frame(model_state, word))
+            except BaseException as e:  # noqa: BLE001
+                # Raised again by the iterating thread, like a crash of the model.
+                frames.put(e)
+            finally:
+                frames.put(None)
+
+        threading.Thread(target=generate, daemon=True).start()
+        while (frame := frames.get()) is not None:
+            if isinstance(frame, BaseException):
+                raise frame
+            yield frame
@@ -0,0 +1,171 @@
+"""Tests for the admission control of the generations."""
+
+import asyncio
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+from pocket_tts import server
+from pocket_tts.admission import AdmissionController, QueueFullError, QueueTimeoutError
+
+
+def test_requests_are_admitted_in_order():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, max_queue_length=2)
+        first = await controller.acquire("first")
+        second = asyncio.create_task(controller.acquire("second"))
+        third = asyncio.create_task(controller.acquire("third"))
+        await asyncio.sleep(0)
+        assert controller.request_status("first")["state"] == "running"
+        assert controller.request_status("third")["position"] == 2
+
+        with pytest.raises(QueueFullError) as error:
+            await controller.acquire("fourth")
+        assert error.value.retry_after > 0
+
+        # Released from the thread of the generation.
+        thread = threading.Thread(target=controller.release, args=(first,))
+        thread.start()
+        thread.join()
+        assert (await second).request_id == "second"
+        assert not third.done()
+        assert controller.status()["queued"] == 1
+        controller.release(await asyncio.wait_for(second, 1))
+        controller.release(await asyncio.wait_for(third, 1))
+        assert controller.status()["running"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_requests_past_their_deadline_are_dropped():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, queue_timeout=10.0)
+        ticket = await controller.acquire()
+        with pytest.raises(QueueTimeoutError):
+            await controller.acquire("late", timeout=0.01)
+        assert controller.request_status("late") is None
+        controller.release(ticket)
+        assert controller.status()["running"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_requests_leave_the_queue():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1)
+        await controller.acquire()
+        waiter = asyncio.create_task(controller.acquire("gone"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert controller.status()["queued"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_shortest_job_first_with_starvation_protection():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, policy="sjf", starvation_seconds=0.2)
+        running = await controller.acquire()
+        long = asyncio.create_task(controller.acquire("long", cost=100.0))
+        await asyncio.sleep(0)
+        short = asyncio.create_task(controller.acquire("short", cost=1.0))
+        await asyncio.sleep(0)
+        assert controller.request_status("short")["position"] == 1
+
+        controller.release(running)
+        controller.release(await asyncio.wait_for(short, 1))
+        controller.release(await asyncio.wait_for(long, 1))
+
+        # After waiting long enough, the long job goes before the shorter ones.
+        running = await controller.acquire()
+        long = asyncio.create_task(controller.acquire("long", cost=100.0))
+        await asyncio.sleep(0.3)
+        short = asyncio.create_task(controller.acquire("short", cost=1.0))
+        await asyncio.sleep(0)
+        assert controller.request_status("long")["position"] == 1
+        controller.release(running)
+        controller.release(await asyncio.wait_for(long, 1))
+        controller.release(await asyncio.wait_for(short, 1))
+
+    asyncio.run(scenario())
+
+
+def test_weighted_fair_scheduling():
+    async def scenario():
+        controller = AdmissionController(
+            max_concurrency=1, policy="fair", client_weights={"heavy": 1.0, "light": 1.0}
+        )
+        running = await controller.acquire(client_id="heavy")
+        # A client sending a burst of requests does not delay the requests of another one.
+        burst = [
+            asyncio.create_task(controller.acquire(f"heavy-{i}", client_id="heavy"))
+            for i in range(3)
+        ]
+        await asyncio.sleep(0)
+        other = asyncio.create_task(controller.acquire("light-0", client_id="light"))
+        await asyncio.sleep(0)
+        assert controller.request_status("light-0")["position"] == 1
+
+        controller.release(running)
+        for task in [other, *burst]:
+            controller.release(await asyncio.wait_for(task, 1))
+
+    asyncio.run(scenario())
+
+
+class FakeGeneration:
+    def __init__(self):
+        self.calls = []
+
+    def pause(self):
+        self.calls.append("pause")
+
+    def resume(self):
+        self.calls.append("resume")
+
+
+def test_long_generations_are_preempted_by_short_requests():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, preemption_ratio=10.0)
+        long = await controller.acquire("long", cost=100.0)
+        generation = FakeGeneration()
+        controller.set_preemptible(long, generation)
+
+        # Not cheap enough to preempt the long generation.
+        medium = asyncio.create_task(controller.acquire("medium", cost=50.0))
+        await asyncio.sleep(0)
+        assert generation.calls == []
+
+        short = await asyncio.wait_for(controller.acquire("short", cost=1.0), 1)
+        assert generation.calls == ["pause"]
+        assert controller.request_status("long")["state"] == "preempted"
+        assert controller.status()["preempted"] == 1
+
+        # The medium request is cheaper, the long generation resumes after it.
+        controller.release(short)
+        controller.release(await asyncio.wait_for(medium, 1))
+        assert generation.calls == ["pause", "resume"]
+        assert controller.request_status("long")["state"] == "running"
+        controller.release(long)
+        assert controller.status()["running"] == 0
+        assert long.num_preemptions == 1
+
+    asyncio.run(scenario())
+
+
+def test_tts_returns_429_when_the_queue_is_full(monkeypatch):
+    controller = AdmissionController(max_concurrency=1, max_queue_length=0)
+    asyncio.run(controller.acquire("running"))
+    monkeypatch.setattr(server, "admission", controller)
+    # No model is loaded to tokenize the text.
+    monkeypatch.setattr(server, "estimate_cost", lambda tts_model, text: 1.0)
+    client = TestClient(server.web_app)
+
+    response = client.post("/tts", data={"text": "Hello world."})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    assert client.get("/queue/running").json()["state"] == "running"
+    assert client.get("/queue/unknown").status_code == 404
@@ -0,0 +1,69 @@
+"""Tests for the streaming WAV writer."""
+
+import io
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from pocket_tts.data import audio
+from pocket_tts.data.audio import StreamingWAVWriter
+
+
+@pytest.mark.parametrize(
+    "seconds_per_chunk, first_write_seconds",
+    [
+        # Twice as fast as real time, the first chunk is written right away.
+        (0.25, 0.5),
+        # Twice as slow: the rest of the 10 seconds takes 8 seconds to generate (10 with the
+        # margin) after the first write of 6 seconds, which plays until it is generated.
+        (1.0, 6.0),
+    ],
+)
+def test_first_write_adapts_to_the_speed_of_the_generation(
+    monkeypatch, seconds_per_chunk, first_write_seconds
+):
+    clock = SimpleNamespace(now=0.0)
+    monkeypatch.setattr(audio, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    output = io.BytesIO()
+    writer = StreamingWAVWriter(output, 100, first_chunk_seconds=None, expected_seconds=10.0)
+    writer.write_header(100)
+
+    generated_seconds = 0.0
+    while not output.getvalue():
+        # Chunks of half a second.
+        clock.now += seconds_per_chunk
+        writer.write_pcm_data(torch.zeros(50))
+        generated_seconds += 0.5
+    assert generated_seconds == first_write_seconds
+
+
+def test_first_write_waits_for_the_end_without_an_expected_duration(monkeypatch):
+    clock = SimpleNamespace(now=0.0)
+    monkeypatch.setattr(audio, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    output = io.BytesIO()
+    writer = StreamingWAVWriter(output, 100, first_chunk_seconds=None)
+    writer.write_header(100)
+    for _ in range(10):
+        clock.now += 1.0
+        writer.write_pcm_data(torch.zeros(50))
+    assert not output.getvalue()
+    writer.finalize()
+    assert len(output.getvalue()) > 10 * 50 * 2
+
+
+def test_numpy_chunks_are_written_like_tensors():
+    chunk = torch.linspace(-1.5, 1.5, 101)
+    outputs = []
+    for audio_chunk in (chunk, chunk.numpy()):
+        output = io.BytesIO()
+        writer = StreamingWAVWriter(output, 100, first_chunk_seconds=0.0)
+        writer.write_header(100)
+        writer.write_pcm_data(audio_chunk)
+        writer.finalize()
+        outputs.append(output.getvalue())
+    assert outputs[0] == outputs[1]
+    # Clipped, before the 0.2 s of silence at the end.
+    samples = np.frombuffer(outputs[0][-40 - 202 : -40], dtype=np.int16)
+    assert (samples[0], samples[-1]) == (-32767, 32767)
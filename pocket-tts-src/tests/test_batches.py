@@ -0,0 +1,98 @@
+"""Tests for the batches of generations."""
+
+import io
+import json
+import time
+import zipfile
+
+import torch
+from conftest import FakeModel
+from fastapi.testclient import TestClient
+
+from pocket_tts import server
+from pocket_tts.admission import AdmissionController
+from pocket_tts.batches import BatchManager
+
+
+def synthesize(item):
+    if item["text"] == "fail":
+        raise RuntimeError("Cannot generate this one")
+    # One chunk of 10 samples per word.
+    return [torch.full((10,), 0.5) for _ in item["text"].split()]
+
+
+def make_manager(results_dir):
+    return BatchManager(results_dir, synthesize, lambda item: 1.0, sample_rate=100)
+
+
+def test_batch_items_are_generated_to_the_results_directory(tmp_path):
+    manager = make_manager(tmp_path)
+    batch = manager.submit([{"text": "Hello world.", "voice": "alba"}, {"text": "fail"}])
+    while (claimed := manager._claim_next()) is not None:
+        manager.generate(*claimed)
+
+    status = batch.as_dict()
+    assert status["status"] == "completed"
+    assert (status["completed"], status["failed"]) == (1, 1)
+    assert status["audio_seconds"] == 0.2
+    items = json.loads(batch.manifest_path.read_text())["items"]
+    assert items[0]["file"] == "00000.wav"
+    assert items[0]["voice"] == "alba"
+    assert items[1]["error"] == "Cannot generate this one"
+
+    with zipfile.ZipFile(manager.write_archive(batch)) as archive:
+        assert sorted(archive.namelist()) == ["00000.wav", "manifest.json"]
+
+    # Items running when the server stopped are generated again after a restart.
+    batch = manager.submit([{"text": "One."}, {"text": "Two."}])
+    manager._claim_next()
+    batch.save()
+    restarted = make_manager(tmp_path)
+    assert restarted.get(batch.batch_id).as_dict()["queued"] == 2
+
+
+def test_batches_api(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "batches", make_manager(tmp_path))
+    monkeypatch.setattr(server, "admission", AdmissionController(max_concurrency=2))
+    items = [{"text": f"Item number {i}."} for i in range(5)]
+    with TestClient(server.web_app) as client:
+        response = client.post("/batches", json={"items": items})
+        assert response.status_code == 202
+        batch_id = response.json()["batch_id"]
+        for _ in range(100):
+            if client.get(f"/batches/{batch_id}").json()["status"] == "completed":
+                break
+            time.sleep(0.05)
+
+        assert client.get(f"/batches/{batch_id}").json()["completed"] == 5
+        manifest = client.get(f"/batches/{batch_id}/manifest").json()
+        assert [item["text"] for item in manifest["items"]] == [item["text"] for item in items]
+        assert client.get(f"/batches/{batch_id}/items/4").headers["content-type"] == "audio/wav"
+        archive = zipfile.ZipFile(io.BytesIO(client.get(f"/batches/{batch_id}/archive").content))
+        assert len(archive.namelist()) == 6
+
+        assert client.post("/batches", json={"items": [{"text": " "}]}).status_code == 400
+        assert client.delete(f"/batches/{batch_id}").status_code == 200
+        assert client.get(f"/batches/{batch_id}").status_code == 404
+
+
+def test_batch_items_are_generated_with_their_parameters(tmp_path, monkeypatch):
+    model = FakeModel()
+    monkeypatch.setattr(server, "tts_model", model)
+    monkeypatch.setattr(server, "global_model_state", {})
+
+    def synthesize_item(**params):
+        return torch.cat(list(server.synthesize_batch_item({"text": "Hello.", **params})))
+
+    assert torch.equal(synthesize_item(), torch.full((10,), 6.0))
+    assert torch.equal(synthesize_item(lsd_steps=4), torch.full((10,), 24.0))
+    assert not torch.equal(synthesize_item(temperature=0.3), torch.full((10,), 6.0))
+    # The generations without parameters keep the ones of the model.
+    assert (model.temp, model.lsd_decode_steps) == (0.0, 1)
+    assert torch.equal(synthesize_item(), torch.full((10,), 6.0))
+
+    monkeypatch.setattr(server, "batches", make_manager(tmp_path))
+    client = TestClient(server.web_app)
+    for params in [{"temperature": -1}, {"temperature": "hot"}, {"lsd_steps": 0}]:
+        response = client.post("/batches", json={"items": [{"text": "Hello.", **params}]})
+        assert response.status_code == 400
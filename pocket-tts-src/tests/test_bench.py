@@ -0,0 +1,53 @@
+"""Tests for the benchmark command."""
+
+import json
+
+import pytest
+import torch
+from typer.testing import CliRunner
+
+from pocket_tts.bench import PeakRss, _summarize, rss_mb
+from pocket_tts.main import cli_app
+
+runner = CliRunner()
+
+
+def test_summarize():
+    generations = [
+        {"time_to_first_chunk": 0.1, "frame_latencies": [0.02, 0.04], "audio_duration": 1.0},
+        {"time_to_first_chunk": 0.3, "frame_latencies": [0.03], "audio_duration": 1.0},
+    ]
+    summary = _summarize(generations, wall_time=0.5)
+    assert summary["real_time_factor"] == 0.25
+    assert abs(summary["time_to_first_chunk_ms"]["mean"] - 200) < 1e-6
+    assert abs(summary["frame_latency_ms"]["p50"] - 30) < 1e-6
+
+
+@pytest.mark.skipif(rss_mb() is None, reason="Linux only")
+def test_peak_rss_is_measured_from_the_start_of_the_block():
+    with PeakRss() as peak_rss:
+        # 80 MB, written so that the pages are resident.
+        buffer = torch.ones(20_000_000)
+        del buffer
+    assert peak_rss.increase_mb > 60
+    with PeakRss() as peak_rss:
+        pass
+    assert peak_rss.increase_mb < 60
+
+
+def test_bench_writes_results(tmp_path):
+    output_file = tmp_path / "bench.json"
+
+    result = runner.invoke(
+        cli_app,
+        ["bench", "--num-threads", "1", "--num-threads", "2", "--output-path", str(output_file)],
+    )
+
+    assert result.exit_code == 0
+    results = json.loads(output_file.read_text())
+    assert [r["num_threads"] for r in results["results"]] == [1, 2]
+    for r in results["results"]:
+        assert r["real_time_factor"] > 0
+        assert r["time_to_first_chunk_ms"]["p50"] > 0
+        assert r["frame_latency_ms"]["p99"] >= r["frame_latency_ms"]["p50"]
+    assert all(size > 0 for size in results["model_state_mb"].values())
@@ -0,0 +1,63 @@
+"""Tests for the single-file model bundles."""
+
+from pathlib import Path
+
+import pytest
+import safetensors.torch
+import torch
+
+import pocket_tts
+from pocket_tts.bundle import load_bundle, pack_bundle
+from pocket_tts.default_parameters import DEFAULT_VARIANT
+from pocket_tts.utils.config import load_config
+
+
+@pytest.fixture
+def model_files(tmp_path, monkeypatch):
+    # The tokenizer is extracted in the cache directory.
+    monkeypatch.setenv("HOME", str(tmp_path))
+    config = load_config(Path(pocket_tts.__file__).parent / f"config/{DEFAULT_VARIANT}.yaml")
+
+    weights = {"flow_lm.emb_std": torch.randn(32), "mimi.decoder.weight": torch.randn(4, 3).half()}
+    config.weights_path = str(tmp_path / "missing.safetensors")
+    config.weights_path_without_voice_cloning = str(tmp_path / "weights.safetensors")
+    safetensors.torch.save_file(weights, config.weights_path_without_voice_cloning)
+
+    tokenizer_bytes = bytes(range(256)) * 3
+    config.flow_lm.lookup_table.tokenizer_path = str(tmp_path / "tokenizer.model")
+    Path(config.flow_lm.lookup_table.tokenizer_path).write_bytes(tokenizer_bytes)
+
+    voices = {}
+    for voice_name in ["alba", "marius"]:
+        voices[voice_name] = str(tmp_path / f"{voice_name}.safetensors")
+        safetensors.torch.save_file({"audio_prompt": torch.randn(1, 5, 1024)}, voices[voice_name])
+    return config, weights, tokenizer_bytes, voices
+
+
+def test_pack_and_load_bundle(tmp_path, model_files):
+    config, weights, tokenizer_bytes, voices = model_files
+    bundle_path = tmp_path / "pocket_tts.bundle"
+
+    pack_bundle(config, bundle_path, voices)
+    bundle = load_bundle(bundle_path)
+
+    assert not bundle.has_voice_cloning
+    assert bundle.state_dict.keys() == weights.keys()
+    for key, value in weights.items():
+        assert torch.equal(bundle.state_dict[key], value)
+    assert bundle.voices.keys() == voices.keys()
+    for voice_name, voice_path in voices.items():
+        expected = safetensors.torch.load_file(voice_path)["audio_prompt"]
+        assert torch.equal(bundle.voices[voice_name], expected)
+    assert bundle.tokenizer_path.read_bytes() == tokenizer_bytes
+    assert bundle.config.flow_lm.lookup_table.tokenizer_path == str(bundle.tokenizer_path)
+    assert bundle.config.mimi == config.mimi
+    assert bundle.config.weights_path is None
+
+
+def test_load_bundle_rejects_other_files(tmp_path):
+    path = tmp_path / "weights.safetensors"
+    safetensors.torch.save_file({"a": torch.zeros(1)}, path)
+
+    with pytest.raises(ValueError, match="not a pocket-tts bundle"):
+        load_bundle(path)
@@ -0,0 +1,42 @@
+"""Startup benchmark of the CLI: `--help` must not import the model or the web stack."""
+
+import json
+import subprocess
+import sys
+
+HEAVY_MODULES = ["torch", "fastapi", "uvicorn", "safetensors", "sentencepiece", "scipy"]
+# Importing torch alone takes more than this on any machine.
+MAX_STARTUP_SECONDS = 1.0
+
+STARTUP_SCRIPT = f"""
+import json, sys, time
+
+start = time.perf_counter()
+from pocket_tts.main import cli_app
+
+try:
+    cli_app(["--help"])
+except SystemExit:
+    pass
+elapsed = time.perf_counter() - start
+heavy = [name for name in {HEAVY_MODULES!r} if name in sys.modules]
+print(json.dumps({{"elapsed": elapsed, "heavy": heavy}}))
+"""
+
+
+def run_startup() -> dict:
+    # A new interpreter is needed, pytest has already imported everything.
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT], capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_help_does_not_import_heavy_modules():
+    assert run_startup()["heavy"] == []
+
+
+def test_help_startup_time():
+    # Best of three, to be robust to a noisy machine.
+    elapsed = min(run_startup()["elapsed"] for _ in range(3))
+    assert elapsed < MAX_STARTUP_SECONDS
@@ -0,0 +1,75 @@
+"""Tests for the executor of the generations and its auto-tune."""
+
+import asyncio
+import os
+import threading
+
+import pytest
+import torch
+from conftest import FakeModel
+
+from pocket_tts import executor
+from pocket_tts.executor import GenerationExecutor, auto_tune, candidate_sizes
+
+
+@pytest.fixture(autouse=True)
+def restore_num_threads():
+    num_threads = torch.get_num_threads()
+    yield
+    torch.set_num_threads(num_threads)
+
+
+def test_candidate_sizes():
+    assert candidate_sizes(8) == [(1, 4), (1, 8), (2, 2), (2, 4), (4, 1), (4, 2), (8, 1)]
+    assert candidate_sizes(8, num_workers=2) == [(2, 2), (2, 4)]
+    assert candidate_sizes(1) == [(1, 1)]
+
+
+def test_generations_run_with_the_torch_threads():
+    generation_executor = GenerationExecutor(2, threads_per_worker=1)
+    try:
+        assert torch.get_num_threads() == 1
+        assert generation_executor.submit(torch.get_num_threads).result() == 1
+        name = asyncio.run(generation_executor.run(lambda: threading.current_thread().name))
+        assert name.startswith("pocket-tts-generation")
+    finally:
+        generation_executor.shutdown()
+
+
+@pytest.mark.skipif(not hasattr(os, "sched_getaffinity"), reason="Linux only")
+def test_running_generations_are_pinned():
+    cpus = executor.available_cpus()
+    # One core per worker.
+    generation_executor = GenerationExecutor(len(cpus), threads_per_worker=1, pin_cpus=True)
+    try:
+        affinity = generation_executor.submit(os.sched_getaffinity, 0).result()
+    finally:
+        generation_executor.shutdown()
+    assert len(affinity) == 1 and affinity <= set(cpus)
+
+
+def test_auto_tune_picks_the_fastest_size(monkeypatch):
+    monkeypatch.setattr(executor, "available_cpus", lambda: [0, 1, 2, 3])
+    # Pretends that two workers with one torch thread each are the fastest.
+    monkeypatch.setattr(
+        executor,
+        "measure_frames_per_second",
+        lambda tts_model, model_state, generation_executor, text: (
+            10.0
+            if (generation_executor.num_workers, generation_executor.threads_per_worker) == (2, 1)
+            else 1.0
+        ),
+    )
+    assert auto_tune(FakeModel(), {}) == (2, 1)
+    assert auto_tune(FakeModel(), {}, num_workers=4) == (4, 1)
+
+
+def test_frames_per_second_are_measured_in_the_workers():
+    model = FakeModel()
+    generation_executor = GenerationExecutor(2, threads_per_worker=1)
+    try:
+        frames_per_second = executor.measure_frames_per_second(model, {}, generation_executor)
+    finally:
+        generation_executor.shutdown()
+    assert frames_per_second > 0
+    assert threading.get_ident() not in model.threads
@@ -0,0 +1,108 @@
+"""Tests for the checkpointed long-form jobs."""
+
+import asyncio
+
+import pytest
+import torch
+from conftest import FakeModel
+
+from pocket_tts import jobs
+from pocket_tts.admission import AdmissionController
+from pocket_tts.jobs import JobManager
+
+
+class Crash(BaseException):
+    """Stops a job like a crash of the process would, without marking it failed."""
+
+
+class CrashingModel(FakeModel):
+    """Scales the random frames by the voice, and crashes at the frame `crash_at_frame`."""
+
+    def __init__(self, crash_at_frame: int | None = None):
+        super().__init__(temp=1.0)
+        self.crash_at_frame = crash_at_frame
+        self.num_frames = 0
+
+    def generate_frame(self, model_state, word):
+        if self.num_frames == self.crash_at_frame:
+            raise Crash()
+        self.num_frames += 1
+        return super().generate_frame(model_state, word) * model_state["voice"]["scale"]
+
+
+@pytest.fixture(autouse=True)
+def fake_text_processing(monkeypatch):
+    monkeypatch.setattr(jobs, "split_text", lambda tts_model, text: text.split("|"))
+    monkeypatch.setattr(jobs, "estimate_cost", lambda tts_model, text: 1.0)
+
+
+MODEL_STATE = {"voice": {"scale": torch.tensor(0.5)}}
+# Three frames per chunk.
+TEXT = "First chunk here.|Second chunk here.|Third chunk here."
+
+
+def test_interrupted_jobs_resume_from_their_checkpoint(tmp_path):
+    torch.manual_seed(0)
+    manager = JobManager(tmp_path / "reference", CrashingModel())
+    reference = manager.submit(TEXT, MODEL_STATE, seed=1)
+    manager.run(reference)
+    assert reference.status == "completed"
+
+    # Crashes in the middle of the second chunk.
+    manager = JobManager(tmp_path / "jobs", CrashingModel(crash_at_frame=4))
+    job = manager.submit(TEXT, MODEL_STATE, seed=1)
+    with pytest.raises(Crash):
+        manager.run(job)
+
+    # A new worker resumes the job after its first chunk, whatever the global RNG.
+    torch.manual_seed(1)
+    model = CrashingModel()
+    manager = JobManager(tmp_path / "jobs", model)
+    job = manager.get(job.job_id)
+    assert job.status == "queued"
+    assert job.chunks_done == 1
+    assert manager.next_job() is job
+    manager.run(job)
+    assert model.num_frames == 6
+    assert job.as_dict()["progress"] == 1.0
+    assert job.audio_path.read_bytes() == reference.audio_path.read_bytes()
+    assert not (job.job_dir / "audio.pcm").exists()
+
+
+def test_jobs_are_served_in_generation_slots(tmp_path):
+    async def scenario():
+        manager = JobManager(tmp_path, CrashingModel())
+        # No request preempts the job.
+        controller = AdmissionController(max_concurrency=1, preemption_ratio=None)
+        job = manager.submit(TEXT, MODEL_STATE)
+        cancelled = manager.submit(TEXT, MODEL_STATE)
+        assert manager.cancel(cancelled.job_id).status == "cancelled"
+        assert not cancelled.job_dir.exists()
+
+        task = asyncio.create_task(manager.serve(controller))
+        for _ in range(100):
+            if job.status in ("completed", "failed"):
+                break
+            await asyncio.sleep(0.05)
+        assert job.status == "completed"
+        task.cancel()
+        assert controller.status()["running"] == 0
+        assert [j.job_id for j in manager.jobs()] == [job.job_id]
+
+    asyncio.run(scenario())
+
+
+def test_jobs_leave_the_global_rng_alone(tmp_path):
+    manager = JobManager(tmp_path, CrashingModel())
+    job = manager.submit(TEXT, MODEL_STATE, seed=1)
+    torch.manual_seed(0)
+    manager.run(job)
+    after_job = torch.randn(10)
+
+    # The nine frames of the job drew from the global RNG (their noise is then drawn again
+    # from the generator of the job), and nothing reset it: the other generations running
+    # meanwhile keep their sequence.
+    torch.manual_seed(0)
+    for _ in range(9):
+        torch.randn(10)
+    assert torch.equal(after_job, torch.randn(10))
@@ -0,0 +1,77 @@
+"""Tests for the Prometheus metrics."""
+
+import pytest
+import torch
+from fastapi.testclient import TestClient
+
+from pocket_tts import metrics, server
+
+
+def _chunks(num_chunks: int, fail: bool = False):
+    for _ in range(num_chunks):
+        yield torch.zeros(1920)
+    if fail:
+        raise RuntimeError("generation failed")
+
+
+def test_histogram_exposition():
+    histogram = metrics.Histogram("test_seconds", "Test histogram.", (0.1, 1.0))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5.0)
+    assert histogram.collect() == [
+        "# HELP test_seconds Test histogram.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1.0"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        "test_seconds_sum 5.55",
+        "test_seconds_count 3",
+    ]
+
+
+def test_instrument_stream_records_completed_generation():
+    count = metrics.GENERATION_SECONDS.count
+    frames_sum = metrics.FRAMES_PER_REQUEST.sum
+
+    chunks = list(metrics.instrument_stream(_chunks(5), sample_rate=24000))
+
+    assert len(chunks) == 5
+    assert metrics.GENERATION_SECONDS.count == count + 1
+    assert metrics.FRAMES_PER_REQUEST.sum == frames_sum + 5
+    assert metrics.ACTIVE_GENERATIONS.get() == 0
+
+
+def test_instrument_stream_records_cancellation():
+    cancellations = metrics.CANCELLATIONS.value
+    audio_chunks = _chunks(5)
+
+    stream = metrics.instrument_stream(audio_chunks, sample_rate=24000)
+    next(stream)
+    assert metrics.ACTIVE_GENERATIONS.get() == 1
+    stream.close()
+
+    assert metrics.CANCELLATIONS.value == cancellations + 1
+    assert metrics.ACTIVE_GENERATIONS.get() == 0
+    # The generation itself is stopped too.
+    assert next(audio_chunks, None) is None
+
+
+def test_instrument_stream_records_error():
+    errors = metrics.ERRORS.value
+
+    with pytest.raises(RuntimeError):
+        list(metrics.instrument_stream(_chunks(2, fail=True), sample_rate=24000))
+
+    assert metrics.ERRORS.value == errors + 1
+    assert metrics.ACTIVE_GENERATIONS.get() == 0
+
+
+def test_metrics_endpoint():
+    client = TestClient(server.web_app)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "# TYPE pocket_tts_active_generations gauge" in response.text
+    assert "pocket_tts_time_to_first_audio_seconds_count" in response.text
@@ -0,0 +1,103 @@
+"""Microbenchmarks of the hot components, at the shapes of the b6369a24 config.
+
+Run them with `pytest --benchmark`. A microbenchmark fails when it is slower than its
+baseline in `microbenchmark_baselines.json` by more than `--benchmark-tolerance`.
+After an intended change, refresh the baselines with `pytest --benchmark-save`.
+"""
+
+import math
+from pathlib import Path
+
+import pytest
+import torch
+
+from pocket_tts.modules.mimi_transformer import MimiStreamingMultiheadAttention
+from pocket_tts.modules.mlp import SimpleMLPAdaLN
+from pocket_tts.modules.rope import RotaryEmbedding, apply_rope
+from pocket_tts.modules.seanet import SEANetDecoder, SEANetEncoder
+from pocket_tts.modules.stateful_module import init_states
+from pocket_tts.modules.transformer import StreamingMultiheadAttention
+from pocket_tts.utils.config import load_config
+
+pytestmark = pytest.mark.benchmark
+
+CONFIG = load_config(Path(__file__).parents[1] / "pocket_tts/config/b6369a24.yaml")
+FLOW_LM = CONFIG.flow_lm.transformer
+MIMI = CONFIG.mimi.transformer
+LATENT_DIM = CONFIG.mimi.quantizer.dimension
+FRAME_SIZE = int(CONFIG.mimi.sample_rate / CONFIG.mimi.frame_rate)
+# Number of SEANet steps (and Mimi transformer steps) in one frame of audio.
+STEPS_PER_FRAME = FRAME_SIZE // math.prod(CONFIG.mimi.seanet.ratios)
+
+
+@pytest.mark.parametrize("context_length", [0, 100, 500, 1000])
+def test_flow_lm_attention(microbenchmark, context_length):
+    attention = StreamingMultiheadAttention(
+        FLOW_LM.d_model, FLOW_LM.num_heads, RotaryEmbedding(FLOW_LM.max_period)
+    )
+    model_state = init_states(attention, batch_size=1, sequence_length=context_length + 1)
+    model_state[""]["cache"].normal_()
+    model_state[""]["current_end"] = torch.zeros(context_length)
+    query = torch.randn(1, 1, FLOW_LM.d_model)
+
+    microbenchmark(lambda: attention(query, model_state))
+
+
+def test_mimi_attention(microbenchmark):
+    attention = MimiStreamingMultiheadAttention(
+        MIMI.d_model, MIMI.num_heads, MIMI.context, RotaryEmbedding(MIMI.max_period)
+    )
+    model_state = init_states(attention, batch_size=1, sequence_length=MIMI.context)
+    model_state[""]["cache"].normal_()
+    query = torch.randn(1, STEPS_PER_FRAME, MIMI.d_model)
+
+    def step():
+        # The cache stays full, as after the first 250 steps of a generation.
+        model_state[""]["offset"].fill_(MIMI.context)
+        model_state[""]["end_offset"].fill_(MIMI.context)
+        attention(query, model_state)
+
+    microbenchmark(step)
+
+
+@pytest.mark.parametrize("num_steps", [1, 100])
+def test_apply_rope(microbenchmark, num_steps):
+    head_dim = FLOW_LM.d_model // FLOW_LM.num_heads
+    q = torch.randn(1, num_steps, FLOW_LM.num_heads, head_dim)
+    k = torch.randn(1, num_steps, FLOW_LM.num_heads, head_dim)
+
+    microbenchmark(lambda: apply_rope(q, k, offset=500, max_period=FLOW_LM.max_period))
+
+
+@pytest.mark.parametrize("lsd_decode_steps", [1, 2, 4])
+def test_flow_net(microbenchmark, lsd_decode_steps):
+    flow_net = SimpleMLPAdaLN.from_pydantic_config(CONFIG.flow_lm, LATENT_DIM, FLOW_LM.d_model)
+    condition = torch.randn(1, FLOW_LM.d_model)
+    noise = torch.randn(1, LATENT_DIM)
+
+    def decode():
+        # Same loop as `lsd_decode`, one flow net call per step.
+        current = noise.clone()
+        for i in range(lsd_decode_steps):
+            s = torch.full((1, 1), i / lsd_decode_steps)
+            t = torch.full((1, 1), (i + 1) / lsd_decode_steps)
+            current += flow_net(condition, s, t, current) / lsd_decode_steps
+        return current
+
+    microbenchmark(decode)
+
+
+def test_seanet_decoder_frame(microbenchmark):
+    decoder = SEANetDecoder(**CONFIG.mimi.seanet.model_dump())
+    model_state = init_states(decoder, batch_size=1, sequence_length=1)
+    latent = torch.randn(1, CONFIG.mimi.seanet.dimension, STEPS_PER_FRAME)
+
+    microbenchmark(lambda: decoder(latent, model_state))
+
+
+def test_seanet_encoder_frame(microbenchmark):
+    encoder = SEANetEncoder(**CONFIG.mimi.seanet.model_dump())
+    model_state = init_states(encoder, batch_size=1, sequence_length=1)
+    audio = torch.randn(1, CONFIG.mimi.channels, FRAME_SIZE)
+
+    microbenchmark(lambda: encoder(audio, model_state))
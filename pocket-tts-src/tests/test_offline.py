@@ -0,0 +1,82 @@
+"""Tests for the offline batch mode of `pocket-tts generate`."""
+
+import json
+
+import pytest
+import torch
+
+from pocket_tts.data.audio import audio_read
+from pocket_tts.offline import read_rows, run_batch
+
+
+class FakeModel:
+    """Generates one chunk of 10 samples per word, at the amplitude of the temperature."""
+
+    sample_rate = 100
+
+    def __init__(self):
+        self.temp = 0.5
+        self.lsd_decode_steps = 1
+        self.noise_clamp = None
+        self.eos_threshold = -4.0
+        self.voices = []
+
+    def get_state_for_audio_prompt(self, voice):
+        self.voices.append(voice)
+        return {"voice": voice}
+
+    def generate_audio_stream(self, model_state, text_to_generate, frames_after_eos=None):
+        if text_to_generate == "fail":
+            raise RuntimeError("Cannot generate this one")
+        for _ in text_to_generate.split():
+            yield torch.full((10,), self.temp)
+
+
+def load_fake_model():
+    return FakeModel()
+
+
+LINES = [
+    json.dumps({"text": "Hello world.", "voice": "marius"}),
+    "",
+    json.dumps({"text": "Louder, please.", "temperature": 0.9, "output": "loud/0.wav"}),
+    json.dumps({"text": "fail"}),
+    json.dumps({"text": "Back to alba."}),
+]
+
+
+def test_rows_are_generated_with_one_model(tmp_path):
+    model = FakeModel()
+    rows = read_rows(LINES, default_voice="alba")
+    assert [row["output"] for row in rows] == ["00000.wav", "loud/0.wav", "00002.wav", "00003.wav"]
+
+    summary = run_batch(rows, lambda: model, tmp_path, rows_per_task=2)
+    assert summary["rows_done"] == 4
+    assert summary["rows_failed"] == 1
+    # One state per voice, and the parameters of a row do not leak to the next ones.
+    assert sorted(model.voices) == ["alba", "marius"]
+    assert model.temp == 0.5
+    audio, sample_rate = audio_read(tmp_path / "loud" / "0.wav")
+    assert sample_rate == 100
+    assert audio[0, 0].item() == pytest.approx(0.9, abs=1e-3)
+
+    manifest = [json.loads(line) for line in (tmp_path / "manifest.jsonl").read_text().splitlines()]
+    assert [result["index"] for result in manifest] == [0, 1, 2, 3]
+    assert manifest[0]["audio_seconds"] == 0.2
+    assert manifest[2]["error"] == "Cannot generate this one"
+    assert not (tmp_path / "00002.wav").exists()
+
+
+def test_rows_are_generated_by_a_pool_of_processes(tmp_path):
+    rows = read_rows([json.dumps({"text": f"Row number {i}."}) for i in range(6)], "alba")
+    summary = run_batch(rows, load_fake_model, tmp_path, num_workers=2, rows_per_task=2)
+    assert summary["rows_done"] == 6
+    assert summary["rows_failed"] == 0
+    assert sorted(path.name for path in tmp_path.glob("*.wav")) == [
+        f"{i:05d}.wav" for i in range(6)
+    ]
+
+
+def test_invalid_rows_are_reported_with_their_line():
+    with pytest.raises(ValueError, match="Line 2"):
+        read_rows(['{"text": "Fine."}', '{"txt": "Typo."}'], "alba")
@@ -0,0 +1,60 @@
+"""Parity tests between the torch model and the graphs exported to ONNX."""
+
+import numpy as np
+import pytest
+from typer.testing import CliRunner
+
+pytest.importorskip("onnxruntime")
+
+from pocket_tts import TTSModel
+from pocket_tts.data.audio import audio_read
+from pocket_tts.export.graphs import export_onnx
+from pocket_tts.export.runtime import OnnxTTSModel
+from pocket_tts.main import cli_app
+
+runner = CliRunner()
+
+
+@pytest.fixture(scope="module")
+def models(tmp_path_factory):
+    # Without noise, generation is deterministic so both backends can be compared.
+    tts_model = TTSModel.load_model(temp=0.0)
+    export_dir = tmp_path_factory.mktemp("onnx")
+    export_onnx(tts_model, export_dir)
+    return tts_model, OnnxTTSModel(export_dir, temp=0.0), export_dir
+
+
+@pytest.mark.parametrize(
+    "text", ["Hello world, this is a test.", "This is a longer text to test the TTS system. " * 3]
+)
+def test_onnx_generation_matches_torch(models, text):
+    tts_model, onnx_model, _ = models
+
+    expected = tts_model.generate_audio(tts_model.get_state_for_audio_prompt("alba"), text)
+    audio = onnx_model.generate_audio(onnx_model.get_state_for_audio_prompt("alba"), text)
+
+    assert audio.shape == tuple(expected.shape)
+    np.testing.assert_allclose(audio, expected.numpy(), atol=1e-3)
+
+
+def test_generate_with_onnx_dir(models, tmp_path):
+    _, _, export_dir = models
+    output_file = tmp_path / "onnx_output.wav"
+
+    result = runner.invoke(
+        cli_app,
+        [
+            "generate",
+            "--text",
+            "Testing the ONNX backend.",
+            "--onnx-dir",
+            str(export_dir),
+            "--output-path",
+            str(output_file),
+        ],
+    )
+
+    assert result.exit_code == 0
+    audio, sample_rate = audio_read(str(output_file))
+    assert audio.shape[1] > 0
+    assert sample_rate == 24000
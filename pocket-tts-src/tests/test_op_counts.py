@@ -0,0 +1,82 @@
+"""Op and allocation counts of the streaming steps, at the shapes of the b6369a24 config.
+
+They are deterministic, so unlike the microbenchmarks they run on every test run and fail
+as soon as a step runs more aten ops or allocates more than its baseline in
+`op_count_baselines.json`. After an intended change, refresh the baselines with
+`pytest tests/test_op_counts.py --op-counts-save`.
+"""
+
+import math
+from pathlib import Path
+
+import torch
+
+from pocket_tts.modules.mimi_transformer import ProjectedTransformer, StreamingTransformer
+from pocket_tts.modules.mlp import SimpleMLPAdaLN
+from pocket_tts.modules.resample import ConvTrUpsample1d
+from pocket_tts.modules.seanet import SEANetDecoder
+from pocket_tts.modules.stateful_module import init_states
+from pocket_tts.utils.config import load_config
+from pocket_tts.utils.debugging import CountingMode
+
+CONFIG = load_config(Path(__file__).parents[1] / "pocket_tts/config/b6369a24.yaml")
+FLOW_LM = CONFIG.flow_lm.transformer
+LATENT_DIM = CONFIG.mimi.quantizer.dimension
+ENCODER_FRAME_RATE = CONFIG.mimi.sample_rate / math.prod(CONFIG.mimi.seanet.ratios)
+# Number of SEANet steps (and Mimi transformer steps) in one frame of audio.
+STEPS_PER_FRAME = int(ENCODER_FRAME_RATE / CONFIG.mimi.frame_rate)
+
+
+def test_counting_mode():
+    x = torch.randn(4, 4)
+    with CountingMode() as mode:
+        y = x @ x  # allocates
+        y.add_(1)  # in place
+        y.view(16)  # view
+    summary = mode.summary()
+    assert summary["op_counts"] == {
+        "aten.add_.Tensor": 1,
+        "aten.mm.default": 1,
+        "aten.view.default": 1,
+    }
+    assert summary["allocations"] == 1
+    assert summary["allocated_bytes"] == 16 * 4
+
+
+def test_flow_lm_step(op_counts):
+    transformer = StreamingTransformer.from_pydantic_config(FLOW_LM)
+    model_state = init_states(transformer, batch_size=1, sequence_length=200)
+    for module_state in model_state.values():
+        module_state["current_end"] = torch.zeros(100)
+    x = torch.randn(1, 1, FLOW_LM.d_model)
+
+    op_counts(lambda: transformer(x, model_state))
+
+
+def test_flow_net_step(op_counts):
+    flow_net = SimpleMLPAdaLN.from_pydantic_config(CONFIG.flow_lm, LATENT_DIM, FLOW_LM.d_model)
+    condition = torch.randn(1, FLOW_LM.d_model)
+    x = torch.randn(1, LATENT_DIM)
+    s, t = torch.zeros(1, 1), torch.ones(1, 1)
+
+    op_counts(lambda: flow_net(condition, s, t, x))
+
+
+def test_mimi_decode_frame(op_counts):
+    upsample = ConvTrUpsample1d(STEPS_PER_FRAME, CONFIG.mimi.quantizer.output_dimension)
+    transformer = ProjectedTransformer(**CONFIG.mimi.transformer.model_dump())
+    decoder = SEANetDecoder(**CONFIG.mimi.seanet.model_dump())
+    mimi = torch.nn.ModuleDict(
+        {"upsample": upsample, "transformer": transformer, "decoder": decoder}
+    )
+    model_state = init_states(mimi, batch_size=1, sequence_length=CONFIG.mimi.transformer.context)
+    latent = torch.randn(1, CONFIG.mimi.quantizer.output_dimension, 1)
+
+    def decode_frame():
+        # Same steps as `MimiModel.decode_from_latent`.
+        emb = upsample(latent, model_state)
+        (emb,) = transformer(emb, model_state)
+        return decoder(emb, model_state)
+
+    decode_frame()
+    op_counts(decode_frame)
@@ -0,0 +1,77 @@
+"""Tests for the generation of the segments of long texts at once."""
+
+import threading
+
+import pytest
+import torch
+from conftest import FakeModel
+
+from pocket_tts import parallel
+from pocket_tts.parallel import crossfade_segments, generate_parallel_audio_stream
+
+
+@pytest.fixture(autouse=True)
+def fake_text_processing(monkeypatch):
+    monkeypatch.setattr(parallel, "split_text", lambda tts_model, text: text.split("|"))
+
+
+class WaitingModel(FakeModel):
+    """Generates the word "waits" only once the first chunk of the audio has been read."""
+
+    def __init__(self):
+        super().__init__()
+        self.first_chunk_read = threading.Event()
+
+    def generate_frame(self, model_state, word):
+        if word == "waits":
+            assert self.first_chunk_read.wait(timeout=5)
+        return super().generate_frame(model_state, word)
+
+
+def test_segments_are_crossfaded():
+    segments = [[torch.ones(10)], [torch.full((5,), 3.0), torch.full((5,), 3.0)]]
+    audio = torch.cat(list(crossfade_segments(segments, crossfade_samples=4)))
+    assert audio.shape == (16,)
+    assert torch.equal(audio[:6], torch.ones(6))
+    assert torch.equal(audio[10:], torch.full((6,), 3.0))
+    assert torch.all(torch.diff(audio[5:11]) > 0)
+
+
+def test_segments_are_generated_at_once_and_stitched_in_order():
+    model = WaitingModel()
+    stream = generate_parallel_audio_stream(
+        model, {}, "a|waits|abc\n\nab", num_workers=3, crossfade_seconds=0.0
+    )
+    first_chunk = next(stream)
+    model.first_chunk_read.set()
+    audio = torch.cat([first_chunk, *stream])
+
+    sequential = torch.cat(list(model.generate_audio_stream({}, "a waits abc ab")))
+    assert torch.equal(audio, sequential)
+    assert len(model.threads) > 1
+
+
+def test_one_worker_generates_the_text_as_is():
+    model = WaitingModel()
+    model.first_chunk_read.set()
+    audio = list(generate_parallel_audio_stream(model, {}, "a waits", num_workers=1))
+    assert len(audio) == 2
+    assert model.threads == {threading.get_ident()}
+
+
+def test_the_first_clause_is_a_segment_of_its_own():
+    model = WaitingModel()
+    model.first_chunk_read.set()
+    stream = generate_parallel_audio_stream(
+        model,
+        {},
+        "When the night falls on the city, the lights come on.|Then the people go home.",
+        num_workers=1,
+        first_clause=True,
+        crossfade_seconds=0.0,
+    )
+    # Three segments, the first one of the words of the clause.
+    chunks = list(stream)
+    clause = ["When", "the", "night", "falls", "on", "the", "city,"]
+    assert [chunk[0].item() for chunk in chunks[: len(clause)]] == [len(w) for w in clause]
+    assert sum(chunk.shape[-1] for chunk in chunks) == 160
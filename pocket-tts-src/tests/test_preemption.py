@@ -0,0 +1,114 @@
+"""Tests for the pause and resume of generations."""
+
+import threading
+import time
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+
+from pocket_tts.preemption import Generation, Preemption
+
+
+class CountingTransformer(nn.Module):
+    """Appends a step to a cache, like the streaming transformer of the FlowLM."""
+
+    def forward(self, x, model_state):
+        state = model_state["layer"]
+        state["cache"] = torch.cat([state["cache"], x])
+        state["current_end"] = state["current_end"] + 1
+        return x
+
+
+def test_paused_generations_resume_where_they_stopped(tmp_path):
+    transformer = CountingTransformer()
+    preemption = Preemption(SimpleNamespace(flow_lm=SimpleNamespace(transformer=transformer)))
+    generation = Generation(spill_dir=tmp_path)
+    model_state = {"layer": {"cache": torch.zeros(0), "current_end": 0}}
+    steps = []
+
+    def generate():
+        # Runs the frames in another thread, like `TTSModel._generate`.
+        for i in range(10):
+            transformer(torch.tensor([float(i)]), model_state)
+            steps.append(i)
+
+    with preemption.track(generation):
+        # The text prompt runs in the tracked thread, it is never paused.
+        generation.pause()
+        transformer(torch.tensor([-1.0]), model_state)
+        thread = threading.Thread(target=generate)
+        thread.start()
+        time.sleep(0.1)
+        assert steps == []
+        # The model state is on disk while the generation is paused.
+        assert model_state["layer"]["cache"] is None
+        assert len(list(tmp_path.iterdir())) == 1
+
+        generation.resume()
+        thread.join()
+
+    assert steps == list(range(10))
+    assert model_state["layer"]["current_end"] == 11
+    assert model_state["layer"]["cache"].tolist() == [-1.0, *map(float, range(10))]
+    assert list(tmp_path.iterdir()) == []
+    preemption.remove()
+
+
+def test_joined_threads_are_paused_with_the_generation():
+    transformer = CountingTransformer()
+    preemption = Preemption(SimpleNamespace(flow_lm=SimpleNamespace(transformer=transformer)))
+    generation = Generation()
+    model_state = {"layer": {"cache": torch.zeros(0), "current_end": 0}}
+
+    def generate_segment():
+        # A worker generating a segment of the text, prompt then frames.
+        with preemption.join(generation):
+            transformer(torch.tensor([-1.0]), model_state)
+            frames = threading.Thread(target=transformer, args=(torch.tensor([0.0]), model_state))
+            frames.start()
+            frames.join()
+
+    with preemption.track(generation):
+        generation.pause()
+        worker = threading.Thread(target=generate_segment)
+        worker.start()
+        time.sleep(0.1)
+        assert model_state["layer"]["current_end"] == 1
+        generation.resume()
+        worker.join()
+
+    assert model_state["layer"]["current_end"] == 2
+    preemption.remove()
+
+
+def test_states_are_forgotten_when_their_thread_leaves():
+    transformer = CountingTransformer()
+    preemption = Preemption(SimpleNamespace(flow_lm=SimpleNamespace(transformer=transformer)))
+    generation = Generation()
+
+    def generate_segment():
+        with preemption.join(generation):
+            # A copy of the state, freed when the segment is done.
+            transformer(torch.tensor([0.0]), {"layer": {"cache": torch.zeros(0), "current_end": 0}})
+            assert len(preemption._by_state) == 2
+
+    with preemption.track(generation):
+        model_state = {"layer": {"cache": torch.zeros(0), "current_end": 0}}
+        transformer(torch.tensor([0.0]), model_state)
+        worker = threading.Thread(target=generate_segment)
+        worker.start()
+        worker.join()
+        # The state of the request is still known, the one of the finished segment is not,
+        # so that its id can be reused by another generation.
+        assert list(preemption._by_state) == [id(model_state)]
+        generation.pause()
+        other_state = {"layer": {"cache": torch.zeros(0), "current_end": 0}}
+        threading.Thread(target=transformer, args=(torch.tensor([0.0]), other_state)).start()
+        time.sleep(0.1)
+        # A generation which is not tracked is never paused.
+        assert other_state["layer"]["current_end"] == 1
+        generation.resume()
+
+    assert preemption._by_state == {}
+    preemption.remove()
@@ -0,0 +1,65 @@
+"""Tests for the per-module profiling hooks."""
+
+import json
+
+import torch
+from torch import nn
+
+from pocket_tts.utils.profiling import ModuleProfiler, profile_generation, profiling_enabled
+
+
+class Block(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.linear = nn.Linear(4, 4)
+
+    def forward(self, x):
+        return self.linear(x)
+
+
+class Model(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.layers = nn.ModuleList([Block(), Block()])
+        self.decoder = nn.Identity()
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = layer(x)
+        return self.decoder(x)
+
+
+def test_module_profiler(tmp_path):
+    model = Model()
+    with ModuleProfiler(model, patterns=["layers.*"], frame_module="decoder") as profiler:
+        for _ in range(3):
+            model(torch.randn(1, 4))
+
+    assert profiler.num_frames == 3
+    rows = profiler.breakdown()
+    # `*` matches one level only, so the linear layers inside the blocks are not timed.
+    assert sorted(row["module"] for row in rows) == ["layers.0", "layers.1"]
+    assert all(row["calls"] == 3 and row["type"] == "Block" for row in rows)
+    assert "layers.0" in profiler.format_table()
+
+    trace_path = tmp_path / "trace.json"
+    profiler.write_chrome_trace(trace_path)
+    events = json.loads(trace_path.read_text())["traceEvents"]
+    assert len(events) == 6
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+
+    # The hooks are removed on exit.
+    model(torch.randn(1, 4))
+    assert profiler.num_frames == 3
+
+
+def test_profile_generation_is_opt_in(monkeypatch):
+    monkeypatch.delenv("POCKET_TTS_PROFILE", raising=False)
+    assert not profiling_enabled()
+    with profile_generation(Model()) as profiler:
+        assert profiler is None
+    with profile_generation(Model(), requested=True) as profiler:
+        assert profiler is not None
+
+    monkeypatch.setenv("POCKET_TTS_PROFILE", "1")
+    assert profiling_enabled()
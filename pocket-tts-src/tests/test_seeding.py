@@ -0,0 +1,79 @@
+"""Tests for the random generators of the generations."""
+
+import threading
+
+import torch
+from conftest import FakeModel
+
+from pocket_tts import parallel
+from pocket_tts.parallel import generate_parallel_audio_stream
+from pocket_tts.seeding import get_seeding, seeded_generator
+
+
+def generate(model, seed, barrier=None):
+    with get_seeding(model).use(seeded_generator(seed)):
+        if barrier is not None:
+            barrier.wait()
+        # Words of 3 letters, frames of 3 plus the noise.
+        return torch.cat(list(model.generate_audio_stream({}, "one two six ten")))
+
+
+def test_seeded_generations_are_reproducible_at_once():
+    model = FakeModel(temp=0.5, noise_clamp=1.0)
+    reference = generate(model, seed=7)
+    assert (reference - 3).abs().max() <= model.noise_clamp
+
+    barrier = threading.Barrier(4)
+    results = {}
+
+    def run(i):
+        results[i] = generate(model, seed=7 if i % 2 == 0 else 8, barrier=barrier)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert torch.equal(results[0], reference)
+    assert torch.equal(results[2], reference)
+    assert torch.equal(results[1], results[3])
+    assert not torch.equal(results[1], reference)
+    # Without a generator, the global RNG is used.
+    torch.manual_seed(0)
+    assert not torch.equal(torch.cat(list(model.generate_audio_stream({}, "one"))), reference[:10])
+
+
+def test_segments_draw_from_generators_of_their_own(monkeypatch):
+    monkeypatch.setattr(parallel, "split_text", lambda tts_model, text: text.split("|"))
+    model = FakeModel(temp=0.5, noise_clamp=1.0)
+    # The same audio, whatever the order in which the workers generate the segments.
+    audio = [
+        torch.cat(
+            list(
+                generate_parallel_audio_stream(
+                    model,
+                    {},
+                    "one two|three|four five six",
+                    num_workers,
+                    crossfade_seconds=0.0,
+                    generator=seeded_generator(3),
+                )
+            )
+        )
+        for num_workers in (2, 3, 3)
+    ]
+    assert torch.equal(audio[0], audio[1])
+    assert torch.equal(audio[1], audio[2])
+
+
+def test_states_are_kept_until_their_generation_ends():
+    model = FakeModel(temp=0.5, noise_clamp=1.0)
+    seeding = get_seeding(model)
+    with seeding.use(seeded_generator(1)):
+        audio_chunks = model.generate_audio_stream({}, "one two")
+        next(audio_chunks)
+        # The copied state is mapped, and alive so that its id is not reused.
+        ((state, _),) = seeding._by_state.values()
+        assert isinstance(state, dict)
+        list(audio_chunks)
+    assert seeding._by_state == {}
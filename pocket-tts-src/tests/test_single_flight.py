@@ -0,0 +1,94 @@
+"""Tests for the coalescing of identical requests running at once."""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from conftest import FakeModel
+from fastapi.testclient import TestClient
+
+from pocket_tts import server
+from pocket_tts.single_flight import SingleFlight
+
+
+async def read_all(flight, delay=0.0):
+    chunks = []
+    async for chunk in flight.read():
+        chunks.append(chunk)
+        await asyncio.sleep(delay)
+    return chunks
+
+
+def test_followers_read_the_bytes_of_the_leader_from_the_start():
+    async def main():
+        single_flight = SingleFlight()
+        flight, leading = single_flight.join("key")
+        assert leading
+        chunks = [b"RIFF", b"one", b"two", b"three"]
+        flight.write(chunks[0])
+
+        follower, leading = single_flight.join("key")
+        assert follower is flight
+        assert not leading
+        assert await follower.wait_started()
+        # A slow reader does not hold back the other one.
+        readers = [asyncio.create_task(read_all(flight, delay)) for delay in (0.0, 0.01)]
+
+        def generate():
+            for chunk in chunks[1:]:
+                flight.write(chunk)
+            flight.close()
+
+        thread = threading.Thread(target=generate)
+        thread.start()
+        fast, slow = await asyncio.gather(*readers)
+        thread.join()
+        assert fast == chunks
+        assert slow == chunks
+        # The next identical request leads a new flight.
+        assert len(single_flight) == 0
+        assert single_flight.join("key")[1]
+
+    asyncio.run(main())
+
+
+def test_followers_of_a_failed_leader_generate_themselves():
+    async def main():
+        single_flight = SingleFlight()
+        flight, _ = single_flight.join("key")
+        follower, leading = single_flight.join("key")
+        assert not leading
+        waiting = asyncio.create_task(follower.wait_started())
+        await asyncio.sleep(0)
+        flight.close()
+        assert not await waiting
+        assert single_flight.join("key")[1]
+
+    asyncio.run(main())
+
+
+def test_seeded_audio_under_load_is_what_the_seed_reproduces(monkeypatch):
+    # Identical seeded requests are only coalesced if they all give the same audio.
+    model = FakeModel(temp=0.7)
+    model.lsd_decode_steps, model.eos_threshold = 1, -4.0
+    model.config = SimpleNamespace(mimi=SimpleNamespace(sample_rate=model.sample_rate))
+    monkeypatch.setattr(server, "tts_model", model)
+    monkeypatch.setattr(server, "global_model_state", {})
+    monkeypatch.setattr(server, "utterance_cache", None)
+    monkeypatch.setattr(server, "estimate_cost", lambda tts_model, text: 1.0)
+    seeded = {"text": "one two three four five six", "seed": 5}
+
+    # The requests share the event loop of the client, the flights are created on it.
+    with TestClient(server.web_app) as client:
+        # Unseeded requests draw from the global RNG meanwhile.
+        with ThreadPoolExecutor(6) as pool:
+            responses = list(
+                pool.map(
+                    lambda i: client.post("/tts", data=seeded if i % 2 else {"text": "one two"}),
+                    range(6),
+                )
+            )
+        alone = client.post("/tts", data=seeded)
+    assert alone.status_code == 200
+    assert all(response.content == alone.content for response in responses[1::2])
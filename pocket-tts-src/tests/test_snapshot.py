@@ -0,0 +1,48 @@
+"""Tests for the snapshots of a ready-to-serve process."""
+
+import os
+
+import pytest
+import torch
+
+from pocket_tts.snapshot import compute_fingerprint, load_snapshot, save_snapshot
+
+
+def test_fingerprint_changes_with_inputs(tmp_path):
+    weights = tmp_path / "weights.safetensors"
+    missing = tmp_path / "missing.safetensors"
+    weights.write_bytes(b"weights")
+
+    fingerprint = compute_fingerprint([weights, missing])
+    assert compute_fingerprint([weights, missing]) == fingerprint
+
+    stat = weights.stat()
+    os.utime(weights, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert compute_fingerprint([weights, missing]) != fingerprint
+
+    fingerprint = compute_fingerprint([weights, missing])
+    missing.write_bytes(b"now it exists")
+    assert compute_fingerprint([weights, missing]) != fingerprint
+
+
+def test_snapshot_round_trip(tmp_path):
+    from pocket_tts import TTSModel
+
+    tts_model = TTSModel.load_model(temp=0)
+    voice_state = tts_model.get_state_for_audio_prompt("alba")
+    path = tmp_path / "pocket_tts.snapshot"
+    fingerprint = compute_fingerprint([])
+
+    save_snapshot(path, {"default": tts_model}, {"default": {"alba": voice_state}}, fingerprint)
+    models, voice_states = load_snapshot(path, fingerprint, 0, 1, None, -4.0)
+
+    restored_model = models["default"]
+    assert restored_model.has_voice_cloning == tts_model.has_voice_cloning
+    expected = tts_model.generate_audio(voice_state, "Hello world, this is a test.")
+    restored = restored_model.generate_audio(
+        voice_states["default"]["alba"], "Hello world, this is a test."
+    )
+    torch.testing.assert_close(restored, expected)
+
+    with pytest.raises(ValueError, match="stale"):
+        load_snapshot(path, "another fingerprint", 0, 1, None, -4.0)
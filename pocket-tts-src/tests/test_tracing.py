@@ -0,0 +1,79 @@
+"""Tests for the request-scoped tracing."""
+
+import json
+import threading
+
+import torch
+
+from pocket_tts.data.audio_utils import convert_audio
+from pocket_tts.utils import tracing
+from pocket_tts.utils.utils import display_execution_time
+
+
+def test_spans_are_recorded_in_the_current_trace():
+    trace = tracing.Trace("request-1")
+
+    with tracing.span("outside"):
+        pass
+    with tracing.activate(trace):
+        with tracing.span("voice_prompt"):
+            convert_audio(torch.zeros(1, 16000), 16000, 24000, 1)
+        with display_execution_time("Prompting text"):
+            pass
+
+    assert [span["name"] for span in trace.spans] == ["resample", "voice_prompt", "Prompting text"]
+    assert tracing.current_trace() is None
+
+
+def test_server_timing():
+    trace = tracing.Trace()
+    trace.record("wav_write", 0.0, 0.001)
+    trace.record("wav_write", 0.0, 0.002)
+    trace.record("Prompting text", 0.0, 0.01)
+
+    assert trace.server_timing() == (
+        'wav_write;desc="wav_write";dur=3.0, prompting_text;desc="Prompting text";dur=10.0'
+    )
+
+
+def test_threads_do_not_inherit_the_trace():
+    trace = tracing.Trace()
+    seen = []
+
+    def worker():
+        seen.append(tracing.current_trace())
+        with tracing.activate(trace):
+            seen.append(tracing.current_trace())
+
+    with tracing.activate(trace):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+    assert seen == [None, trace]
+
+
+def test_traced_stream():
+    trace = tracing.Trace()
+    chunks = list(tracing.traced_stream(iter([torch.zeros(1920)] * 3), trace))
+
+    assert len(chunks) == 3
+    assert [span["name"] for span in trace.spans] == ["first_audio", "frames"]
+    assert trace.spans[1]["attributes"] == {"chunks": 3}
+
+
+def test_json_lines_exporter(tmp_path):
+    exporter = tracing.JsonLinesExporter(tmp_path / "traces.jsonl")
+    tracing.add_exporter(exporter)
+    try:
+        for request_id in ["a", "b"]:
+            trace = tracing.Trace(request_id)
+            with trace.span("upload"):
+                pass
+            tracing.export(trace)
+    finally:
+        tracing.remove_exporter(exporter)
+
+    lines = (tmp_path / "traces.jsonl").read_text().splitlines()
+    traces = [json.loads(line) for line in lines]
+    assert [trace["request_id"] for trace in traces] == ["a", "b"]
+    assert traces[0]["spans"][0]["name"] == "upload"
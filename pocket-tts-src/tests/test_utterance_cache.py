@@ -0,0 +1,94 @@
+"""Tests for the cache of the generated utterances."""
+
+import os
+from types import SimpleNamespace
+
+import torch
+from fastapi.testclient import TestClient
+
+from pocket_tts import metrics, server
+from pocket_tts.data.audio import encode_wav
+from pocket_tts.utterance_cache import UtteranceCache, utterance_key
+
+
+def test_keys_ignore_the_whitespace_but_not_the_parameters():
+    key = utterance_key("Press  one\nfor sales.", "alba", seed=1, temperature=0.7)
+    assert key == utterance_key(" Press one for sales. ", "alba", temperature=0.7, seed=1)
+    assert key != utterance_key("Press one for sales.", "alba", seed=2, temperature=0.7)
+    assert key != utterance_key("Press one for sales.", "marius", seed=1, temperature=0.7)
+
+
+def test_least_recently_used_utterances_are_evicted():
+    cache = UtteranceCache(max_bytes=25)
+    cache.put("a", b"a" * 10)
+    cache.put("b", b"b" * 10)
+    assert cache.get("a") == b"a" * 10
+    cache.put("c", b"c" * 10)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert len(cache) == 2
+    assert metrics.UTTERANCE_CACHE_BYTES.get() == 20
+
+
+def test_utterances_on_disk_survive_a_restart(tmp_path):
+    cache = UtteranceCache(max_bytes=25, disk_dir=tmp_path, max_disk_bytes=25)
+    for key in "abc":
+        cache.put(key, key.encode() * 10)
+    # The oldest file was evicted from the disk too.
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["b.wav", "c.wav"]
+
+    disk_hits = metrics.UTTERANCE_CACHE_DISK_HITS.value
+    restarted = UtteranceCache(max_bytes=25, disk_dir=tmp_path, max_disk_bytes=25)
+    assert len(restarted) == 0
+    assert restarted.get("b") == b"b" * 10
+    assert metrics.UTTERANCE_CACHE_DISK_HITS.value == disk_hits + 1
+    # Moved back to RAM.
+    assert len(restarted) == 1
+    assert restarted.get("a") is None
+
+
+def test_files_removed_meanwhile_are_misses(tmp_path, monkeypatch):
+    cache = UtteranceCache(max_bytes=25, disk_dir=tmp_path, max_disk_bytes=25)
+    for key in "ab":
+        cache.put(key, key.encode() * 10)
+    restarted = UtteranceCache(max_bytes=25, disk_dir=tmp_path, max_disk_bytes=25)
+    (tmp_path / "a.wav").unlink()
+    assert restarted.get("a") is None
+    assert "a" not in restarted._disk_entries
+
+    # Evicted between the read and the update of its time.
+    def evicted(path):
+        os.remove(path)
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(os, "utime", evicted)
+    assert restarted.get("b") is None
+    assert restarted._disk_bytes == 0
+
+
+def test_seeded_requests_are_answered_from_the_cache(monkeypatch):
+    model = SimpleNamespace(temp=0.7, lsd_decode_steps=1, noise_clamp=None, eos_threshold=-4.0)
+    cache = UtteranceCache()
+    monkeypatch.setattr(server, "tts_model", model)
+    monkeypatch.setattr(server, "utterance_cache", cache)
+    wav = encode_wav([torch.zeros(10)], sample_rate=100)
+    key = utterance_key(
+        "Your call is important to us.",
+        server.default_voice_identity,
+        seed=3,
+        model=server.model_identity,
+        temperature=0.7,
+        lsd_decode_steps=1,
+        noise_clamp=None,
+        eos_threshold=-4.0,
+        segment_workers=server.segment_workers,
+        low_latency=server.low_latency,
+    )
+    cache.put(key, wav)
+
+    # Without the warmup of the lifespan, the fake model cannot generate.
+    client = TestClient(server.web_app)
+    response = client.post("/tts", data={"text": "Your call is important to us.", "seed": 3})
+    assert response.status_code == 200
+    assert response.headers["x-cache"] == "HIT"
+    assert response.content == wav
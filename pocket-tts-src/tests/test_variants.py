@@ -0,0 +1,50 @@
+"""Tests for the loading of the model with and without voice cloning."""
+
+from pathlib import Path
+
+import pytest
+import torch
+from huggingface_hub.utils import EntryNotFoundError
+
+from pocket_tts import variants
+from pocket_tts.utils.config import Config
+from pocket_tts.utils.utils import size_of_dict
+from pocket_tts.variants import _unique_size, resolve_weights
+
+
+def test_shared_tensors_are_counted_once():
+    # Views of a single memory map, like `load_safetensors_mmap` returns.
+    storage = torch.UntypedStorage(128)
+    first = torch.empty(0, dtype=torch.uint8).set_(storage, 16, (4,))
+    # At byte 64, its storage offset (in elements) is 16 too.
+    second = torch.empty(0, dtype=torch.float32).set_(storage, 16, (4,))
+    state_dicts = {"a": {"first": first, "second": second}, "b": {"second": second}}
+    assert _unique_size(state_dicts) == size_of_dict({"first": first, "second": second})
+
+
+@pytest.mark.parametrize("error", [FileNotFoundError, EntryNotFoundError])
+def test_weights_without_voice_cloning_replace_missing_ones(monkeypatch, error):
+    def download_if_necessary(file_path):
+        if file_path == "with_voice_cloning.safetensors":
+            raise error(file_path)
+        return Path(file_path)
+
+    monkeypatch.setattr(variants, "download_if_necessary", download_if_necessary)
+    config = Config.model_construct(
+        weights_path="with_voice_cloning.safetensors",
+        weights_path_without_voice_cloning="without_voice_cloning.safetensors",
+    )
+    assert resolve_weights(config) == (Path("without_voice_cloning.safetensors"), False)
+
+
+def test_download_errors_are_not_missing_weights(monkeypatch):
+    def download_if_necessary(file_path):
+        raise ConnectionError("Network is unreachable")
+
+    monkeypatch.setattr(variants, "download_if_necessary", download_if_necessary)
+    config = Config.model_construct(
+        weights_path="with_voice_cloning.safetensors",
+        weights_path_without_voice_cloning="without_voice_cloning.safetensors",
+    )
+    with pytest.raises(ConnectionError):
+        resolve_weights(config)
@@ -0,0 +1,40 @@
+"""Tests for the warmup and readiness of the server."""
+
+from fastapi.testclient import TestClient
+
+from pocket_tts import server
+from pocket_tts.warmup import Readiness
+
+
+def test_health_reports_ready_after_warmup(monkeypatch):
+    readiness = Readiness()
+    monkeypatch.setattr(server, "readiness", readiness)
+    client = TestClient(server.web_app)
+
+    response = client.get("/health")
+    assert response.status_code == 503
+    assert response.json()["status"] == "loading"
+
+    readiness.warm_up(None, {}, text=None)
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert response.json() == {"status": "healthy", "warm_latency": None}
+
+
+def test_warm_up_measures_warm_latency():
+    from pocket_tts import TTSModel
+
+    tts_model = TTSModel.load_model(temp=0)
+    voice_state = tts_model.get_state_for_audio_prompt("alba")
+    readiness = Readiness()
+
+    readiness.start_warm_up(tts_model, {"alba": voice_state}, "Hello world.").join()
+    assert readiness.is_ready
+    assert readiness.warm_latency["total_ms"] >= readiness.warm_latency["time_to_first_chunk_ms"]
+
+
+def test_failed_warm_up_is_not_ready():
+    readiness = Readiness()
+    readiness.warm_up(None, {"alba": {}}, "Hello world.")
+    assert readiness.status == "failed"
+    assert not readiness.is_ready
@@ -0,0 +1,143 @@
+"""Tests for the zero-copy loading of the weights."""
+
+import threading
+
+import pytest
+import safetensors.torch
+import torch
+
+from pocket_tts.modules.mlp import SimpleMLPAdaLN
+from pocket_tts.utils.weights_loading import (
+    assign_state_dict,
+    get_mimi_state_dict,
+    load_safetensors_mmap,
+    load_shared_state_dicts,
+    skip_weight_init,
+)
+
+
+def make_flow_net():
+    return SimpleMLPAdaLN(32, 64, 32, 48, num_res_blocks=2, num_time_conds=2)
+
+
+def test_load_safetensors_mmap_matches_safetensors(tmp_path):
+    path = tmp_path / "weights.safetensors"
+    tensors = {
+        "float": torch.randn(3, 4),
+        "half": torch.randn(5).half(),
+        "bfloat": torch.randn(2, 2).bfloat16(),
+        "int": torch.arange(7),
+        "byte": torch.arange(3, dtype=torch.uint8),
+        "empty": torch.zeros(0, 4),
+    }
+    safetensors.torch.save_file(tensors, path)
+
+    loaded = load_safetensors_mmap(path)
+
+    expected = safetensors.torch.load_file(path)
+    assert loaded.keys() == expected.keys()
+    for key, value in expected.items():
+        assert loaded[key].dtype == value.dtype
+        assert torch.equal(loaded[key], value)
+
+
+def test_load_safetensors_mmap_does_not_copy(tmp_path):
+    path = tmp_path / "weights.safetensors"
+    safetensors.torch.save_file({"a": torch.randn(16), "b": torch.randn(4, 4)}, path)
+
+    loaded = load_safetensors_mmap(path)
+
+    storages = {tensor.untyped_storage().data_ptr() for tensor in loaded.values()}
+    assert len(storages) == 1
+    # Writing to a tensor must not modify the file.
+    loaded["a"].zero_()
+    assert not torch.equal(safetensors.torch.load_file(path)["a"], loaded["a"])
+
+
+def test_assign_state_dict_on_meta_module(tmp_path):
+    reference = make_flow_net()
+    path = tmp_path / "flow_net.safetensors"
+    safetensors.torch.save_file(reference.state_dict(), path)
+
+    with torch.device("meta"):
+        flow_net = make_flow_net()
+    assign_state_dict(flow_net, load_safetensors_mmap(path))
+
+    inputs = torch.randn(2, 48), torch.zeros(2, 1), torch.ones(2, 1), torch.randn(2, 32)
+    torch.testing.assert_close(flow_net(*inputs), reference(*inputs))
+
+
+def test_skip_weight_init(tmp_path):
+    reference = make_flow_net()
+    reset_parameters = torch.nn.Linear.reset_parameters
+
+    with skip_weight_init():
+        flow_net = make_flow_net()
+    assign_state_dict(flow_net, reference.state_dict())
+
+    assert torch.nn.Linear.reset_parameters is reset_parameters
+    inputs = torch.randn(2, 48), torch.zeros(2, 1), torch.ones(2, 1), torch.randn(2, 32)
+    torch.testing.assert_close(flow_net(*inputs), reference(*inputs))
+
+
+def test_skip_weight_init_only_applies_to_its_thread():
+    weights = {name: torch.zeros(4, 4) for name in ("skipped", "other_thread")}
+    other_thread = threading.Thread(
+        target=torch.nn.init.kaiming_uniform_, args=(weights["other_thread"],)
+    )
+
+    with skip_weight_init():
+        torch.nn.init.kaiming_uniform_(weights["skipped"])
+        # Another thread sampling during the construction, like a running generation.
+        other_thread.start()
+        other_thread.join()
+
+    assert torch.equal(weights["skipped"], torch.zeros(4, 4))
+    assert not torch.equal(weights["other_thread"], torch.zeros(4, 4))
+
+
+def test_assign_state_dict_missing_tensors():
+    state_dict = make_flow_net().state_dict()
+    del state_dict["input_proj.weight"]
+
+    with torch.device("meta"):
+        flow_net = make_flow_net()
+    with pytest.raises(ValueError, match="input_proj.weight"):
+        assign_state_dict(flow_net, state_dict, strict=False)
+
+
+def test_get_mimi_state_dict_renames_keys(tmp_path):
+    path = tmp_path / "mimi.safetensors"
+    tensors = {
+        "model.decoder.model.0.conv.weight": torch.randn(2, 2),
+        "model.quantizer.vq.codebook": torch.randn(2),
+        "model.quantizer.logvar_proj.weight": torch.randn(2),
+    }
+    safetensors.torch.save_file(tensors, path)
+
+    state_dict = get_mimi_state_dict(path)
+
+    assert list(state_dict) == ["decoder.model.0.conv.weight"]
+
+
+def test_load_shared_state_dicts(tmp_path):
+    shared, renamed = torch.randn(8, 4), torch.randn(3)
+    files = {
+        "a": {"shared": shared, "renamed": renamed, "different": torch.zeros(8, 4)},
+        "b": {"shared": shared, "other_name": renamed, "different": torch.ones(8, 4)},
+    }
+    paths = {}
+    for name, tensors in files.items():
+        paths[name] = tmp_path / f"{name}.safetensors"
+        safetensors.torch.save_file(tensors, paths[name])
+
+    state_dicts = load_shared_state_dicts(paths)
+
+    for name, tensors in files.items():
+        assert state_dicts[name].keys() == tensors.keys()
+        for key, value in tensors.items():
+            assert torch.equal(state_dicts[name][key], value)
+    a, b = state_dicts["a"], state_dicts["b"]
+    assert a["shared"] is b["shared"]
+    assert a["renamed"] is b["other_name"]
+    assert a["different"].data_ptr() != b["different"].data_ptr()
@@ -1,8 +1,11 @@
 import os
 import shutil
+import sys
 from pathlib import Path
 from huggingface_hub import hf_hub_download
 
+sys.path.insert(0, str(Path(__file__).parent / "pocket-tts-src"))
+
 MODELS_DIR = Path(__file__).parent / "models"
 MODELS_DIR.mkdir(exist_ok=True)
 EMBEDDINGS_DIR = MODELS_DIR / "embeddings"
@@ -38,6 +41,25 @@ def download_and_copy(repo_id, filename, revision, target_filename=None):
         print(f"Failed to download {filename}: {e}")
         return None
 
+def pack_local_bundle():
+    from pocket_tts.bundle import pack_bundle
+    from pocket_tts.default_parameters import DEFAULT_VARIANT
+    from pocket_tts.utils.config import load_config
+    import pocket_tts
+
+    config = load_config(Path(pocket_tts.__file__).parent / f"config/{DEFAULT_VARIANT}.yaml")
+    config.weights_path = str(MODELS_DIR / "tts_b6369a24.safetensors")
+    config.weights_path_without_voice_cloning = str(MODELS_DIR / "tts_b6369a24_no_vc.safetensors")
+    config.flow_lm.lookup_table.tokenizer_path = str(MODELS_DIR / "tokenizer.model")
+    voices = {voice: str(EMBEDDINGS_DIR / f"{voice}.safetensors") for voice in VOICES}
+
+    bundle_path = MODELS_DIR / "pocket_tts.bundle"
+    try:
+        pack_bundle(config, bundle_path, voices)
+        print(f"Bundle written to {bundle_path}")
+    except Exception as e:
+        print(f"Failed to pack bundle: {e}")
+
 def main():
     print("Setting up offline models in ./models ...")
 
@@ -81,6 +103,10 @@ def main():
             target_filename=f"embeddings/{voice}.safetensors"
         )
 
+    # 5. Bundle (single file, memory-mapped by app.py at startup)
+    print("\nPacking models into a single bundle...")
+    pack_local_bundle()
+
     print("\nOffline setup complete.")
 
 if __name__ == "__main__":
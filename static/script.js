@@ -55,8 +55,12 @@ document.addEventListener('DOMContentLoaded', async () => {
                 }
 
                 loadVoices();
+            } else if (data.status === 'failed') {
+                statusBadge.textContent = "Warmup Failed";
+                statusBadge.className = "badge error";
+                generateBtn.disabled = true;
             } else {
-                statusBadge.textContent = "Loading Model...";
+                statusBadge.textContent = data.status === 'warming_up' ? "Warming Up..." : "Loading Model...";
                 statusBadge.className = "badge loading";
                 generateBtn.disabled = true;
                 setTimeout(checkStatus, 2000);
@@ -174,6 +178,7 @@ document.addEventListener('DOMContentLoaded', async () => {
 
     const stopBtn = document.getElementById('stop-btn');
     let abortController = null;
+    let currentRequestId = null;
 
     // Stop Button
     stopBtn.addEventListener('click', async () => {
@@ -182,9 +187,12 @@ document.addEventListener('DOMContentLoaded', async () => {
             abortController = null;
         }
 
-        // Notify server
+        // Notify server, only this generation is stopped
         try {
-            await fetch(`${API_BASE}/stop`, { method: 'POST' });
+            await fetch(`${API_BASE}/stop`, {
+                method: 'POST',
+                headers: { 'X-Request-ID': currentRequestId }
+            });
         } catch (e) {
             console.error("Failed to notify stop", e);
         }
@@ -192,6 +200,29 @@ document.addEventListener('DOMContentLoaded', async () => {
         resetUI();
     });
 
+    // Shows the position of the request while it waits for a generation slot
+    function pollQueuePosition(requestId) {
+        const stopText = stopBtn.querySelector('.btn-text');
+        const timer = setInterval(async () => {
+            try {
+                const res = await fetch(`${API_BASE}/queue/${requestId}`);
+                if (!res.ok) return;
+                const data = await res.json();
+                // A long generation can be paused while shorter requests run
+                const label = data.state === 'preempted' ? 'paused' : 'queued';
+                stopText.textContent = data.state === 'running'
+                    ? "Stop Generation"
+                    : `Stop (${label} #${data.position}, ~${Math.ceil(data.estimated_wait_seconds)} s)`;
+            } catch (e) {
+                console.error("Failed to get the queue position", e);
+            }
+        }, 1000);
+        return () => {
+            clearInterval(timer);
+            stopText.textContent = "Stop Generation";
+        };
+    }
+
     function resetUI() {
         generateBtn.classList.remove('loading');
         generateBtn.style.display = '';
@@ -231,14 +262,22 @@ document.addEventListener('DOMContentLoaded', async () => {
         formData.append('lsd_steps', lsdInput.value);
 
         abortController = new AbortController();
+        const requestId = crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random()}`;
+        currentRequestId = requestId;
+        const stopPolling = pollQueuePosition(requestId);
 
         try {
             const res = await fetch(`${API_BASE}/generate`, {
                 method: 'POST',
                 body: formData,
+                headers: { 'X-Request-ID': requestId },
                 signal: abortController.signal
             });
 
+            if (res.status === 429) {
+                const retryAfter = res.headers.get('Retry-After');
+                throw new Error(`The server is busy, retry in ${retryAfter} seconds.`);
+            }
             if (!res.ok) throw new Error(await res.text());
 
             // It's a streaming response, but we can consume it as a blob for <audio> src
@@ -264,6 +303,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                 alert("Error generating speech: " + e.message);
             }
         } finally {
+            stopPolling();
             resetUI();
             abortController = null;
         }